@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+パイプライン全体のオフラインベンチマーク
+
+Gemini API（google.generativeai）、markerのコンバータ、PDFのレンダリングを
+gps.fakes の代替実装に置き換え、合成した論文のコーパス（デフォルト: 10/100/1000本）を
+`gps` の通常の処理（変換・要約・翻訳・レンダリングのパイプライン）で処理する。
+コーパスの大きさごとに別のプロセスで実行し、以下を報告する。
+
+- ステージごとの件数、p50/p95、1時間あたりの件数
+- 1時間あたりの論文数
+- 最大RSS
+- レート制限による待ち時間
+
+結果は benchmarks/baselines/e2e.json（--save-baselineで保存）と比較し、
+論文数/時が許容範囲（--tolerance）を超えて減るか、最大RSSが増えた場合に失敗する。
+ベースラインは実行したマシンに依存するため、同じマシンで保存したものと比較すること。
+--real-pandoc を指定した場合は、レンダリングに実際のpandocとlualatexを使う。
+gps の追加のオプションは `--` の後に指定する。
+
+    PYTHONPATH=src python benchmarks/e2e.py --sizes 10,100
+    PYTHONPATH=src python benchmarks/e2e.py --sizes 100 -- --ccache --chunk-tokens 0
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "e2e.json")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def respond(contents):
+    """要約は短い文章を、翻訳は入力（チャンクまたは文書全体）をそのまま返す"""
+    from gps import prompts
+    texts = [c if isinstance(c, str) else getattr(c, "text", "") for c in contents]
+    if prompts.summary_prompt in texts:
+        return "## 要約\n\n合成した論文の要約です。提案手法は計算量を削減しつつ精度を維持する。\n"
+    for prompt in (prompts.chunk_prompt, prompts.chunk_memory_prompt):
+        if prompt in texts:
+            return [t for t in texts if t != prompt][-1] + "\n<EOF>"
+    return max(texts, key=len) + "\n<EOF>"
+
+
+def install_fakes(args):
+    """Gemini API、marker、レンダリングを代替実装に置き換える"""
+    import google
+    from gps import fakes
+    genai = fakes.FakeGenAI(
+        upload_latency=args.upload_latency,
+        response=respond,
+        latency=args.latency,
+        chunk_latency=args.chunk_latency,
+        chunk_size=args.chunk_size,
+        prompt_tokens=None,
+        fail_rate=args.fail_rate,
+        retry_delay=args.retry_delay,
+    )
+    sys.modules["google.generativeai"] = genai
+    google.generativeai = genai
+    os.environ["GEMINI_API_KEY"] = "fake"
+
+    from gps import create_md
+    create_md.create_md = fakes.FakeMarker(args.pages, latency=args.convert_latency).create_md
+    if not args.real_pandoc:
+        from gps import md_to_pdf
+        md_to_pdf.convert_isolated = fakes.FakeRenderer(args.render_latency).convert_isolated
+
+
+def make_corpus(input_dir, size):
+    """内容の異なるPDF（中身は読まれないため、ヘッダーのみ）をsize本作成する"""
+    for i in range(size):
+        path = os.path.join(input_dir, f"batch{i // 100:02d}", f"paper{i:04d}.pdf")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(f"%PDF-1.4\n% synthetic paper {i}\n".encode("ascii"))
+
+
+def run_child(args, gps_args):
+    """1つのコーパスをこのプロセスで処理し、結果をargs.resultに書き出す"""
+    random.seed(args.seed)
+    install_fakes(args)
+    work_dir = os.path.abspath(args.work_dir)
+    if args.real_pandoc:
+        os.symlink(os.path.join(REPO_DIR, "configs"), os.path.join(work_dir, "configs"))
+    os.chdir(work_dir)
+    make_corpus("input", args.child)
+
+    from gps.__main__ import main
+    from gps import gemini, metrics
+    start = time.monotonic()
+    main([
+        "input", "-o", "output", "--rpm", str(args.rpm), "--tpm", str(args.tpm),
+        "--workers", str(args.workers), "--metrics", "logs/metrics.jsonl", *gps_args,
+    ])
+    wall = time.monotonic() - start
+
+    stages, runs = metrics.summarize_runs(metrics.load("logs/metrics.jsonl"))
+    run = runs[-1] if runs else {}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = {
+        "papers": run.get("papers", 0),
+        "wall": wall,
+        "papers_per_hour": run.get("papers", 0) / wall * 3600 if wall else 0.0,
+        # Linuxではru_maxrssの単位はKB
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "peak_child_rss_mb": children.ru_maxrss / 1024,
+        "ratelimit_wait_seconds": sum(limiter.waited for limiter in gemini.limiters.values())
+        + sum(key.limiter.waited for key in (gemini.key_pool.keys if gemini.key_pool else [])),
+        "throttled_requests": run.get("throttled_requests", 0),
+        "stages": {
+            stage: {
+                "count": s["count"],
+                "p50": s["p50"],
+                "p95": s["p95"],
+                "per_hour": s["count"] / wall * 3600 if wall else 0.0,
+            }
+            for stage, s in stages.items()
+        },
+    }
+    with open(args.result, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+
+def run_size(size, verbose):
+    """コーパスの大きさごとに新しいプロセスで実行する（最大RSSを分けて計測するため）"""
+    work_dir = tempfile.mkdtemp(prefix=f"gps-e2e-{size}-")
+    result_path = os.path.join(work_dir, "result.json")
+    try:
+        output = None if verbose else subprocess.DEVNULL
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+             "--child", str(size), "--work-dir", work_dir, "--result", result_path],
+            stdout=output, stderr=output,
+        )
+        if proc.returncode != 0 or not os.path.exists(result_path):
+            raise RuntimeError(f"{size}本のコーパスの処理に失敗しました（--verboseで出力を表示）")
+        with open(result_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def format_result(size, result):
+    lines = [
+        f"{size} papers: {result['papers']} done in {result['wall']:.1f} s, "
+        f"{result['papers_per_hour']:.0f} papers/h, peak RSS {result['peak_rss_mb']:.0f} MB, "
+        f"rate limiter wait {result['ratelimit_wait_seconds']:.1f} s, throttled {result['throttled_requests']:.0f}",
+        f"  {'stage':<14}{'count':>7}{'p50 s':>10}{'p95 s':>10}{'per hour':>11}",
+    ]
+    for stage, s in sorted(result["stages"].items()):
+        lines.append(f"  {stage:<14}{s['count']:>7}{s['p50']:>10.3f}{s['p95']:>10.3f}{s['per_hour']:>11.0f}")
+    return "\n".join(lines)
+
+
+def compare(size, result, baseline, tolerance):
+    """ベースラインと比較し、悪化した項目のメッセージを返す"""
+    problems = []
+    if result["papers_per_hour"] < baseline["papers_per_hour"] * (1 - tolerance):
+        problems.append(f"papers/h {result['papers_per_hour']:.0f} < baseline {baseline['papers_per_hour']:.0f}")
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        problems.append(f"peak RSS {result['peak_rss_mb']:.0f} MB > baseline {baseline['peak_rss_mb']:.0f} MB")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the whole pipeline offline with fake Gemini, marker and renderer backends",
+        epilog="Arguments after -- are passed to gps.",
+    )
+    parser.add_argument("--sizes", default="10,100,1000", help="Comma-separated corpus sizes (default: 10,100,1000)")
+    parser.add_argument("--rpm", type=int, default=6000, help="gps --rpm (default: 6000)")
+    parser.add_argument("--tpm", type=int, default=0, help="gps --tpm (default: 0)")
+    parser.add_argument("--workers", type=int, default=4, help="gps --workers (default: 4)")
+    parser.add_argument("--pages", type=int, default=10, help="Pages per synthetic paper (default: 10)")
+    parser.add_argument("--convert-latency", type=float, default=0.01, help="Fake marker seconds per page (default: 0.01)")
+    parser.add_argument("--upload-latency", type=float, default=0.05, help="Fake upload seconds per file (default: 0.05)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake Gemini seconds before the first chunk (default: 0.05)")
+    parser.add_argument("--chunk-latency", type=float, default=0.001, help="Fake Gemini seconds between chunks (default: 0.001)")
+    parser.add_argument("--chunk-size", type=int, default=512, help="Fake Gemini characters per streamed chunk (default: 512)")
+    parser.add_argument("--fail-rate", type=float, default=0.01, help="Fraction of requests answered with a 429 (default: 0.01)")
+    parser.add_argument("--retry-delay", type=float, default=0.5, help="Retry hint in seconds sent with each 429 (default: 0.5)")
+    parser.add_argument("--render-latency", type=float, default=0.05, help="Fake render seconds per paper (default: 0.05)")
+    parser.add_argument("--real-pandoc", action="store_true", help="Render with the real pandoc and lualatex")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for 429 injection (default: 0)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline results file (default: benchmarks/baselines/e2e.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline (default: 0.2)")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of gps")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    argv = sys.argv[1:]
+    gps_args = []
+    if "--" in argv:
+        gps_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+
+    if args.child is not None:
+        run_child(args, gps_args)
+        return
+
+    if args.real_pandoc and (not shutil.which("pandoc") or not shutil.which("lualatex")):
+        print("--real-pandoc には pandoc と lualatex が必要です")
+        sys.exit(2)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baselines = json.load(f)
+
+    results = {}
+    failed = False
+    for size in (int(s) for s in args.sizes.split(",")):
+        result = results[str(size)] = run_size(size, args.verbose)
+        print(format_result(size, result))
+        if result["papers"] < size:
+            print(f"  NG: only {result['papers']} of {size} papers finished")
+            failed = True
+        if not args.save_baseline and str(size) in baselines:
+            for problem in compare(size, result, baselines[str(size)], args.tolerance):
+                print(f"  NG: {problem}")
+                failed = True
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({**baselines, **results}, f, indent=2)
+        print(f"Saved baseline: {args.baseline}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+PDFレンダリングのベンチマーク（TeXキャッシュなし／あり、画像の最適化なし／ありの比較）
+
+翻訳済みの論文を模したマークダウンを作成し、以下のレンダリング時間を比較する。
+
+- cold: 空のTeXキャッシュディレクトリから毎回レンダリング
+- warm: ツールが管理するTeXキャッシュを作成済みの状態でレンダリング（元の画像を埋め込む）
+- optimized: warmに加えて、画像を最適化してから埋め込む（最適化した画像のキャッシュは1回目に作成）
+
+レンダリング結果のキャッシュ（render_cache）はいずれも使用しない。
+--images を指定すると、写真を模した大きな画像を含める（Pillowが必要）。
+pandocとlualatexが必要。
+
+    python benchmarks/render.py --runs 3 --images 6
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from gps import image_opt, md_to_pdf
+
+
+def sample_images(paper_dir, count, size=(3000, 2000)):
+    """markerが書き出す図を模した大きなJPEG画像を作成する"""
+    from PIL import Image
+
+    names = []
+    for k in range(count):
+        # ノイズにグラデーションを重ねて、写真のように圧縮しにくい画像にする
+        noise = Image.effect_noise(size, 40 + k).convert("RGB")
+        gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+        name = f"_page_{k}_Figure_1.jpeg"
+        Image.blend(noise, gradient, 0.5).save(os.path.join(paper_dir, name), "JPEG", quality=95)
+        names.append(name)
+    return names
+
+
+def sample_paper(sections=8, paragraphs=4, images=()):
+    """翻訳済みの論文を模したマークダウンを作成する"""
+    lines = ["# 大規模言語モデルを用いた論文翻訳の評価", ""]
+    for i in range(1, sections + 1):
+        lines += [f"## {i}. セクション{i}", ""]
+        if images:
+            lines += [f"![図{i}]({images[(i - 1) % len(images)]})", ""]
+        for j in range(paragraphs):
+            lines += [
+                f"本節では提案手法の第{j + 1}の特徴について述べる。"
+                "既存手法と比較して、提案手法は計算量を削減しつつ精度を維持する。"
+                f"式 $f(x) = \\sum_{{k=1}}^{{{i}}} w_k x^k$ に示すように、重みは学習によって決定される。",
+                "",
+            ]
+        lines += ["| 手法 | 精度 | 時間 |", "|---|---|---|", "| 従来法 | 0.81 | 12.3 |", "| 提案法 | 0.86 | 8.7 |", ""]
+    lines += ["## 参考文献", ""]
+    lines += [f"{k}. 著者{k}. 論文タイトル{k}の和訳. 会議名, 2023." for k in range(1, 21)]
+    return "\n".join(lines) + "\n"
+
+
+def render(md_path, output_path, template, font, engine, tex_cache_dir, image_cache_dir=None, stats=None):
+    start = time.monotonic()
+    _, result, _, _ = md_to_pdf.convert_isolated(
+        md_path, output_path, font, template, engine, cache_dir=None, tex_cache_dir=tex_cache_dir,
+        image_cache_dir=image_cache_dir, stats=stats,
+    )
+    if not result:
+        raise RuntimeError("レンダリングに失敗しました")
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare cold and warm LuaLaTeX render times")
+    parser.add_argument("--runs", type=int, default=3, help="Number of renders per mode (default: 3)")
+    parser.add_argument("--template", default="configs/template.tex", help="Template path (default: configs/template.tex)")
+    parser.add_argument("--font", default="IPAexGothic", help="Font name (default: IPAexGothic)")
+    parser.add_argument("--engine", default="lualatex", help="PDF engine (default: lualatex)")
+    parser.add_argument("--markdown", help="Render this markdown file instead of the generated sample")
+    parser.add_argument("--images", type=int, default=0, help="Number of distinct large figures in the generated sample (default: 0)")
+    parser.add_argument("--image-dpi", type=int, default=image_opt.DEFAULT_DPI, help=f"Resolution images are downsampled to (default: {image_opt.DEFAULT_DPI})")
+    args = parser.parse_args()
+
+    if not shutil.which("pandoc") or not shutil.which(args.engine):
+        print(f"pandoc と {args.engine} が必要です")
+        sys.exit(2)
+
+    work_dir = tempfile.mkdtemp(prefix="gps-render-bench-")
+    try:
+        paper_dir = os.path.join(work_dir, "paper")
+        os.makedirs(paper_dir)
+        md_path = os.path.join(paper_dir, "combined.md")
+        if args.markdown:
+            shutil.copy(args.markdown, md_path)
+        else:
+            images = sample_images(paper_dir, args.images) if args.images else ()
+            with open(md_path, "w", encoding="utf-8") as f:
+                f.write(sample_paper(images=images))
+        output_path = os.path.join(work_dir, "paper.pdf")
+
+        cold = []
+        for i in range(args.runs):
+            # 毎回空のキャッシュディレクトリを使う
+            cold_dir = os.path.join(work_dir, f"cold-{i}")
+            cold.append(render(md_path, output_path, args.template, args.font, args.engine, cold_dir))
+
+        warm_dir = os.path.join(work_dir, "warm")
+        md_to_pdf.prepare_tex_cache(args.font, args.template, args.engine, warm_dir)
+        warm = [render(md_path, output_path, args.template, args.font, args.engine, warm_dir) for _ in range(args.runs)]
+        warm_size = os.path.getsize(output_path)
+
+        image_dir = os.path.join(work_dir, "images")
+        stats = {}
+        optimized = [
+            render(md_path, output_path, args.template, args.font, args.engine, warm_dir, image_dir, stats)
+            for _ in range(args.runs)
+        ]
+        optimized_size = os.path.getsize(output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"cold: median {statistics.median(cold):.2f} s ({', '.join(f'{t:.2f}' for t in cold)})")
+    print(f"warm: median {statistics.median(warm):.2f} s ({', '.join(f'{t:.2f}' for t in warm)})")
+    print(f"optimized: median {statistics.median(optimized):.2f} s ({', '.join(f'{t:.2f}' for t in optimized)})")
+    print(f"speedup (cold -> warm): {statistics.median(cold) / statistics.median(warm):.2f}x")
+    print(f"render time reduction (warm -> optimized): {1 - statistics.median(optimized) / statistics.median(warm):.1%}")
+    print(f"image bytes saved: {stats.get('image_bytes_saved', 0) / 1e6:.1f} MB, "
+          f"PDF size: {warm_size / 1e6:.1f} MB -> {optimized_size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
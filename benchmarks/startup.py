@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+CLIの起動時間のベンチマーク
+
+`python -X importtime` で `gps --help` と `md-to-pdf --help` を実行し、
+起動時間が予算を超えた場合や重い依存パッケージが読み込まれた場合に失敗する。
+
+    python benchmarks/startup.py --budget-ms 300
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# --help の実行時には読み込まれてはならないパッケージ
+HEAVY_MODULES = ["google.generativeai", "google.api_core", "marker", "torch", "pypandoc", "dotenv"]
+
+COMMANDS = {
+    "gps": "from gps.__main__ import main; main(['--help'])",
+    "md-to-pdf": "import sys; sys.argv = ['md-to-pdf', '--help']; from gps.md_to_pdf import main; main()",
+}
+
+
+def run_once(code):
+    """コードを新しいプロセスで実行し、経過時間（ms）とimporttimeの出力を返す"""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    elapsed = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    return elapsed, proc.stderr
+
+
+def parse_importtime(stderr):
+    """importtimeの出力を (モジュール名, 累積時間us) のリストに変換する"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        imports.append((module.strip(), int(cumulative)))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI startup time with python -X importtime")
+    parser.add_argument("--budget-ms", type=float, default=300, help="Maximum median wall time in ms (default: 300)")
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs per command (default: 5)")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to show (default: 10)")
+    args = parser.parse_args()
+
+    failed = False
+    for name, code in COMMANDS.items():
+        times = []
+        for _ in range(args.runs):
+            elapsed, stderr = run_once(code)
+            times.append(elapsed)
+        median = statistics.median(times)
+        imports = parse_importtime(stderr)
+        loaded = {module for module, _ in imports}
+        heavy = [m for m in HEAVY_MODULES if m in loaded]
+
+        print(f"{name} --help: median {median:.1f} ms (min {min(times):.1f} ms, budget {args.budget_ms:.0f} ms)")
+        for module, cumulative in sorted(imports, key=lambda x: x[1], reverse=True)[:args.top]:
+            print(f"  {cumulative / 1000:8.1f} ms  {module}")
+        if heavy:
+            print(f"  NG: heavy modules imported: {', '.join(heavy)}")
+            failed = True
+        if median > args.budget_ms:
+            print("  NG: over budget")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,20 @@
 import argparse
 from .__init__ import name, __version__
 import os
-from dotenv import load_dotenv
-import google.generativeai as genai
-from .summarize import summarize
-from . import gemini  # geminiモジュールを直接インポート
 import gps.prompts as prompts
 from pathlib import Path
-from .create_md import create_md
-import json
 import logging
 from datetime import datetime
 import subprocess
-from .md_to_pdf import convert_md_to_pdf
+import threading
+import sys
+from .pipeline import Pipeline, Stage
+from . import response_cache
+from . import partial
+from . import metrics
+from . import jobstore
+from . import sync
+from .jobstore import JobStore, sha256_file
 
 # ロガーの取得
 logger = logging.getLogger(__name__)
@@ -66,141 +68,238 @@ def setup_logging():
     cost_logger.addHandler(cost_console_handler)
 
 # 料金を計算する関数
-def calculate_cost(prompt_tokens, candidates_tokens):
-    """トークン数から料金を計算する"""
-    # 入力トークン: 1Mあたり25円、出力トークン: 1Mあたり100円
-    input_cost_per_million = 25
-    output_cost_per_million = 100
-    
-    input_cost = prompt_tokens * input_cost_per_million / 1000000
-    output_cost = candidates_tokens * output_cost_per_million / 1000000
-    total_cost = input_cost + output_cost
+def calculate_cost(prompt_tokens, candidates_tokens, model_name=None, cached_tokens=0, batch=False):
+    """トークン数から料金を計算する（料金はgps.ledger.MODEL_RATES）"""
+    from . import ledger
+    return ledger.cost(model_name, prompt_tokens, candidates_tokens, cached_tokens, batch)
+
+def log_cost(label, pdf_path, usage, model_name=None):
+    """統計情報から料金を計算して料金ログに記録する"""
+    from . import ledger
+    prompt_tokens = usage.get("prompt_token_count", 0)
+    candidates_tokens = usage.get("candidates_token_count", 0)
+    cached_tokens = usage.get("cached_content_token_count", 0)
+    input_cost, output_cost, total_cost = calculate_cost(prompt_tokens, candidates_tokens, model_name, cached_tokens)
+    savings = ledger.cache_savings(model_name, cached_tokens)
     
-    return input_cost, output_cost, total_cost
+    cost_logger.info(f"{label}の料金情報 - ファイル: {pdf_path}")
+    cost_logger.info(f"入力トークン数: {prompt_tokens}, 入力料金: {input_cost:.2f}円")
+    if cached_tokens:
+        cost_logger.info(f"キャッシュ済みトークン数: {cached_tokens}, 削減額: {savings:.2f}円")
+    cost_logger.info(f"出力トークン数: {candidates_tokens}, 出力料金: {output_cost:.2f}円")
+    cost_logger.info(f"合計料金: {total_cost:.2f}円")
+    metrics.add("cost_yen", total_cost, paper=pdf_path)
+    metrics.add("cache_savings_yen", savings, paper=pdf_path)
+
+# コンテキストキャッシュのマネージャ（--ccacheで最初に使うときに作成する）
+context_caches = None
+context_caches_lock = threading.Lock()
+
+def get_context_caches(args):
+    """コンテキストキャッシュのマネージャを取得する"""
+    global context_caches
+    from .context_cache import ContextCacheManager
+    with context_caches_lock:
+        if context_caches is None:
+            context_caches = ContextCacheManager(ttl=args.ccache_ttl)
+        return context_caches
+
+def close_context_caches():
+    """残っているコンテキストキャッシュを削除し、利用状況を記録する"""
+    if context_caches is not None:
+        context_caches.close()
+        stats = context_caches.stats
+        logger.info(f"コンテキストキャッシュ - 作成: {stats['created']}, 再利用: {stats['reused']}, 最小サイズ未満: {stats['skipped']}")
+
+# 翻訳メモリ（最初に使うときに開く）
+translation_memory = None
+translation_memory_lock = threading.Lock()
+
+def get_translation_memory(args):
+    """翻訳メモリを取得する（--no-translation-memoryの場合はNone）"""
+    global translation_memory
+    if args.no_translation_memory:
+        return None
+    from .translation_memory import TranslationMemory
+    with translation_memory_lock:
+        if translation_memory is None:
+            translation_memory = TranslationMemory(args.translation_memory, args.tm_fuzzy)
+        return translation_memory
+
+def close_translation_memory():
+    """翻訳メモリの利用状況を記録して閉じる"""
+    if translation_memory is not None:
+        stats = translation_memory.stats()
+        logger.info(
+            f"翻訳メモリ - セグメント数: {stats['segments']}（訳文あり {stats['translated_segments']}）, "
+            f"埋めたセグメント数: {stats['hits']}（{stats['saved_chars']}文字）, 送信しなかったチャンク数: {stats['local_chunks']}"
+        )
+        metrics.add("tm_segments_filled", stats["hits"])
+        metrics.add("tm_chars_filled", stats["saved_chars"])
+        translation_memory.close()
 
-# ログファイルの設定
-LOG_FILE = "logs/pdf_processing_log.json"
-if os.path.exists(LOG_FILE):
+def learn_translation(md_path, translation, args):
+    """完了した翻訳を翻訳メモリに追加する"""
+    memory = get_translation_memory(args)
+    if memory is None:
+        return
     try:
-        with open(LOG_FILE, 'r', encoding='utf-8') as f:
-            processing_log = json.load(f)
-        logger.info(f"既存のログファイルを読み込みました: {len(processing_log)}件のエントリがあります")
-    except json.JSONDecodeError:
-        logger.warning(f"ログファイルの形式が不正です。新しいログファイルを作成します: {LOG_FILE}")
-        processing_log = {}
-else:
-    logger.info(f"新しいログファイルを作成します: {LOG_FILE}")
-    processing_log = {}
-
-def update_log(file_path, status, error=None):
-    """ログファイルを更新する"""
-    # 絶対パスを正規化して保存
-    normalized_path = str(Path(file_path).resolve())
-    
-    # 現在の処理情報
-    current_entry = {
-        "status": status,
-        "timestamp": datetime.now().isoformat(),
-        "error": str(error) if error else None
-    }
-    
-    # 新しいパスの場合は初期化
-    if normalized_path not in processing_log:
-        processing_log[normalized_path] = {}
-    
-    # 既存のエントリがある場合は履歴として保存
-    if "status" in processing_log[normalized_path]:
-        # 履歴フィールドがなければ作成
-        if "history" not in processing_log[normalized_path]:
-            processing_log[normalized_path]["history"] = []
-        
-        # 現在の内容を履歴に追加
-        old_entry = {
-            "status": processing_log[normalized_path].get("status"),
-            "timestamp": processing_log[normalized_path].get("timestamp"),
-            "error": processing_log[normalized_path].get("error")
-        }
-        processing_log[normalized_path]["history"].append(old_entry)
-    
-    # 現在の処理情報を更新
-    processing_log[normalized_path].update(current_entry)
-    
-    # ログファイルに書き込み
+        with open(md_path, "r", encoding="utf-8") as f:
+            source = f.read()
+        memory.learn(source, translation)
+    except Exception as e:
+        logger.warning(f"翻訳メモリの更新に失敗しました: {e}")
+
+# 処理状況のジョブストア（最初の更新時に開く）
+job_store = None
+job_store_lock = threading.Lock()
+
+def get_job_store():
+    """ジョブストアを取得する。初回は以前のJSON形式のログも取り込む"""
+    global job_store
+    with job_store_lock:
+        if job_store is None:
+            job_store = JobStore(jobstore.DEFAULT_PATH)
+            job_store.import_legacy_log()
+        return job_store
+
+def update_log(file_path, status, error=None, content_hash=None):
+    """ジョブストアの処理状況を更新する"""
     try:
-        with open(LOG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(processing_log, f, ensure_ascii=False, indent=2)
-        logger.debug(f"ログファイルを更新しました: {normalized_path}, 状態: {status}")
+        get_job_store().update(file_path, status, error, content_hash)
     except Exception as e:
-        logger.error(f"ログファイルの更新に失敗しました: {e}")
+        logger.error(f"ジョブストアの更新に失敗しました: {e}")
 
-def process_pdf_file(pdf_path, output_dir, args):
-    """個々のPDFファイルを処理する"""
+def convert_stage(job, args):
+    """PDFをマークダウンに変換するステージ。スキップまたは失敗した場合はNoneを返す"""
+    pdf_path = job["pdf_path"]
     try:
-        if pdf_path in processing_log:
-            if processing_log[pdf_path]["status"] == "success":
+        # 正規化したパスで処理状況を確認し、処理する権利を取得する（内容が変わっていれば再処理する）
+        # 確認と更新は1つのトランザクションで行うため、同時に動く他のプロセスと重複して処理しない
+        # （ワークキューのリースを取得した場合は、前のワーカーが残した状態を引き継ぐ）
+        content_hash = sha256_file(pdf_path)
+        claimed, entry = get_job_store().claim(pdf_path, content_hash, force=bool(job.get("lease")))
+        if not claimed:
+            if entry["status"] == "success":
                 logger.info(f"スキップ: {pdf_path} は既に処理済みです")
-                return
-            elif processing_log[pdf_path]["status"] == "processing":
-                logger.info(f"スキップ: {pdf_path} は処理中です")
-                return
-            elif processing_log[pdf_path]["status"] == "failed":
+            else:
+                logger.info(f"スキップ: {pdf_path} は処理中です（{entry['owner'] or entry['timestamp']}）")
+            return None
+        if entry and entry["content_hash"] in (None, content_hash):
+            if entry["status"] == "processing" and job.get("lease"):
+                logger.info(f"引き継ぎ: {pdf_path} は他のワーカーが処理していました（{entry['owner']}）")
+            elif entry["status"] == "processing":
+                logger.info(f"再試行: {pdf_path} は中断されたまま残っていました（{entry['owner'] or entry['timestamp']}）")
+            elif entry["status"] == "failed":
                 logger.info(f"再試行: {pdf_path} は処理に失敗しました")
 
         logger.info(f"PDFファイルを処理中: {pdf_path}")
-        update_log(pdf_path, "processing")
         
-        _, md_path = create_md(pdf_path, output_dir)
+        from .create_md import create_md
+        with metrics.span("convert", paper=pdf_path):
+            _, job["md_path"] = create_md(pdf_path, job["output_dir"], args.page_window)
+        return job
+    except Exception as e:
+        logger.error(f"エラー: {pdf_path} の処理中にエラーが発生しました: {str(e)}")
+        update_log(pdf_path, "failed", e)
+        return None
 
+async def generate_summary_async(pdf_path, md_path, args, file, cache=None):
+    """要約を生成してsummary.mdとして保存する"""
+    genai = configure_gemini()
+    from . import gemini
+    model_name = get_model_name(args)
+    logger.info(f"要約を生成中: {md_path}")
+    
+    with open(md_path, "r", encoding="utf-8") as f:
+        markdown = f.read()
+    
+    # 要約用のモデル設定
+    if cache:
+        summary_model = genai.GenerativeModel.from_cached_content(cache)
+        summary_model.generation_config = generation_config
+        contents = (prompts.summary_prompt,)
+    else:
+        summary_model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            system_instruction=prompts.system_instruction,
+        )
+        # アップロードしていない場合（--batch）はマークダウンを直接渡す
+        contents = (file or markdown, prompts.summary_prompt)
+    
+    # 要約を生成（同じ内容・設定の要約が応答キャッシュにあれば再利用）
+    cache_key = response_cache.make_key(
+        markdown, prompts.summary_prompt, model_name, prompts.system_instruction, generation_config
+    )
+    summary_result, summary_usage = await gemini.generate_content_async(
+        summary_model, args.rpm, *contents, max_tpm=args.tpm, cache_key=cache_key
+    )
+    
+    # 要約の保存先
+    summary_dir = os.path.dirname(md_path)
+    summary_path = os.path.join(summary_dir, "summary.md")
+    
+    # 要約を保存
+    with open(summary_path, "w", encoding="utf-8") as f:
+        f.write(summary_result)
+    
+    logger.info(f"要約を保存しました: {summary_path}")
+    
+    # 料金ログの記録
+    log_cost("要約処理", pdf_path, summary_usage, model_name)
+    
+    gemini.show_stats(summary_usage)
+
+async def generate_texts_async(pdf_path, md_path, output_dir, args):
+    """
+    アップロードしたファイル（とコンテキストキャッシュ）を共有して、要約と翻訳を並行に生成する
+    
+    Returns:
+        tuple: (要約の例外またはNone, 翻訳の結果 (translation, output, stats))
+    """
+    import asyncio
+    genai = configure_gemini()
+    from . import gemini
+    from . import keypool
+    from .summarize import summarize_async
+    model_name = get_model_name(args)
+    # キープールを使う場合は、この論文のアップロード・キャッシュとそれらを参照するリクエストに使うキーを選ぶ
+    # （gemini.runのタスク内で設定するため、この論文の処理にだけ適用される）
+    if gemini.key_pool:
+        keypool.current_key.set(gemini.key_pool.choose())
+    # 要約と翻訳で共有するファイルをアップロード
+    # （チャンク翻訳はファイルを使わないため、要約がない場合はアップロードしない。
+    #   --batchでは応答が応答キャッシュにあるため、アップロードせずにマークダウンを直接渡す）
+    file = None
+    if not args.batch and (not args.nosummary or not args.chunk_tokens):
+        with metrics.span("upload"):
+            # イベントループは全ての論文で共有するため、ブロックする呼び出しは別のスレッドで行う
+            file = await asyncio.to_thread(genai.upload_file, md_path, mime_type="text/markdown")
+        print(f"Uploaded markdown file '{file.display_name}' as: {file.uri}")
+    cache = None
+    cache_key = None
+    try:
+        if args.ccache and file:
+            # 要約・翻訳・続きの取得で共有するコンテキストキャッシュ（同じ内容の論文とも共有）
+            with open(md_path, "r", encoding="utf-8") as f:
+                markdown = f.read()
+            with metrics.span("ccache") as span:
+                cache_key, cache = await asyncio.to_thread(
+                    get_context_caches(args).acquire, model_name, prompts.system_instruction, file, markdown
+                )
+                span["cached"] = cache is not None
+        
+        tasks = []
         # 要約の生成（--nosummaryが指定されていない場合のみ実行）
         if not args.nosummary:
-            logger.info(f"要約を生成中: {md_path}")
-            
-            # 要約用のモデル設定
-            summary_model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config=generation_config,
-                system_instruction=prompts.system_instruction,
-            )
-            
-            # 要約用のファイルをアップロード
-            summary_file = genai.upload_file(md_path, mime_type="text/markdown")
-            
-            try:
-                # 要約を生成
-                summary_result, summary_usage = gemini.generate_content(summary_model, args.rpm, summary_file, prompts.summary_prompt)
-                
-                # 要約の保存先
-                summary_dir = os.path.dirname(md_path)
-                summary_path = os.path.join(summary_dir, "summary.md")
-                
-                # 要約を保存
-                with open(summary_path, "w", encoding="utf-8") as f:
-                    f.write(summary_result)
-                
-                logger.info(f"要約を保存しました: {summary_path}")
-                
-                prompt_tokens = summary_usage.get("prompt_token_count", 0)
-                candidates_tokens = summary_usage.get("candidates_token_count", 0)
-                input_cost, output_cost, total_cost = calculate_cost(prompt_tokens, candidates_tokens)
-                
-                # 料金ログの記録
-                cost_logger.info(f"要約処理の料金情報 - ファイル: {pdf_path}")
-                cost_logger.info(f"入力トークン数: {prompt_tokens}, 入力料金: {input_cost:.2f}円")
-                cost_logger.info(f"出力トークン数: {candidates_tokens}, 出力料金: {output_cost:.2f}円")
-                cost_logger.info(f"合計料金: {total_cost:.2f}円")
-
-
-                gemini.show_stats(summary_usage)
-            except Exception as e:
-                logger.error(f"要約の生成に失敗しました: {e}")
-                update_log(pdf_path, "failed", e)
-                return
+            tasks.append(metrics.traced("summary", generate_summary_async(pdf_path, md_path, args, file, cache)))
         else:
             logger.info(f"--nosummary オプションが指定されたため、要約をスキップします")
-    
+        
         # 翻訳の生成
         logger.info(f"翻訳を生成中: {md_path}")
-        translation, output, stats = summarize(
+        tasks.append(metrics.traced("translation", summarize_async(
             args.model,
             generation_config,
             prompts.system_instruction,
@@ -211,19 +310,56 @@ def process_pdf_file(pdf_path, output_dir, args):
             args.suffix,
             "",
             args.ccache,
-        )
+            args.tpm,
+            uploaded_file=file,
+            cached_content=cache,
+            chunk_tokens=args.chunk_tokens,
+            chunk_concurrency=args.chunk_concurrency,
+            memory=get_translation_memory(args),
+        )))
         
+        # 両方の完了を待ってからファイルとキャッシュを削除する
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if cache_key:
+            await asyncio.to_thread(get_context_caches(args).release, cache_key)
+        if file:
+            await asyncio.to_thread(genai.delete_file, file.name)
+            print(f"Deleted file '{file.display_name}' from: {file.uri}")
+    
+    summary_error = results[0] if not args.nosummary else None
+    translation_result = results[-1]
+    if isinstance(translation_result, BaseException):
+        raise translation_result
+    return summary_error, translation_result
 
-        # 翻訳処理の料金計算
-        prompt_tokens = stats.get("prompt_token_count", 0)
-        candidates_tokens = stats.get("candidates_token_count", 0)
-        input_cost, output_cost, total_cost = calculate_cost(prompt_tokens, candidates_tokens)
-        
-        # 料金ログの記録
-        cost_logger.info(f"翻訳処理の料金情報 - ファイル: {pdf_path}")
-        cost_logger.info(f"入力トークン数: {prompt_tokens}, 入力料金: {input_cost:.2f}円")
-        cost_logger.info(f"出力トークン数: {candidates_tokens}, 出力料金: {output_cost:.2f}円")
-        cost_logger.info(f"合計料金: {total_cost:.2f}円")
+def generate_stage(job, args):
+    """要約と翻訳を生成し、合体させるステージ。失敗した場合はNoneを返す"""
+    pdf_path = job["pdf_path"]
+    md_path = job["md_path"]
+    output_dir = job["output_dir"]
+    if budget_reached(args):
+        logger.warning(f"予算の上限（{args.budget}円）に達したため、要約と翻訳を行いません: {pdf_path}")
+        update_log(pdf_path, "failed", "予算の上限に達しました")
+        return None
+    try:
+        from . import gemini
+        # 全ての論文で1つのイベントループを共有する（SDKの非同期クライアントは最初のループに結び付くため）
+        with metrics.span("gemini", paper=pdf_path):
+            summary_error, (translation, output, stats) = gemini.run(
+                generate_texts_async(pdf_path, md_path, output_dir, args)
+            )
+        if summary_error:
+            logger.error(f"要約の生成に失敗しました: {summary_error}")
+            update_log(pdf_path, "failed", summary_error)
+            return None
+
+        # 翻訳処理の料金ログの記録
+        log_cost("翻訳処理", pdf_path, stats, get_model_name(args))
+        # 以降の論文で再利用できるよう翻訳メモリに追加する
+        # （--batchでは、投入したリクエストと同じ内容で送信するため実行中は更新しない）
+        if not args.batch:
+            learn_translation(md_path, translation, args)
         
         # 要約と翻訳を合体させる（--nosummaryが指定されていない場合のみ実行）
         combined_path = None
@@ -234,49 +370,88 @@ def process_pdf_file(pdf_path, output_dir, args):
             
             if os.path.exists(summary_path):
                 try:
-                    with open(summary_path, "r", encoding="utf-8") as summary_file:
-                        summary_content = summary_file.read()
-                    
-                    translation_path = os.path.join(md_dir, "translation.md")
-                    if os.path.exists(translation_path):
-                        with open(translation_path, "r", encoding="utf-8") as translation_file:
-                            translation_content = translation_file.read()
-                        
-                        # 合体させた内容
-                        combined_content = summary_content + "\n\n---\n\n## 論文全文\n\n" + translation_content
+                    with metrics.span("merge", paper=pdf_path):
+                        with open(summary_path, "r", encoding="utf-8") as summary_file:
+                            summary_content = summary_file.read()
                         
-                        # 合体したファイルを保存
-                        with open(combined_path, "w", encoding="utf-8") as combined_file:
-                            combined_file.write(combined_content)
-                        
-                        logger.info(f"要約と翻訳を合体させました: {combined_path}")
-                        logger.info(f"入力ファイルを削除しました: {md_path}")
-                        os.unlink(summary_path)
-                        logger.info(f"要約ファイルを削除しました: {summary_path}")
-                        os.unlink(translation_path)
-                        logger.info(f"翻訳ファイルを削除しました: {translation_path}")
+                        translation_path = os.path.join(md_dir, "translation.md")
+                        if os.path.exists(translation_path):
+                            with open(translation_path, "r", encoding="utf-8") as translation_file:
+                                translation_content = translation_file.read()
+                            
+                            # 合体させた内容
+                            combined_content = summary_content + "\n\n---\n\n## 論文全文\n\n" + translation_content
+                            
+                            # 合体したファイルを保存（途中で中断しても不完全なファイルが残らないよう置き換える）
+                            with open(f"{combined_path}.part", "w", encoding="utf-8") as combined_file:
+                                combined_file.write(combined_content)
+                            os.replace(f"{combined_path}.part", combined_path)
+                            
+                            logger.info(f"要約と翻訳を合体させました: {combined_path}")
+                            logger.info(f"入力ファイルを削除しました: {md_path}")
+                            os.unlink(summary_path)
+                            logger.info(f"要約ファイルを削除しました: {summary_path}")
+                            os.unlink(translation_path)
+                            logger.info(f"翻訳ファイルを削除しました: {translation_path}")
                 except Exception as e:
                     logger.error(f"要約と翻訳の合体に失敗しました: {e}")
         else:
             # 要約がない場合は翻訳のみのファイルをPDFに変換
             combined_path = os.path.join(os.path.dirname(md_path), "translation.md")
-            
+        
+        job["combined_path"] = combined_path
+        return job
+    except Exception as e:
+        logger.error(f"エラー: {pdf_path} の処理中にエラーが発生しました: {str(e)}")
+        update_log(pdf_path, "failed", e)
+        return None
+
+def render_stage(job, args):
+    """マークダウンをPDFに変換し、処理を完了させるステージ"""
+    pdf_path = job["pdf_path"]
+    combined_path = job["combined_path"]
+    try:
         # マークダウンをPDFに変換
         if args.convert_pdf and combined_path and os.path.exists(combined_path):
-            convert_md_to_pdf(combined_path)
+            # 並行して動く他のレンダリングと衝突しないよう、ジョブ専用の作業ディレクトリで変換
+            from .md_to_pdf import convert_isolated
+            from . import render_cache
+            from . import tex_cache
+            from . import image_opt
+            cache_dir = None if args.no_render_cache else render_cache.DEFAULT_DIR
+            tex_cache_dir = None if args.no_tex_cache else tex_cache.DEFAULT_DIR
+            image_cache_dir = None if args.no_image_opt else image_opt.DEFAULT_DIR
+            with metrics.span("render", paper=pdf_path) as span:
+                _, _, _, span["cached"] = convert_isolated(
+                    combined_path, cache_dir=cache_dir, tex_cache_dir=tex_cache_dir,
+                    image_cache_dir=image_cache_dir, image_dpi=args.image_dpi, stats=span,
+                )
+                metrics.add("image_bytes_saved", span.get("image_bytes_saved", 0))
         
         update_log(pdf_path, "success")
-        
+        return job
     except Exception as e:
         logger.error(f"エラー: {pdf_path} の処理中にエラーが発生しました: {str(e)}")
         update_log(pdf_path, "failed", e)
+        return None
 
-def process_directory(input_dir, output_dir, args):
-    """ディレクトリ内のPDFファイルを再帰的に処理する"""
+def process_pdf_file(pdf_path, output_dir, args):
+    """個々のPDFファイルを処理する"""
+    job = {"pdf_path": pdf_path, "output_dir": output_dir}
+    for stage in (convert_stage, generate_stage, render_stage):
+        job = stage(job, args)
+        if job is None:
+            return
+
+def stage_workers(args, name):
+    """ステージごとのワーカー数を取得する（未指定の場合は--workersの値）"""
+    workers = getattr(args, f"{name}_workers", None)
+    return workers if workers else args.workers
+
+def collect_jobs(input_dir, output_dir):
+    """ディレクトリ内のPDFファイルを再帰的に探し、処理ジョブを生成する"""
     input_dir = Path(input_dir)
     output_dir = Path(output_dir)
-    
-    logger.info(f"ディレクトリ処理開始: {input_dir}")
     for pdf_file in input_dir.rglob("*.pdf"):
         relative_path = pdf_file.relative_to(input_dir)
         output_path = output_dir / relative_path.parent / pdf_file.stem
@@ -284,29 +459,367 @@ def process_directory(input_dir, output_dir, args):
         # 出力ディレクトリを作成
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
-        process_pdf_file(str(pdf_file), str(output_path), args)
+        yield {"pdf_path": str(pdf_file), "output_dir": str(output_path)}
+
+def budget_reached(args):
+    """--budgetで指定した料金の上限にこの実行で達したかどうか"""
+    from . import gemini
+    return bool(args.budget) and gemini.cost_ledger is not None and gemini.cost_ledger.run_total >= args.budget
+
+def within_budget(jobs, args):
+    """予算の上限に達した時点で、新しい論文の投入をやめる"""
+    for job in jobs:
+        if budget_reached(args):
+            logger.warning(f"予算の上限（{args.budget}円）に達したため、以降の論文は処理しません")
+            return
+        yield job
+
+def run_pipeline(jobs, args, on_done=None, is_lost=None):
+    """
+    変換・生成・レンダリングの各ステージを並行実行するパイプラインでジョブを処理する
+
+    on_doneが指定された場合は、ジョブの処理が終わったとき（途中のステージで止まった場合を含む）に呼び出す。
+    is_lostが指定された場合は、Trueを返したジョブ（ワークキューのリースを失ったもの）の要約と翻訳、
+    レンダリングを行わない。
+    """
+    stages = [
+        Stage("convert", lambda job: convert_stage(job, args), stage_workers(args, "convert")),
+        Stage("gemini", lambda job: generate_stage(job, args), stage_workers(args, "gemini")),
+        Stage("render", lambda job: render_stage(job, args), stage_workers(args, "render")),
+    ]
+    if is_lost:
+        for stage in stages[1:]:
+            stage.func = skip_lost(stage.func, is_lost)
+    if on_done:
+        for i, stage in enumerate(stages):
+            stage.func = notify_done(stage.func, on_done, last=i == len(stages) - 1)
+    Pipeline(stages).run(within_budget(jobs, args))
+
+def notify_done(func, on_done, last=False):
+    """ステージの関数を、ジョブがそのステージで終わった場合にon_doneを呼び出すようにする"""
+    def run(job):
+        result = None
+        try:
+            result = func(job)
+        finally:
+            if result is None or last:
+                on_done(job)
+        return result
+    return run
+
+def skip_lost(func, is_lost):
+    """ステージの関数を、リースを失ったジョブを処理せずに止める（Noneを返す）ようにする"""
+    def run(job):
+        if is_lost(job):
+            # 他のワーカーが処理している可能性があるため、ジョブストアも更新しない
+            logger.warning(f"中止: リースを失ったため、{job['pdf_path']} の処理を他のワーカーに任せます")
+            return None
+        return func(job)
+    return run
+
+def run_worker(args):
+    """
+    gps worker: 共有ワークキューからリースを取得した論文を処理する
+
+    処理中はリースを延長し、終わった論文はジョブストアの状態に従って完了または失敗を記録する。
+    停止した場合、処理を終えていない論文は処理待ちに戻す。
+    """
+    from . import workqueue
+    work_queue = workqueue.open_queue(args.queue)
+    keeper = workqueue.LeaseKeeper(work_queue, args.lease)
+    logger.info(f"ワーカー {keeper.worker} としてワークキューの論文を処理します: {args.queue}")
+
+    def on_done(job):
+        entry = get_job_store().get(job["pdf_path"])
+        if entry and entry["status"] == "success":
+            keeper.finish(job, "done")
+        else:
+            keeper.finish(job, "failed", (entry or {}).get("error") or "処理が完了しませんでした")
+
+    try:
+        run_pipeline(keeper.jobs(args.wait, args.poll_interval), args, on_done, keeper.is_lost)
+    finally:
+        keeper.close()
+        work_queue.close()
+
+def manage_queue(args):
+    """gps queue: ワークキューへの論文の登録、状態の表示、HTTPでの公開"""
+    from . import workqueue
+    if args.action == "serve":
+        work_queue = workqueue.WorkQueue(args.queue)
+        try:
+            workqueue.serve_queue(work_queue, args.host, args.port)
+        finally:
+            work_queue.close()
+        return
+    work_queue = workqueue.open_queue(args.queue)
+    try:
+        if args.action == "add":
+            # 他のマシンのワーカーからも同じパスで参照できるよう絶対パスで登録する
+            output_dir = Path(args.output_dir).resolve()
+            jobs = []
+            for path in args.paths:
+                path = Path(path).resolve()
+                if path.is_dir():
+                    jobs.extend(collect_jobs(path, output_dir))
+                elif path.is_file() and path.suffix.lower() == '.pdf':
+                    jobs.append({"pdf_path": str(path), "output_dir": str(output_dir / path.stem)})
+                else:
+                    logger.warning(f"無効なパスまたはファイル形式です: {path}")
+            added = work_queue.enqueue(jobs, args.retry_failed)
+            print(f"{added}件の論文を処理待ちにしました（指定された論文: {len(jobs)}件）")
+        counts = work_queue.counts()
+        print(", ".join(f"{status}: {counts.get(status, 0)}" for status in ("queued", "leased", "done", "failed")))
+        if args.action == "status":
+            for lease in work_queue.leases():
+                print(f"  処理中 {lease['path']} - {lease['worker']}（{lease['attempts']}回目, 期限まで {lease['expires_in']:.0f}秒）")
+            for failure in work_queue.failures():
+                print(f"  失敗 {failure['path']} - {failure['error']}")
+    finally:
+        work_queue.close()
+
+def dry_run(jobs, args):
+    """
+    --dry-run: 要約と翻訳を行わずに、マークダウンへの変換結果から料金を見積もる
+
+    変換済みのマークダウンがあれば再利用する。応答キャッシュにあるリクエストは料金に含めない。
+    --count-tokensを指定した場合は、入力トークン数をcount_tokens APIで数える（無料）。
+    """
+    from . import batch
+    from . import gemini
+    from . import ledger
+    model_name = get_model_name(args)
+    count_tokens = None
+    if args.count_tokens:
+        genai = configure_gemini()
+        def count_tokens(parts, system_instruction):
+            model = genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+            return model.count_tokens(parts).total_tokens
+    
+    totals = {"papers": 0, "requests": 0, "prompt_tokens": 0, "candidates_tokens": 0, "cost": 0.0}
+    for job in jobs:
+        pdf_path = job["pdf_path"]
+        stem = Path(pdf_path).stem
+        md_path = os.path.join(job["output_dir"], stem, f"{stem}.md")
+        if not os.path.exists(md_path):
+            from .create_md import create_md
+            _, md_path = create_md(pdf_path, job["output_dir"], args.page_window)
+        requests = batch.collect_requests(
+            [md_path], model_name, prompts.system_instruction, generation_config,
+            not args.nosummary, args.chunk_tokens, gemini.response_cache, get_translation_memory(args),
+        )
+        estimate = ledger.estimate(requests, model_name, count_tokens, batch=args.batch)
+        logger.info(
+            f"見積もり: {pdf_path}: リクエスト数 {estimate['requests']}, 入力 {estimate['prompt_tokens']}トークン, "
+            f"出力（見込み） {estimate['candidates_tokens']}トークン, 料金 {estimate['cost']:.2f}円"
+        )
+        totals["papers"] += 1
+        for k in ("requests", "prompt_tokens", "candidates_tokens", "cost"):
+            totals[k] += estimate[k]
+    
+    cost_logger.info(
+        f"見積もりの合計 - 論文数: {totals['papers']}, リクエスト数: {totals['requests']}, "
+        f"入力トークン数: {totals['prompt_tokens']}, 出力トークン数（見込み）: {totals['candidates_tokens']}, "
+        f"料金: {totals['cost']:.2f}円{'（バッチ料金）' if args.batch else ''}"
+    )
+    if args.budget and totals["cost"] > args.budget:
+        logger.warning(f"見積もり料金が予算（{args.budget}円）を超えています")
+    return totals
+
+def run_batch_pipeline(jobs, args):
+    """
+    --batch: PDFを全て変換してから要約と翻訳のリクエストをBatch APIでまとめて処理し、
+    応答キャッシュに保存された結果から生成・レンダリングする
+    """
+    from . import batch
+    from . import gemini
+    from . import ledger
+    # マークダウンへの変換
+    converted = []
+    Pipeline([
+        Stage("convert", lambda job: convert_stage(job, args), stage_workers(args, "convert")),
+        Stage("collect", converted.append),
+    ]).run(jobs)
+    
+    configure_gemini()
+    client = batch.BatchClient(get_api_key(), args.batch_base_url)
+    cache = gemini.response_cache
+    # 以前に投入して回収していないバッチがあれば先に回収する
+    
+    batch.collect_pending(client, cache, args.batch_dir, args.batch_poll_interval, args.batch_timeout,
+                          gemini.cost_ledger)
+    
+    # 論文ごとにリクエストを集め、--budgetを超える論文は投入しない
+    model_name = get_model_name(args)
+    requests = {}
+    scheduled = []
+    estimated = 0.0
+    for job in converted:
+        job_requests = [
+            r for r in batch.collect_requests(
+                [job["md_path"]], model_name, prompts.system_instruction,
+                generation_config, not args.nosummary, args.chunk_tokens, cache, get_translation_memory(args),
+            ) if r["key"] not in requests
+        ]
+        cost = ledger.estimate(job_requests, model_name, batch=True)["cost"]
+        if args.budget and gemini.cost_ledger.run_total + estimated + cost > args.budget:
+            logger.warning(f"予算の上限（{args.budget}円）を超える見込みのため、バッチに含めません: {job['pdf_path']}")
+            update_log(job["pdf_path"], "failed", "予算の上限に達しました")
+            continue
+        estimated += cost
+        requests.update((r["key"], r) for r in job_requests)
+        scheduled.append(job)
+    converted = scheduled
+    
+    if requests:
+        logger.info(f"バッチの見積もり料金: {estimated:.2f}円")
+        totals = batch.run_batch(
+            list(requests.values()), client, cache, model_name, args.batch_dir,
+            args.batch_poll_interval, args.batch_timeout, gemini.cost_ledger,
+        )
+        usage = totals["usage"]
+        input_cost, output_cost, total_cost = calculate_cost(
+            usage.get("prompt_token_count", 0), usage.get("candidates_token_count", 0), model_name, batch=True
+        )
+        # バッチの料金は通常の50%
+        cost_logger.info(f"バッチ処理の料金情報 - リクエスト数: {len(requests)}, 成功: {totals['succeeded']}, 失敗: {totals['failed']}")
+        cost_logger.info(f"入力トークン数: {usage.get('prompt_token_count', 0)}, 入力料金: {input_cost:.2f}円")
+        cost_logger.info(f"出力トークン数: {usage.get('candidates_token_count', 0)}, 出力料金: {output_cost:.2f}円")
+        cost_logger.info(f"合計料金: {total_cost:.2f}円")
+    else:
+        logger.info("全てのリクエストの応答が応答キャッシュにあるため、バッチを投入しません")
+    
+    # 要約・翻訳（応答キャッシュから）とレンダリング。失敗したリクエストのみ通常どおり送信される
+    Pipeline([
+        Stage("gemini", lambda job: generate_stage(job, args), stage_workers(args, "gemini")),
+        Stage("render", lambda job: render_stage(job, args), stage_workers(args, "render")),
+    ]).run(converted)
+
+def process_directory(input_dir, output_dir, args):
+    """ディレクトリ内のPDFファイルを再帰的に処理する"""
+    logger.info(f"ディレクトリ処理開始: {input_dir}")
+    run_pipeline(collect_jobs(input_dir, output_dir), args)
     logger.info(f"ディレクトリ処理完了: {input_dir}")
 
-parser = argparse.ArgumentParser(description='Summarize academic papers using Gemini API')
-parser.add_argument('paths', nargs='+', help='Path(s) to one or more PDF files or directories')
-parser.add_argument('-o', '--output-dir', default='./output', help='Output directory for summaries')
-parser.add_argument('-l', '--language', choices=['ja'], default='ja', help='Specify the output language')
-parser.add_argument('-m', '--model', default='gemini-2.5-flash-preview-04-17', help='Specify the Gemini model to use')
-parser.add_argument('--rpm', type=int, default=15, help='Maximum requests per minute (default: 15)')
-parser.add_argument('--version', action='version', version=f'{name} {__version__}')
-parser.add_argument('--suffix', help='Suffix to add to the output file name')
-parser.add_argument('--ccache', action='store_true', default=False, help='Enable context caching')
-parser.add_argument('--nosummary', action='store_true', default=False, help='Skip summary generation')
-parser.add_argument('--convert-pdf', action='store_true', default=True, help='Convert the generated markdown to PDF')
-args = parser.parse_args()
-
-# Gemini APIの設定
-load_dotenv()
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-
-model_name = args.model
-if not model_name.startswith("models/"):
-    model_name = "models/" + args.model
+def add_processing_arguments(parser):
+    """PDFの処理に関する共通のオプションを追加する"""
+    parser.add_argument('-o', '--output-dir', default='./output', help='Output directory for summaries')
+    parser.add_argument('-l', '--language', choices=['ja'], default='ja', help='Specify the output language')
+    parser.add_argument('-m', '--model', default='gemini-2.5-flash-preview-04-17', help='Specify the Gemini model to use')
+    parser.add_argument('--rpm', type=int, default=15, help='Maximum requests per minute (default: 15)')
+    parser.add_argument('--tpm', type=int, default=0, help='Maximum tokens per minute (default: 0, unlimited)')
+    parser.add_argument('--key-pool', metavar='PATH', help='JSON file listing several API keys with their own rpm/tpm/rpd limits; requests go to the key with the most headroom (default: GEMINI_API_KEY only)')
+    parser.add_argument('--suffix', help='Suffix to add to the output file name')
+    parser.add_argument('--page-window', type=int, default=40, help='Convert PDFs longer than this many pages in windows of this many pages to bound memory; 0 converts every PDF at once (default: 40)')
+    parser.add_argument('--chunk-tokens', type=int, default=4000, help='Maximum estimated tokens per translation chunk; 0 translates the whole file in one request (default: 4000)')
+    parser.add_argument('--chunk-concurrency', type=int, default=4, help='Maximum number of chunks translated concurrently per paper (default: 4)')
+    parser.add_argument('--response-cache', default=response_cache.DEFAULT_PATH, help=f'Path to the Gemini response cache (default: {response_cache.DEFAULT_PATH})')
+    parser.add_argument('--no-response-cache', action='store_true', default=False, help='Disable the Gemini response cache')
+    parser.add_argument('--response-cache-max-mb', type=int, default=1024, help='Maximum size of the response cache in MB (default: 1024)')
+    parser.add_argument('--response-cache-max-age', type=float, default=30, help='Maximum age of response cache entries in days (default: 30)')
+    parser.add_argument('--partial-dir', default=partial.DEFAULT_DIR, help=f'Directory for partially streamed responses used to resume interrupted requests (default: {partial.DEFAULT_DIR})')
+    parser.add_argument('--no-resume', action='store_true', default=False, help='Do not write partial responses or resume interrupted requests')
+    parser.add_argument('--batch', action='store_true', default=False, help='Submit all summary and translation requests as one Gemini Batch API job and wait for it')
+    parser.add_argument('--batch-dir', default='cache/batch', help='Directory for batch job files and pending batch records (default: cache/batch)')
+    parser.add_argument('--batch-poll-interval', type=float, default=30, help='Seconds between batch status checks (default: 30)')
+    parser.add_argument('--batch-timeout', type=float, default=None, help='Give up waiting for a batch after this many seconds (default: wait indefinitely)')
+    parser.add_argument('--batch-base-url', default='https://generativelanguage.googleapis.com', help=argparse.SUPPRESS)
+    parser.add_argument('--translation-memory', default='cache/translation_memory.sqlite', help='Translation memory of headings, references and recurring paragraphs reused across papers (default: cache/translation_memory.sqlite)')
+    parser.add_argument('--no-translation-memory', action='store_true', default=False, help='Do not fill chunks from or add translations to the translation memory')
+    parser.add_argument('--tm-fuzzy', type=float, default=0.0, help='Also match references whose similarity to a remembered one is at least this ratio, e.g. 0.9 (default: 0, exact matches only)')
+    parser.add_argument('--ccache', action='store_true', default=False, help='Enable context caching')
+    parser.add_argument('--ccache-ttl', type=int, default=600, help='TTL in seconds of context caches; extended while a paper is in progress (default: 600)')
+    parser.add_argument('--nosummary', action='store_true', default=False, help='Skip summary generation')
+    parser.add_argument('--convert-pdf', action='store_true', default=True, help='Convert the generated markdown to PDF')
+    parser.add_argument('--no-render-cache', action='store_true', default=False, help='Always re-render PDFs instead of reusing cached renders')
+    parser.add_argument('--no-tex-cache', action='store_true', default=False, help='Do not use the managed LuaLaTeX font/format cache')
+    parser.add_argument('--no-image-opt', action='store_true', default=False, help='Embed the original images instead of downsampled and recompressed copies')
+    parser.add_argument('--image-dpi', type=int, default=300, help='Resolution images are downsampled to for the two-column layout of the template (default: 300)')
+    parser.add_argument('--ledger', default='logs/cost_ledger.sqlite', help='Per-call cost ledger (default: logs/cost_ledger.sqlite)')
+    parser.add_argument('--ledger-jsonl', help='Also export the calls of this run from the cost ledger to this JSONL file')
+    parser.add_argument('--budget', type=float, default=None, help='Stop scheduling new papers once this run has spent this many yen')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='Convert PDFs and estimate tokens and cost without generating anything')
+    parser.add_argument('--count-tokens', action='store_true', default=False, help='With --dry-run, count input tokens with the count_tokens API instead of estimating locally')
+    parser.add_argument('--metrics', default=metrics.DEFAULT_PATH, help=f'Append per-stage spans and counters to this JSONL file; a Prometheus text file is written next to it (default: {metrics.DEFAULT_PATH})')
+    parser.add_argument('--no-metrics', action='store_true', default=False, help='Do not record metrics')
+    parser.add_argument('--workers', type=int, default=1, help='Number of workers per pipeline stage for directory runs (default: 1)')
+    parser.add_argument('--convert-workers', type=int, help='Number of PDF to markdown conversion workers (default: --workers)')
+    parser.add_argument('--gemini-workers', type=int, help='Number of summary/translation workers (default: --workers)')
+    parser.add_argument('--render-workers', type=int, help='Number of concurrent PDF renderings (pandoc/lualatex jobs) (default: --workers)')
+
+def parse_args(argv=None):
+    """コマンドライン引数を解析する（先頭が "sync" / "serve" / "worker" などの場合はそれぞれのモード）"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "sync":
+        parser = argparse.ArgumentParser(prog='gps sync', description='Process only new or changed PDFs in a directory')
+        parser.add_argument('input', help='Input directory to synchronize')
+        parser.add_argument('--manifest', default=sync.DEFAULT_PATH, help=f'Path to the sync manifest (default: {sync.DEFAULT_PATH})')
+        parser.add_argument('--prune', action='store_true', default=False, help='Remove outputs of PDFs deleted from the input directory')
+        add_processing_arguments(parser)
+        args = parser.parse_args(argv[1:])
+        args.command = "sync"
+        return args
+    if argv and argv[0] == "report":
+        parser = argparse.ArgumentParser(prog='gps report', description='Show p50/p95 stage latencies and throughput across runs')
+        parser.add_argument('--metrics', default=metrics.DEFAULT_PATH, help=f'Metrics JSONL file (default: {metrics.DEFAULT_PATH})')
+        parser.add_argument('--runs', type=int, default=None, help='Only include the last N runs (default: all)')
+        parser.add_argument('--format', choices=['text', 'json'], default='text', help='Output format (default: text)')
+        args = parser.parse_args(argv[1:])
+        args.command = "report"
+        return args
+    if argv and argv[0] == "tm":
+        parser = argparse.ArgumentParser(prog='gps tm', description='Build or correct the translation memory')
+        parser.add_argument('action', choices=['build', 'forget'], help='build: add translation.md / combined.md outputs found under the directories, forget: remove the given source segments')
+        parser.add_argument('items', nargs='+', help='Output directories to scan (build) or source headings, reference entries or paragraphs to remove (forget)')
+        parser.add_argument('--overwrite', action='store_true', default=False, help='Replace remembered translations with the ones found (build only)')
+        parser.add_argument('--translation-memory', default='cache/translation_memory.sqlite', help='Translation memory (default: cache/translation_memory.sqlite)')
+        args = parser.parse_args(argv[1:])
+        args.command = "tm"
+        return args
+    if argv and argv[0] == "queue":
+        from . import workqueue
+        parser = argparse.ArgumentParser(prog='gps queue', description='Manage the shared work queue used by "gps worker"')
+        parser.add_argument('action', choices=['add', 'status', 'serve'], help='add: enqueue PDFs or directories, status: show progress, serve: expose a SQLite queue over HTTP')
+        parser.add_argument('paths', nargs='*', help='PDF files or directories to enqueue (add only)')
+        parser.add_argument('--queue', default=workqueue.DEFAULT_PATH, help=f'SQLite queue on a shared filesystem, or http://HOST:PORT of "gps queue serve" (default: {workqueue.DEFAULT_PATH})')
+        parser.add_argument('-o', '--output-dir', default='./output', help='Output directory; must be reachable at the same path from every worker (default: ./output)')
+        parser.add_argument('--retry-failed', action='store_true', default=False, help='Queue failed PDFs again (add only)')
+        parser.add_argument('--host', default='127.0.0.1', help='Host to listen on (serve only, default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=workqueue.DEFAULT_PORT, help=f'Port to listen on (serve only, default: {workqueue.DEFAULT_PORT})')
+        args = parser.parse_args(argv[1:])
+        if args.action == "add" and not args.paths:
+            parser.error("add requires at least one PDF file or directory")
+        args.command = "queue"
+        return args
+    if argv and argv[0] == "worker":
+        from . import workqueue
+        parser = argparse.ArgumentParser(prog='gps worker', description='Process PDFs leased from a shared work queue; run one per machine')
+        parser.add_argument('--queue', default=workqueue.DEFAULT_PATH, help=f'SQLite queue on a shared filesystem, or http://HOST:PORT of "gps queue serve" (default: {workqueue.DEFAULT_PATH})')
+        parser.add_argument('--lease', type=float, default=workqueue.DEFAULT_LEASE, help=f'Lease duration in seconds; renewed every third of it while a PDF is in progress (default: {workqueue.DEFAULT_LEASE})')
+        parser.add_argument('--wait', action='store_true', default=False, help='Keep waiting for new PDFs after the queue is drained')
+        parser.add_argument('--poll-interval', type=float, default=workqueue.DEFAULT_POLL_INTERVAL, help=f'Seconds between queue checks while waiting (default: {workqueue.DEFAULT_POLL_INTERVAL})')
+        add_processing_arguments(parser)
+        args = parser.parse_args(argv[1:])
+        args.command = "worker"
+        return args
+    if argv and argv[0] == "serve":
+        parser = argparse.ArgumentParser(prog='gps serve', description='Keep models warm and process PDFs dropped into a watched folder')
+        parser.add_argument('--watch', required=True, help='Directory to watch for new PDFs')
+        parser.add_argument('--host', default='127.0.0.1', help='Host of the job submission endpoint (default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=8765, help='Port of the job submission endpoint; 0 disables it (default: 8765)')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='Polling interval in seconds when inotify is unavailable (default: 2.0)')
+        parser.add_argument('--force-polling', action='store_true', default=False, help='Poll the watched directory even if inotify is available')
+        add_processing_arguments(parser)
+        args = parser.parse_args(argv[1:])
+        args.command = "serve"
+        return args
+    parser = argparse.ArgumentParser(prog='gps', description='Summarize academic papers using Gemini API', epilog='Use "gps sync DIR" to process only new or changed PDFs, "gps serve --watch DIR" to run as a daemon, "gps report" to summarize stage timings, "gps tm build DIR" to build the translation memory from existing outputs, or "gps queue add DIR" and "gps worker" to share an archive across machines.')
+    parser.add_argument('paths', nargs='+', help='Path(s) to one or more PDF files or directories')
+    parser.add_argument('--version', action='version', version=f'{name} {__version__}')
+    add_processing_arguments(parser)
+    args = parser.parse_args(argv)
+    args.command = None
+    return args
 
 generation_config = {
     "temperature": 0.1,
@@ -315,27 +828,212 @@ generation_config = {
     "response_mime_type": "text/plain",
 }
 
-def main():
+# Gemini APIの設定（最初にGeminiを呼び出すときに一度だけ行う）
+gemini_configured = False
+gemini_lock = threading.Lock()
+
+def configure_gemini():
+    """Gemini APIを設定し、google.generativeaiモジュールを返す"""
+    global gemini_configured
+    import google.generativeai as genai
+    from dotenv import load_dotenv
+    with gemini_lock:
+        if not gemini_configured:
+            load_dotenv()
+            genai.configure(api_key=get_api_key())
+            gemini_configured = True
+    return genai
+
+def get_api_key():
+    """既定のAPIキー（キープールを使う場合はプールの最初のキー）を取得する"""
+    from . import gemini
+    if gemini.key_pool:
+        return gemini.key_pool.keys[0].api_key
+    return os.environ["GEMINI_API_KEY"]
+
+def get_model_name(args):
+    """APIで使用するモデル名（"models/"付き）を取得する"""
+    model_name = args.model
+    if not model_name.startswith("models/"):
+        model_name = "models/" + args.model
+    return model_name
+
+def release_loaded_models():
+    """markerのモデルが読み込まれている場合は解放する"""
+    if "gps.create_md" in sys.modules:
+        from .create_md import release_models
+        release_models()
+
+def finish_run(args):
+    """モデルとコンテキストキャッシュを解放し、料金の合計と計測結果を書き出す"""
+    from . import gemini
+    release_loaded_models()
+    close_context_caches()
+    close_translation_memory()
+    if gemini.key_pool is not None:
+        for key in gemini.key_pool.stats():
+            logger.info(
+                f"APIキー {key['name']} - リクエスト数: {key['requests']}（本日 {key['requests_today']}）, "
+                f"制限を受けた回数: {key['throttled']}, 待ち時間: {key['waited']:.1f}秒"
+                f"{', 1日の上限に到達' if key['exhausted'] else ''}"
+            )
+    if gemini.cost_ledger is not None:
+        totals = gemini.cost_ledger.totals(gemini.cost_ledger.run_id)
+        cost_logger.info(
+            f"この実行の料金 - 呼び出し数: {totals['calls']}, 入力トークン数: {totals['prompt_tokens']}"
+            f"（キャッシュ済み {totals['cached_tokens']}）, 出力トークン数: {totals['candidates_tokens']}, 合計料金: {totals['cost']:.2f}円"
+        )
+        if args.ledger_jsonl:
+            gemini.cost_ledger.export_jsonl(args.ledger_jsonl, gemini.cost_ledger.run_id)
+        gemini.cost_ledger.close()
+    if not args.no_metrics:
+        metrics.metrics.write_prometheus(os.path.splitext(args.metrics)[0] + ".prom")
+        metrics.metrics.close()
+    logger.info("処理を完了しました")
+
+def report(args):
+    """gps report: 計測結果からステージごとの所要時間とスループットを集計して表示する"""
+    records = metrics.load(args.metrics)
+    if not records:
+        print(f"計測結果がありません: {args.metrics}")
+        return
+    stage_summary, run_summary = metrics.summarize_runs(records, args.runs)
+    if args.format == "json":
+        import json
+        print(json.dumps({"stages": stage_summary, "runs": run_summary}, ensure_ascii=False, indent=2))
+    else:
+        print(metrics.format_report(stage_summary, run_summary))
+
+def build_translation_memory(args):
+    """gps tm build / forget: 完了した出力から翻訳メモリを作成する、または誤ったセグメントを削除する"""
+    from .translation_memory import TranslationMemory, build
+    memory = TranslationMemory(args.translation_memory)
+    try:
+        if args.action == "forget":
+            print(f"{memory.forget(args.items)}セグメントを削除しました")
+            return
+        papers, segments = build(memory, args.items, args.overwrite)
+        stats = memory.stats()
+    finally:
+        memory.close()
+    print(f"{papers}本の論文から{segments}セグメントを追加しました（合計 {stats['segments']}、訳文あり {stats['translated_segments']}）")
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "report":
+        report(args)
+        return
+    if args.command == "tm":
+        build_translation_memory(args)
+        return
+    if args.command == "queue":
+        setup_logging()
+        manage_queue(args)
+        return
+    
     # ロギングの設定
     setup_logging()
     
     logger.info("処理を開始します")
+    
+    # ステージごとの計測結果の記録先
+    if not args.no_metrics:
+        metrics.configure(args.metrics)
+    
+    # Geminiの応答キャッシュの設定（--batchでは結果の受け渡しに使用するため必須）
+    if args.batch and args.no_response_cache:
+        logger.error("--batch は --no-response-cache と同時に指定できません")
+        sys.exit(2)
+    if not args.no_response_cache:
+        from . import gemini
+        gemini.configure_response_cache(response_cache.ResponseCache(
+            args.response_cache,
+            max_bytes=args.response_cache_max_mb * 1024 * 1024,
+            max_age_days=args.response_cache_max_age,
+        ))
+    # 呼び出しごとの料金台帳（--budgetの判定にも使う）
+    if not args.dry_run:
+        from . import gemini
+        from .ledger import Ledger
+        gemini.configure_ledger(Ledger(args.ledger, metrics.metrics.run_id))
+    # 複数のAPIキーへの振り分け
+    if args.key_pool:
+        from dotenv import load_dotenv
+        from . import gemini
+        from .keypool import KeyPool
+        load_dotenv()
+        pool = KeyPool.load(args.key_pool, args.rpm, args.tpm)
+        gemini.configure_key_pool(pool)
+        # markerのLLMモードはプールの最初のキーを使う
+        os.environ.setdefault("GEMINI_API_KEY", pool.keys[0].api_key)
+        logger.info(f"キープール: {', '.join(key.name for key in pool.keys)}")
+    # 中断したリクエストを再開するための途中経過の保存先
+    if not args.no_resume:
+        from . import gemini
+        gemini.configure_partial_dir(args.partial_dir)
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    for path in args.paths:
-        path = Path(path)
-        if path.is_dir():
-            process_directory(path, output_dir, args)
-        elif path.is_file() and path.suffix.lower() == '.pdf':
-            relative_path = path.relative_to(path.parent)
-            output_path = output_dir / relative_path.parent / path.stem
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-            process_pdf_file(str(path), str(output_path), args)
-        else:
-            logger.warning(f"無効なパスまたはファイル形式です: {path}")
+    if args.dry_run and args.command:
+        logger.error(f"--dry-run は {args.command} では使用できません")
+        sys.exit(2)
     
-    logger.info("処理を完了しました")
+    if args.command == "sync":
+        process_jobs = run_batch_pipeline if args.batch else run_pipeline
+        sync.sync_directory(
+            args.input, output_dir, lambda jobs: process_jobs(jobs, args), get_job_store(),
+            args.manifest, args.prune,
+        )
+        finish_run(args)
+        return
+    
+    if args.command == "worker":
+        if args.batch:
+            logger.error("--batch は worker では使用できません")
+            sys.exit(2)
+        run_worker(args)
+        finish_run(args)
+        return
+    
+    if args.command == "serve":
+        if args.batch:
+            logger.error("--batch は serve では使用できません")
+            sys.exit(2)
+        # モデルを先に読み込み、停止するまで読み込んだままにする
+        from . import serve
+        from .create_md import get_converter
+        get_converter()
+        serve.serve(
+            args.watch, output_dir, lambda jobs: run_pipeline(jobs, args, jobs.done), get_job_store(),
+            args.host, args.port, args.poll_interval, args.force_polling,
+        )
+        finish_run(args)
+        return
+    
+    def iter_jobs():
+        for path in args.paths:
+            path = Path(path)
+            if path.is_dir():
+                logger.info(f"ディレクトリ処理開始: {path}")
+                yield from collect_jobs(path, output_dir)
+            elif path.is_file() and path.suffix.lower() == '.pdf':
+                relative_path = path.relative_to(path.parent)
+                output_path = output_dir / relative_path.parent / path.stem
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                yield {"pdf_path": str(path), "output_dir": str(output_path)}
+            else:
+                logger.warning(f"無効なパスまたはファイル形式です: {path}")
+    
+    # 全ての入力をひとつのパイプラインで処理する
+    if args.dry_run:
+        dry_run(iter_jobs(), args)
+    elif args.batch:
+        run_batch_pipeline(iter_jobs(), args)
+    else:
+        run_pipeline(iter_jobs(), args)
+    
+    # 読み込んだmarkerのモデルを解放し、計測結果を書き出す
+    finish_run(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,285 @@
+"""
+Gemini Batch APIで要約と翻訳のリクエストをまとめて処理する（--batch）
+
+多数の論文の要約・翻訳（チャンク）のリクエストをJSONLのバッチジョブファイルにまとめて投入し、
+完了するまでポーリングする。結果は通常のリクエストと同じキーで応答キャッシュに保存するため、
+その後の通常の処理（summary.md / translation.md / combined.mdの作成とレンダリング）は
+すべてキャッシュから行われ、RPMの制限による待ち時間もかからない。
+
+REST APIを標準ライブラリで直接呼び出すため、base_urlを変えるとローカルの
+フェイクサーバー（gps.fakes.FakeBatchServer）に対して動作を確認できる。
+"""
+
+import glob
+import json
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+
+from . import chunking
+from . import prompts
+from . import response_cache
+from . import translation_memory
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = "cache/batch"
+DEFAULT_BASE_URL = "https://generativelanguage.googleapis.com"
+# 完了したバッチの状態
+SUCCEEDED = "BATCH_STATE_SUCCEEDED"
+TERMINAL_STATES = {SUCCEEDED, "BATCH_STATE_FAILED", "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED"}
+
+
+class BatchError(Exception):
+    """バッチの投入・取得に失敗した"""
+
+
+def to_camel(name):
+    head, *rest = name.split("_")
+    return head + "".join(word.capitalize() for word in rest)
+
+
+def to_snake(name):
+    return "".join(f"_{c.lower()}" if c.isupper() else c for c in name)
+
+
+def make_request(parts, system_instruction, generation_config):
+    """GenerateContentRequest（JSON）を作成する"""
+    return {
+        "contents": [{"role": "user", "parts": [{"text": part} for part in parts]}],
+        "systemInstruction": {"parts": [{"text": system_instruction}]},
+        "generationConfig": {to_camel(k): v for k, v in generation_config.items()},
+    }
+
+
+def collect_requests(md_paths, model_name, system_instruction, generation_config,
+                     summary=True, chunk_tokens=0, cache=None, memory=None):
+    """
+    マークダウンごとに、通常の処理と同じ内容・同じキャッシュキーのリクエストを作成する
+
+    応答キャッシュに既にある（またはキーが重複する）リクエストは含めない。
+
+    Args:
+        md_paths (list[str]): マークダウンファイルのパス
+        model_name (str): モデル名
+        system_instruction (str): システムインストラクション
+        generation_config (dict): 生成時の設定
+        summary (bool): 要約のリクエストを含めるかどうか
+        chunk_tokens (int): チャンク翻訳のトークン数の上限（0の場合はファイル全体を翻訳）
+        cache (ResponseCache, optional): 応答キャッシュ
+        memory (TranslationMemory, optional): チャンク翻訳に適用する翻訳メモリ
+
+    Returns:
+        list[dict]: {"key": キャッシュキー, "kind": 種類, "request": リクエスト} のリスト
+    """
+    requests = []
+    seen = set()
+    params = (system_instruction, generation_config)
+
+    def add(kind, input_text, prompt, parts):
+        key = response_cache.make_key(input_text, prompt, model_name, *params)
+        if key in seen or (cache and cache.get(key)):
+            return
+        seen.add(key)
+        requests.append({"key": key, "kind": kind, "request": make_request(parts, *params)})
+
+    for md_path in md_paths:
+        with open(md_path, "r", encoding="utf-8") as f:
+            markdown = f.read()
+        if summary:
+            add("summary", markdown, prompts.summary_prompt, [markdown, prompts.summary_prompt])
+        if chunk_tokens:
+            chunks = chunking.split_markdown(markdown, chunk_tokens)
+            for chunk, heading in zip(chunks, translation_memory.section_headings(chunks)):
+                text, prompt, fills = translation_memory.prepare_chunk(memory, chunk, heading)
+                # 全てのセグメントが翻訳メモリにあるチャンクは送信しない
+                if not fills or translation_memory.needs_request(text):
+                    add("chunk", text, prompt, [prompt, text])
+        else:
+            add("translation", markdown, prompts.single_prompt, [markdown, prompts.single_prompt])
+    return requests
+
+
+def parse_results(data):
+    """
+    結果ファイル（JSONL）を解析する
+
+    Returns:
+        iterator: (キー, 応答テキスト, 統計情報, エラー) のイテレータ
+    """
+    for line in data.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        key = entry.get("key")
+        if "error" in entry or "response" not in entry:
+            yield key, None, {}, entry.get("error", "no response")
+            continue
+        response = entry["response"]
+        candidates = response.get("candidates") or []
+        parts = candidates[0].get("content", {}).get("parts", []) if candidates else []
+        text = "".join(p.get("text", "") for p in parts if not p.get("thought"))
+        usage = {to_snake(k): v for k, v in response.get("usageMetadata", {}).items() if isinstance(v, int)}
+        if not text:
+            yield key, None, usage, f"empty response (finishReason: {candidates[0].get('finishReason') if candidates else None})"
+        else:
+            yield key, text, usage, None
+
+
+class BatchClient:
+    """Gemini Batch API（REST）のクライアント"""
+
+    def __init__(self, api_key, base_url=DEFAULT_BASE_URL, timeout=300):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method, url, data=None, headers=None):
+        headers = {"x-goog-api-key": self.api_key, **(headers or {})}
+        request = urllib.request.Request(url, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            raise BatchError(f"{method} {url}: {e.code} {e.read().decode('utf-8', errors='replace')}") from e
+
+    def _json(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        _, content = self._request(method, f"{self.base_url}{path}", data, {"Content-Type": "application/json"})
+        return json.loads(content or b"{}")
+
+    def upload(self, path, display_name):
+        """バッチジョブファイルをアップロードし、ファイル名（files/...）を返す"""
+        with open(path, "rb") as f:
+            data = f.read()
+        headers, _ = self._request(
+            "POST", f"{self.base_url}/upload/v1beta/files",
+            json.dumps({"file": {"display_name": display_name}}).encode("utf-8"),
+            {
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(len(data)),
+                "X-Goog-Upload-Header-Content-Type": "application/jsonl",
+                "Content-Type": "application/json",
+            },
+        )
+        upload_url = headers.get("x-goog-upload-url")
+        if not upload_url:
+            raise BatchError("アップロード先のURLが返されませんでした")
+        _, content = self._request(
+            "POST", upload_url, data,
+            {"X-Goog-Upload-Offset": "0", "X-Goog-Upload-Command": "upload, finalize"},
+        )
+        return json.loads(content)["file"]["name"]
+
+    def create(self, model_name, file_name, display_name):
+        """バッチを作成し、バッチ名（batches/...）を返す"""
+        if not model_name.startswith("models/"):
+            model_name = "models/" + model_name
+        body = {"batch": {"display_name": display_name, "input_config": {"file_name": file_name}}}
+        return self._json("POST", f"/v1beta/{model_name}:batchGenerateContent", body)["name"]
+
+    def get(self, batch_name):
+        """バッチの状態を取得する"""
+        return self._json("GET", f"/v1beta/{batch_name}")
+
+    def download(self, file_name):
+        """結果ファイルの内容を取得する"""
+        _, content = self._request("GET", f"{self.base_url}/download/v1beta/{file_name}:download?alt=media")
+        return content
+
+
+def wait(client, batch_name, poll_interval=30.0, timeout=None):
+    """バッチが完了するまでポーリングし、最後の状態を返す"""
+    start = time.monotonic()
+    last_state = None
+    while True:
+        batch = client.get(batch_name)
+        state = batch.get("metadata", {}).get("state")
+        if state != last_state:
+            logger.info(f"バッチの状態: {batch_name}: {state}")
+            last_state = state
+        if state in TERMINAL_STATES:
+            return batch
+        if timeout and time.monotonic() - start > timeout:
+            raise BatchError(f"バッチが{timeout}秒以内に完了しませんでした: {batch_name}")
+        time.sleep(poll_interval)
+
+
+def store_results(client, batch, cache, ledger=None, model_name=None):
+    """
+    完了したバッチの結果を応答キャッシュに保存する（ledgerを指定した場合は料金台帳にも記録する）
+
+    Returns:
+        dict: 件数と合計の統計情報
+    """
+    totals = {"succeeded": 0, "failed": 0, "usage": {}}
+    state = batch.get("metadata", {}).get("state")
+    if state != SUCCEEDED:
+        logger.error(f"バッチが完了しませんでした: {batch.get('name')}: {state}")
+        return totals
+    responses_file = batch.get("response", {}).get("responsesFile")
+    if not responses_file:
+        raise BatchError(f"結果ファイルがありません: {batch.get('name')}")
+    for key, text, usage, error in parse_results(client.download(responses_file)):
+        for k, v in usage.items():
+            totals["usage"][k] = totals["usage"].get(k, 0) + v
+        if ledger and usage:
+            ledger.record(model_name, usage, kind="batch", batch=True)
+        if error:
+            totals["failed"] += 1
+            logger.warning(f"バッチのリクエストが失敗しました（通常のリクエストで再試行します）: {key}: {error}")
+            continue
+        # 通常のリクエストと同じ形式で保存する（gemini.finish_content）
+        cache.put(key, text.rstrip() + "\n", usage)
+        totals["succeeded"] += 1
+    return totals
+
+
+def run_batch(requests, client, cache, model_name, batch_dir=DEFAULT_DIR, poll_interval=30.0, timeout=None,
+              ledger=None):
+    """
+    リクエストをバッチジョブファイルに書き出して投入し、完了を待って結果を応答キャッシュに保存する
+
+    投入したバッチは batch_dir に記録し、完了を待つ前にプロセスが終了しても
+    次回の collect_pending で結果を回収できるようにする。
+
+    Returns:
+        dict: 件数と合計の統計情報
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    display_name = f"gps-{time.strftime('%Y%m%d-%H%M%S')}"
+    input_path = os.path.join(batch_dir, f"{display_name}.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps({"key": request["key"], "request": request["request"]}, ensure_ascii=False) + "\n")
+    logger.info(f"{len(requests)}件のリクエストをバッチジョブファイルに書き出しました: {input_path}")
+
+    file_name = client.upload(input_path, display_name)
+    batch_name = client.create(model_name, file_name, display_name)
+    state_path = os.path.join(batch_dir, f"{display_name}.json")
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump({"name": batch_name, "model": model_name, "requests": len(requests), "input": input_path}, f)
+    logger.info(f"バッチを投入しました: {batch_name}")
+
+    batch = wait(client, batch_name, poll_interval, timeout)
+    totals = store_results(client, batch, cache, ledger, model_name)
+    os.remove(state_path)
+    os.remove(input_path)
+    return totals
+
+
+def collect_pending(client, cache, batch_dir=DEFAULT_DIR, poll_interval=30.0, timeout=None, ledger=None):
+    """以前に投入して結果を回収していないバッチの完了を待ち、結果を応答キャッシュに保存する"""
+    for state_path in sorted(glob.glob(os.path.join(batch_dir, "*.json"))):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        logger.info(f"以前に投入したバッチの結果を回収します: {state['name']}")
+        batch = wait(client, state["name"], poll_interval, timeout)
+        totals = store_results(client, batch, cache, ledger, state.get("model"))
+        logger.info(f"回収しました: 成功 {totals['succeeded']}件, 失敗 {totals['failed']}件")
+        os.remove(state_path)
+        if os.path.exists(state.get("input", "")):
+            os.remove(state["input"])
@@ -0,0 +1,118 @@
+"""
+マークダウンを見出しと段落の境界で、トークン数の上限付きチャンクに分割する
+"""
+
+import re
+
+# 画像の参照（convert_image_paths_to_absoluteと同じ形式）
+IMAGE_PATTERN = re.compile(r'!\[(.*?)\]\((.*?)\)')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を概算する
+
+    ASCII文字は約4文字で1トークン、それ以外（日本語など）は1文字1トークンとして数える。
+    """
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def split_blocks(markdown: str) -> list[str]:
+    """マークダウンを空行区切りのブロックに分割する（コードブロックの内部は分割しない）"""
+    blocks = []
+    current = []
+    in_fence = False
+    for line in markdown.splitlines():
+        if line.lstrip().startswith("```"):
+            in_fence = not in_fence
+        if not line.strip() and not in_fence:
+            if current:
+                blocks.append("\n".join(current))
+                current = []
+            continue
+        current.append(line)
+    if current:
+        blocks.append("\n".join(current))
+    return blocks
+
+
+def split_sections(blocks: list[str]) -> list[list[str]]:
+    """ブロックを見出しごとのセクションにまとめる"""
+    sections = []
+    for block in blocks:
+        if block.startswith("#") or not sections:
+            sections.append([block])
+        else:
+            sections[-1].append(block)
+    return sections
+
+
+def split_markdown(markdown: str, max_tokens: int) -> list[str]:
+    """
+    マークダウンを見出しと段落の境界でチャンクに分割する
+
+    セクションはできるだけまとめて1チャンクに入れ、上限を超えるセクションのみ段落単位で分割する。
+    1段落（表やコードブロックを含む）が上限を超える場合は、その段落だけで1チャンクとする。
+
+    Args:
+        markdown (str): 分割するマークダウン
+        max_tokens (int): 1チャンクあたりの最大トークン数（概算）
+
+    Returns:
+        list[str]: 元の順序のチャンクのリスト
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_tokens = 0
+
+    for section in split_sections(split_blocks(markdown)):
+        section_tokens = sum(estimate_tokens(b) for b in section)
+        if current_tokens + section_tokens <= max_tokens:
+            current.extend(section)
+            current_tokens += section_tokens
+            continue
+        # セクションの途中で切らないよう、現在のチャンクを確定させる
+        flush()
+        for block in section:
+            block_tokens = estimate_tokens(block)
+            if current and current_tokens + block_tokens > max_tokens:
+                flush()
+            current.append(block)
+            current_tokens += block_tokens
+    flush()
+    return chunks
+
+
+def image_refs(text: str) -> list[str]:
+    """テキスト中の画像の参照先を取得する"""
+    return [m.group(2) for m in IMAGE_PATTERN.finditer(text)]
+
+
+def table_rows(text: str) -> int:
+    """テキスト中の表の行数を数える"""
+    return sum(1 for line in text.splitlines() if line.lstrip().startswith("|"))
+
+
+def check_chunk(source: str, translated: str) -> list[str]:
+    """
+    翻訳結果で画像の参照と表が保持されているか確認する
+
+    Returns:
+        list[str]: 問題点の説明のリスト（問題がなければ空）
+    """
+    problems = []
+    translated_images = set(image_refs(translated))
+    missing = [ref for ref in image_refs(source) if ref not in translated_images]
+    if missing:
+        problems.append(f"画像の参照が失われています: {', '.join(missing)}")
+    if table_rows(source) != table_rows(translated):
+        problems.append(f"表の行数が一致しません: {table_rows(source)} -> {table_rows(translated)}")
+    return problems
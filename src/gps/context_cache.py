@@ -0,0 +1,178 @@
+"""
+Geminiのコンテキストキャッシュ（CachedContent）を論文ごとに管理する（--ccache）
+
+同じ論文（内容・モデル・システムインストラクションが同じ）に対する要約、翻訳、
+続きの取得のリクエストは1つのキャッシュを共有する。使用中のキャッシュは
+バックグラウンドでTTLを延長し、最後の利用者が解放したときに削除する。
+モデルの最小キャッシュサイズに満たない文書はキャッシュしない（キャッシュせずに送信する方が安い）。
+キープールを使う場合、キャッシュは作成したキー（プロジェクト）でのみ共有する。
+"""
+
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+
+from . import keypool
+from .chunking import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# モデルごとのキャッシュできる最小トークン数（前方一致、該当しない場合はDEFAULT_MIN_TOKENS）
+MIN_CACHE_TOKENS = {
+    "gemini-2.5-flash": 1024,
+    "gemini-2.5-pro": 4096,
+    "gemini-1.5": 32768,
+}
+DEFAULT_MIN_TOKENS = 4096
+# キャッシュの有効期限と、使用中に延長する間隔（秒）
+DEFAULT_TTL = 600
+DEFAULT_REFRESH_INTERVAL = 240
+
+
+def min_cache_tokens(model_name) -> int:
+    """モデルのキャッシュできる最小トークン数を取得する"""
+    if model_name.startswith("models/"):
+        model_name = model_name[len("models/"):]
+    for prefix, tokens in MIN_CACHE_TOKENS.items():
+        if model_name.startswith(prefix):
+            return tokens
+    return DEFAULT_MIN_TOKENS
+
+
+class ContextCacheManager:
+    """論文ごとのコンテキストキャッシュを参照カウントで共有するマネージャ"""
+
+    def __init__(self, ttl=DEFAULT_TTL, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # キー -> {"cache": CachedContent, "refs": 利用者数, "ready": 作成の完了, "api_key": 作成したAPIキー}
+        self._entries = {}
+        self._stop = threading.Event()
+        self._refresher = None
+        self.stats = {"created": 0, "reused": 0, "skipped": 0}
+
+    @staticmethod
+    def make_key(text, model_name, system_instruction, api_key_name=""):
+        if model_name.startswith("models/"):
+            model_name = model_name[len("models/"):]
+        return hashlib.sha256(f"{api_key_name}\0{model_name}\0{system_instruction}\0{text}".encode("utf-8")).hexdigest()
+
+    def acquire(self, model_name, system_instruction, file, text):
+        """
+        文書のキャッシュを取得する（ない場合は作成する）
+
+        Args:
+            model_name (str): モデル名
+            system_instruction (str): システムインストラクション
+            file: アップロード済みのファイル
+            text (str): ファイルの内容（キーと最小サイズの判定に使用）
+
+        Returns:
+            tuple: (キー, CachedContent)。キャッシュしない場合は (None, None)
+        """
+        import google.generativeai as genai
+        from google.api_core import exceptions
+
+        tokens = estimate_tokens(system_instruction + text)
+        minimum = min_cache_tokens(model_name)
+        if tokens < minimum:
+            logger.info(f"文書が最小キャッシュサイズ（{minimum}トークン）未満のため、キャッシュしません（推定{tokens}トークン）")
+            with self._lock:
+                self.stats["skipped"] += 1
+            return None, None
+
+        api_key = keypool.current_key.get()
+        key = self.make_key(text, model_name, system_instruction, api_key.name if api_key else "")
+        creating = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                entry["refs"] += 1
+                self.stats["reused"] += 1
+            else:
+                entry = self._entries[key] = {"cache": None, "refs": 1, "ready": threading.Event(), "api_key": api_key}
+                creating = True
+        if not creating:
+            # 同じ文書のキャッシュを他の利用者が作成中の場合は完了を待つ
+            entry["ready"].wait()
+            return (key, entry["cache"]) if entry["cache"] else (None, None)
+
+        try:
+            print("Caching file...")
+            entry["cache"] = genai.caching.CachedContent.create(
+                model=model_name,
+                system_instruction=system_instruction,
+                contents=[file],
+                ttl=timedelta(seconds=self.ttl),
+            )
+            with self._lock:
+                self.stats["created"] += 1
+        except exceptions.InvalidArgument as e:
+            # 推定より実際のトークン数が少なく、最小サイズに満たなかった場合など
+            logger.info(f"コンテキストキャッシュを作成できないため、キャッシュせずに送信します: {e}")
+            with self._lock:
+                del self._entries[key]
+                self.stats["skipped"] += 1
+            return None, None
+        except Exception:
+            with self._lock:
+                del self._entries[key]
+            raise
+        finally:
+            entry["ready"].set()
+        self._start_refresher()
+        return key, entry["cache"]
+
+    def release(self, key):
+        """キャッシュの利用を終える。利用者がいなくなった場合は削除する"""
+        if key is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return
+            entry["refs"] -= 1
+            if entry["refs"] > 0:
+                return
+            del self._entries[key]
+        try:
+            with keypool.using(entry["api_key"]):
+                entry["cache"].delete()
+            print("Deleted cache")
+        except Exception as e:
+            logger.warning(f"コンテキストキャッシュの削除に失敗しました: {e}")
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh, name="gps-ccache-ttl", daemon=True)
+                self._refresher.start()
+
+    def _refresh(self):
+        """使用中のキャッシュのTTLを定期的に延長する"""
+        while not self._stop.wait(self.refresh_interval):
+            with self._lock:
+                caches = [(entry["cache"], entry["api_key"]) for entry in self._entries.values() if entry["cache"]]
+            for cache, api_key in caches:
+                try:
+                    with keypool.using(api_key):
+                        cache.update(ttl=timedelta(seconds=self.ttl))
+                    logger.debug(f"コンテキストキャッシュの有効期限を延長しました: {cache.name}")
+                except Exception as e:
+                    logger.warning(f"コンテキストキャッシュの有効期限の延長に失敗しました: {e}")
+
+    def close(self):
+        """TTLの延長を止め、残っているキャッシュを削除する"""
+        self._stop.set()
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry["cache"]:
+                try:
+                    with keypool.using(entry["api_key"]):
+                        entry["cache"].delete()
+                except Exception as e:
+                    logger.warning(f"コンテキストキャッシュの削除に失敗しました: {e}")
@@ -1,26 +1,181 @@
-from marker.converters.pdf import PdfConverter
-from marker.models import create_model_dict
-from marker.output import text_from_rendered
-from marker.output import save_output
 import os
+import json
 from pathlib import Path
 from dotenv import load_dotenv
+import gc
+import threading
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    from marker.converters.pdf import PdfConverter
 
+# プロセス内で共有するmarkerのモデルとコンバータ
+# （モデルの読み込みは数十秒かかるため、最初のPDFで一度だけ読み込む）
+_artifact_dict = None
+_converter = None
+_converter_lock = threading.Lock()
 
-def create_md(filepath: str, output_dir: str = None) -> tuple[str, str]:
+# ページ範囲ごとに変換する場合の1回あたりのページ数
+DEFAULT_PAGE_WINDOW = 40
+
+
+def get_artifact_dict():
+    """markerのモデル（artifact_dict）を取得する。未読み込みの場合は読み込む"""
+    global _artifact_dict
+    with _converter_lock:
+        if _artifact_dict is None:
+            # markerの読み込みは重いため、必要になるまでインポートしない
+            from marker.models import create_model_dict
+            _artifact_dict = create_model_dict()
+        return _artifact_dict
+
+
+def get_converter() -> "PdfConverter":
+    """
+    プロセス内で共有するPdfConverterを取得する
+    
+    初回呼び出し時にモデルを読み込み、以降は同じコンバータを再利用する。
+    
+    Returns:
+        PdfConverter: 共有のPDFコンバータ
+    """
+    global _converter
+    artifact_dict = get_artifact_dict()
+    with _converter_lock:
+        if _converter is None:
+            _converter = make_converter(artifact_dict)
+        return _converter
+
+
+def make_converter(artifact_dict, page_range=None) -> "PdfConverter":
+    """
+    PdfConverterを作成する（モデルはartifact_dictを共有する）
+    
+    Args:
+        artifact_dict (dict): markerのモデル
+        page_range (list[int], optional): 変換するページ（0始まり）。指定しない場合は全ページ
+    """
+    from marker.converters.pdf import PdfConverter
+    load_dotenv()
+    config = {"use_llm": True, "gemini_api_key": os.getenv("GEMINI_API_KEY")}
+    if page_range is not None:
+        config["page_range"] = page_range
+    return PdfConverter(artifact_dict=artifact_dict, config=config)
+
+
+def release_models():
+    """読み込んだmarkerのモデルとコンバータを解放する"""
+    global _artifact_dict, _converter
+    with _converter_lock:
+        _converter = None
+        _artifact_dict = None
+    release_memory()
+
+
+def count_pages(filepath: str) -> int:
+    """PDFのページ数を取得する（ページの内容は読み込まない）"""
+    import pypdfium2
+    pdf = pypdfium2.PdfDocument(filepath)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def release_memory():
+    """変換で使ったメモリ（GPUのキャッシュを含む）を解放する"""
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+def iter_page_windows(filepath: str, page_window: int = DEFAULT_PAGE_WINDOW):
+    """
+    PDFをpage_windowページずつ変換し、ページ範囲ごとの結果を順に返す
+    
+    同時に保持するのは1つのページ範囲の変換結果だけなので、メモリの使用量は
+    文書の長さによらない。markerはページ範囲を指定しても元のページ番号で
+    ブロックに名前を付けるため、画像の名前（_page_N_Picture_M）は全体を
+    一度に変換した場合と同じになる。
+    
+    Yields:
+        tuple[range, str, dict, dict]: (ページ範囲, マークダウン, 画像, メタデータ)
+    """
+    from marker.output import text_from_rendered
+    
+    pages = count_pages(filepath)
+    artifact_dict = get_artifact_dict()
+    for start in range(0, pages, page_window):
+        window = range(start, min(start + page_window, pages))
+        print(f"Converting pages {window.start + 1}-{window.stop} of {pages}: {filepath}")
+        rendered = make_converter(artifact_dict, list(window))(filepath)
+        text, _, images = text_from_rendered(rendered)
+        metadata = rendered.metadata
+        del rendered
+        yield window, text, images, metadata
+        del images
+        release_memory()
+
+
+def save_images(images: dict, output_dir: str):
+    """画像を保存する（marker.output.save_outputと同じ形式）"""
+    from marker.settings import settings
+    for name, image in images.items():
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(os.path.join(output_dir, name), settings.OUTPUT_IMAGE_FORMAT)
+
+
+def create_md_windowed(filepath: str, output_dir: str, pdf_name: str, page_window: int) -> tuple[str, str]:
+    """
+    PDFをページ範囲ごとに変換し、マークダウンと画像を順に書き出す
+    
+    マークダウンは変換が終わるまで一時ファイルに追記し、最後に置き換える
+    （途中で失敗した場合に、不完全なマークダウンが変換済みとして残らないようにする）。
+    """
+    md_path = os.path.join(output_dir, f"{pdf_name}.md")
+    tmp_path = f"{md_path}.part"
+    metadata = {}
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for window, text, images, window_metadata in iter_page_windows(filepath, page_window):
+            if window.start:
+                f.write("\n\n")
+            f.write(text.strip())
+            f.flush()
+            save_images(images, output_dir)
+            # ページごとの情報（目次、ページの統計）は連結する
+            for k, v in window_metadata.items():
+                if isinstance(v, list):
+                    metadata.setdefault(k, []).extend(v)
+                else:
+                    metadata.setdefault(k, v)
+        f.write("\n")
+    with open(os.path.join(output_dir, f"{pdf_name}_meta.json"), "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(tmp_path, md_path)
+    with open(md_path, "r", encoding="utf-8") as f:
+        return f.read(), md_path
+
+
+def create_md(filepath: str, output_dir: str = None, page_window: int = DEFAULT_PAGE_WINDOW) -> tuple[str, str]:
     """
     PDFファイルを処理してマークダウンに変換する関数
     
     Args:
         filepath (str): 処理するPDFファイルのパス
         output_dir (str, optional): 出力先ディレクトリ。指定されない場合はPDFと同じ場所に作成
+        page_window (int): ページ数がこれを超えるPDFは、このページ数ずつ変換する（0の場合は常に全体を一度に変換）
         
     Returns:
         tuple[str, str]: 生成されたマークダウンの内容とマークダウンファイルの保存パス
     """
-    load_dotenv()
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
+    from marker.output import text_from_rendered
+    from marker.output import save_output
+    
     # PDFファイル名を取得（拡張子なし）
     pdf_name = Path(filepath).stem
     
@@ -33,11 +188,12 @@ def create_md(filepath: str, output_dir: str = None) -> tuple[str, str]:
     # 出力ディレクトリが存在しない場合は作成
     os.makedirs(output_dir, exist_ok=True)
     
-    # PDFを変換
-    converter = PdfConverter(
-        artifact_dict=create_model_dict(),
-        config={"use_llm": True, "gemini_api_key": gemini_api_key}
-    )
+    # 長い文書はページ範囲ごとに変換して、メモリの使用量を抑える
+    if page_window and count_pages(filepath) > page_window:
+        return create_md_windowed(filepath, output_dir, pdf_name, page_window)
+    
+    # PDFを変換（モデルはプロセス内で共有）
+    converter = get_converter()
     rendered = converter(filepath)
     
     # 結果を保存
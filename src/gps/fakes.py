@@ -0,0 +1,405 @@
+"""
+Local stand-ins for the Gemini API, marker and the PDF renderer used to exercise
+the client, rate limiter, retry logic and the whole pipeline without network
+access, models or cost.
+"""
+
+import asyncio, hashlib, json, os, random, threading, time, types
+from pathlib import Path
+from google.api_core import exceptions
+
+
+class FakeChunk:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage = usage
+
+    def to_dict(self):
+        if self.usage is None:
+            return {}
+        return {"usage_metadata": dict(self.usage)}
+
+
+class FakeGenerativeModel:
+    """Mimics ``genai.GenerativeModel`` streaming responses.
+
+    Args:
+        response: text returned for every request, or a callable that
+            receives the request contents and returns the text
+        latency: seconds before the first chunk arrives
+        chunk_latency: seconds between subsequent chunks
+        chunk_size: characters per streamed chunk
+        fail_first: number of initial requests answered with a 429
+        fail_rate: probability of answering any other request with a 429
+        fail_midstream: number of initial streamed responses that drop the
+            connection (503) halfway through
+        prompt_tokens: ``prompt_token_count`` reported in usage metadata, or
+            None to estimate it from the request contents
+        retry_delay: retry hint in seconds included in the 429 message
+    """
+
+    def __init__(self, response="<EOF>", latency=0.0, chunk_latency=0.0, chunk_size=64,
+                 fail_first=0, prompt_tokens=1000, model_name="models/fake", fail_midstream=0,
+                 retry_delay=None, fail_rate=0.0):
+        self.response = response
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.chunk_size = chunk_size
+        self.fail_first = fail_first
+        self.fail_midstream = fail_midstream
+        self.fail_rate = fail_rate
+        self.prompt_tokens = prompt_tokens
+        self.retry_delay = retry_delay
+        self.model_name = model_name
+        self.generation_config = {}
+        self.calls = 0
+        self.failures = 0
+        self.drops = 0
+        self.lock = threading.Lock()
+
+    def _begin(self, contents):
+        with self.lock:
+            self.calls += 1
+            if self.failures < self.fail_first or random.random() < self.fail_rate:
+                self.failures += 1
+                hint = f" Please retry in {self.retry_delay}s." if self.retry_delay is not None else ""
+                raise exceptions.ResourceExhausted(f"429 Resource has been exhausted (fake).{hint}")
+        text = self.response(contents) if callable(self.response) else self.response
+        pieces = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or [""]
+        # Roughly 4 characters per token
+        candidates = max(1, len(text) // 4)
+        prompt_tokens = self.prompt_tokens
+        if prompt_tokens is None:
+            prompt_tokens = max(1, sum(len(c if isinstance(c, str) else getattr(c, "text", "")) for c in contents) // 4)
+        usage = {
+            "prompt_token_count": prompt_tokens,
+            "candidates_token_count": candidates,
+            "total_token_count": prompt_tokens + candidates,
+        }
+        chunks = [FakeChunk(p) for p in pieces]
+        chunks[-1].usage = usage
+        drop_at = None
+        with self.lock:
+            if self.drops < self.fail_midstream:
+                self.drops += 1
+                drop_at = len(chunks) // 2
+        return chunks, FakeChunk(text, usage), drop_at
+
+    @staticmethod
+    def _drop():
+        raise exceptions.ServiceUnavailable("503 Connection reset during stream (fake)")
+
+    def generate_content(self, contents, stream=False):
+        chunks, whole, drop_at = self._begin(contents)
+        time.sleep(self.latency)
+
+        def iterate():
+            for i, chunk in enumerate(chunks):
+                if i == drop_at:
+                    self._drop()
+                if i and self.chunk_latency:
+                    time.sleep(self.chunk_latency)
+                yield chunk
+        return iterate() if stream else whole
+
+    async def generate_content_async(self, contents, stream=False):
+        chunks, whole, drop_at = self._begin(contents)
+        await asyncio.sleep(self.latency)
+
+        async def iterate():
+            for i, chunk in enumerate(chunks):
+                if i == drop_at:
+                    self._drop()
+                if i and self.chunk_latency:
+                    await asyncio.sleep(self.chunk_latency)
+                yield chunk
+        return iterate() if stream else whole
+
+
+class FakeFile:
+    """An uploaded file; keeps the text so fake responses can read it."""
+
+    def __init__(self, name, path, mime_type=None):
+        self.name = name
+        self.display_name = os.path.basename(path)
+        self.uri = f"fake://{name}"
+        self.mime_type = mime_type
+        with open(path, "r", encoding="utf-8") as f:
+            self.text = f.read()
+
+
+class FakeCachedContent:
+    def __init__(self, name, model, system_instruction, contents, ttl=None):
+        self.name = name
+        self.model = model
+        self.system_instruction = system_instruction
+        self.contents = list(contents)
+        self.ttl = ttl
+        self.deleted = False
+
+    def update(self, ttl=None):
+        self.ttl = ttl
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeGenAI:
+    """Mimics the parts of the ``google.generativeai`` module used by gps.
+
+    Install it with ``sys.modules["google.generativeai"] = FakeGenAI(...)``
+    before gps imports the real module.  Models created through it (directly
+    or from a cached content) are ``FakeGenerativeModel`` instances built with
+    ``model_options``; a cached content's contents are passed to the response
+    callable ahead of the request contents.
+
+    Args:
+        upload_latency: seconds per ``upload_file`` call
+        cache_latency: seconds per ``caching.CachedContent.create`` call
+    """
+
+    def __init__(self, upload_latency=0.0, cache_latency=0.0, **model_options):
+        self.upload_latency = upload_latency
+        self.cache_latency = cache_latency
+        self.model_options = model_options
+        self.files = {}
+        self.caches = {}
+        self.lock = threading.Lock()
+        self.caching = types.SimpleNamespace(CachedContent=types.SimpleNamespace(create=self._create_cache))
+        genai = self
+
+        class GenerativeModel(FakeGenerativeModel):
+            def __init__(self, model_name="models/fake", generation_config=None, system_instruction=None):
+                super().__init__(model_name=model_name, **genai.model_options)
+                self.generation_config = generation_config or {}
+                self.system_instruction = system_instruction
+                self.cached_content = None
+
+            @classmethod
+            def from_cached_content(cls, cache):
+                model = cls(cache.model, system_instruction=cache.system_instruction)
+                model.cached_content = cache
+                return model
+
+            def _begin(self, contents):
+                if isinstance(contents, (str, FakeFile)):
+                    contents = [contents]
+                if self.cached_content:
+                    contents = [*self.cached_content.contents, *contents]
+                return super()._begin(list(contents))
+
+        self.GenerativeModel = GenerativeModel
+
+    def configure(self, api_key=None):
+        pass
+
+    def upload_file(self, path, mime_type=None):
+        time.sleep(self.upload_latency)
+        with self.lock:
+            name = f"files/{len(self.files) + 1}"
+            self.files[name] = FakeFile(name, path, mime_type)
+            return self.files[name]
+
+    def delete_file(self, name):
+        with self.lock:
+            self.files.pop(name, None)
+
+    def _create_cache(self, model, system_instruction=None, contents=(), ttl=None):
+        time.sleep(self.cache_latency)
+        with self.lock:
+            name = f"cachedContents/{len(self.caches) + 1}"
+            self.caches[name] = FakeCachedContent(name, model, system_instruction, contents, ttl)
+            return self.caches[name]
+
+
+class FakeMarker:
+    """Canned replacement for ``gps.create_md.create_md``.
+
+    Writes a synthetic paper (sections, tables and ``_page_N_Picture_M``
+    image references) derived from the PDF's name, in the same layout as
+    marker's output, without reading the PDF or loading any model.
+
+    Args:
+        pages: pages per paper; each page has a section, paragraphs and a figure
+        paragraphs: paragraphs per page
+        latency: seconds per page
+    """
+
+    def __init__(self, pages=10, paragraphs=3, latency=0.0):
+        self.pages = pages
+        self.paragraphs = paragraphs
+        self.latency = latency
+
+    def markdown(self, name):
+        seed = int(hashlib.sha256(name.encode("utf-8")).hexdigest()[:8], 16)
+        lines = [f"# A Study of Synthetic Paper {seed}", ""]
+        for page in range(self.pages):
+            lines += [f"## {page + 1}. Section {page + 1}", ""]
+            for p in range(self.paragraphs):
+                lines += [
+                    f"Paragraph {p + 1} of section {page + 1} describes the method of paper {seed}. "
+                    "The proposed approach reduces computation while keeping accuracy, "
+                    f"as shown by $f(x) = \\sum_{{k=1}}^{{{page + 1}}} w_k x^k$ and the results below.",
+                    "",
+                ]
+            lines += [f"![](_page_{page}_Picture_1.jpeg)", ""]
+            lines += ["| Method | Accuracy |", "|---|---|", f"| Baseline | 0.{seed % 90 + 10} |", "| Proposed | 0.95 |", ""]
+        return "\n".join(lines)
+
+    def create_md(self, filepath, output_dir=None, page_window=0):
+        pdf_name = Path(filepath).stem
+        if output_dir is None:
+            output_dir = os.path.join(os.path.dirname(filepath), pdf_name)
+        else:
+            output_dir = os.path.join(output_dir, pdf_name)
+        os.makedirs(output_dir, exist_ok=True)
+        time.sleep(self.latency * self.pages)
+        text = self.markdown(pdf_name)
+        md_path = os.path.join(output_dir, f"{pdf_name}.md")
+        with open(md_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        for page in range(self.pages):
+            with open(os.path.join(output_dir, f"_page_{page}_Picture_1.jpeg"), "wb") as f:
+                f.write(b"\xff\xd8\xff\xd9")
+        return text, md_path
+
+
+class FakeRenderer:
+    """Replacement for ``gps.md_to_pdf.convert_isolated`` that writes a placeholder PDF.
+
+    Args:
+        latency: seconds per render
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def convert_isolated(self, md_path, output_path=None, *args, **kwargs):
+        start = time.monotonic()
+        time.sleep(self.latency)
+        output_path = output_path or os.path.splitext(md_path)[0] + ".pdf"
+        with open(output_path, "wb") as f:
+            f.write(b"%PDF-1.4\n%fake\n")
+        return md_path, output_path, time.monotonic() - start, False
+
+
+class FakeBatchServer:
+    """Serves the subset of the Gemini Batch REST API used by ``gps.batch`` on localhost.
+
+    Args:
+        response: text returned for every request, or a callable that
+            receives the list of text parts and returns the text
+        polls: number of status requests answered as running before the
+            batch succeeds
+        fail_keys: request keys answered with an error
+    """
+
+    def __init__(self, response="<EOF>", polls=1, fail_keys=(), prompt_tokens=1000):
+        self.response = response
+        self.polls = polls
+        self.fail_keys = set(fail_keys)
+        self.prompt_tokens = prompt_tokens
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        from http.server import ThreadingHTTPServer
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _new_name(self, prefix, table):
+        return f"{prefix}/{len(table) + 1}"
+
+    def _run(self, batch):
+        lines = []
+        for line in self.files[batch["input"]].decode("utf-8").splitlines():
+            entry = json.loads(line)
+            key = entry["key"]
+            if key in self.fail_keys:
+                lines.append({"key": key, "error": {"code": 500, "message": "fake failure"}})
+                continue
+            parts = [p["text"] for c in entry["request"]["contents"] for p in c["parts"]]
+            text = self.response(parts) if callable(self.response) else self.response
+            candidates = max(1, len(text) // 4)
+            lines.append({"key": key, "response": {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+                "usageMetadata": {
+                    "promptTokenCount": self.prompt_tokens,
+                    "candidatesTokenCount": candidates,
+                    "totalTokenCount": self.prompt_tokens + candidates,
+                },
+            }})
+        output = self._new_name("files", self.files)
+        self.files[output] = "".join(json.dumps(l, ensure_ascii=False) + "\n" for l in lines).encode("utf-8")
+        batch["output"] = output
+
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+        from urllib.parse import parse_qs, urlparse
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, body, headers=None, raw=None):
+                data = raw if raw is not None else json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with server.lock:
+                    if url.path == "/upload/v1beta/files" and "upload_id" not in url.query:
+                        upload_id = len(server.files) + 1
+                        self._send({}, {"x-goog-upload-url": f"{server.base_url}/upload/v1beta/files?upload_id={upload_id}"})
+                    elif url.path == "/upload/v1beta/files":
+                        name = f"files/{parse_qs(url.query)['upload_id'][0]}"
+                        server.files[name] = data
+                        self._send({"file": {"name": name}})
+                    elif url.path.endswith(":batchGenerateContent"):
+                        body = json.loads(data)["batch"]
+                        name = server._new_name("batches", server.batches)
+                        server.batches[name] = {"input": body["input_config"]["file_name"], "polls": server.polls}
+                        self._send({"name": name, "metadata": {"state": "BATCH_STATE_PENDING"}})
+                    else:
+                        self.send_error(404)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with server.lock:
+                    if url.path.startswith("/v1beta/batches/"):
+                        name = url.path[len("/v1beta/"):]
+                        batch = server.batches[name]
+                        if batch["polls"] > 0:
+                            batch["polls"] -= 1
+                            self._send({"name": name, "metadata": {"state": "BATCH_STATE_RUNNING"}})
+                            return
+                        if "output" not in batch:
+                            server._run(batch)
+                        self._send({"name": name, "metadata": {"state": "BATCH_STATE_SUCCEEDED"},
+                                    "response": {"responsesFile": batch["output"]}})
+                    elif url.path.startswith("/download/v1beta/") and url.path.endswith(":download"):
+                        name = url.path[len("/download/v1beta/"):-len(":download")]
+                        self._send(None, raw=server.files[name])
+                    else:
+                        self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
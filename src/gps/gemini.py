@@ -1,34 +1,266 @@
-import logging, math, time, re
+import asyncio, contextvars, itertools, logging, random, time, re, threading
 from datetime import timedelta
-from tqdm import tqdm
-from google.api_core import retry
+from google.api_core import exceptions
+from .ratelimit import RateLimiter, INITIAL_BACKOFF, MAX_BACKOFF
+from .partial import PartialOutput
+from . import keypool
+from . import prompts
+from . import metrics
 
 # Display retry status
 logger = logging.getLogger("google.api_core.retry")
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
-interval = 60 + 1  # with margin
-
-timestamps = []
-
-# Limit the number of requests per minute
-def generate_content(model, max_rpm, *args):
-    # Wait due to rate limiting
-    if 0 < max_rpm <= len(timestamps):
-        t = timestamps[-max_rpm]
-        if (td := time.monotonic() - t) < interval:
-            wait = math.ceil((interval - td) * 10)
-            print(f"Waiting {wait/10} seconds...")
-            if (wait_1 := wait % 10):
-                time.sleep(wait_1 / 10)
-            if wait >= 10:
-                for _ in tqdm(range(wait // 10)):
-                    time.sleep(1)
-
-    # Get the response
-    time1, time2, time3, rtext, chunk = generate_content_retry(model, args)
-    timestamps.append(time3)
+# Throttling and overload responses slow down every caller sharing the limiter;
+# other transient errors are only retried by the caller that hit them
+THROTTLE_ERRORS = (exceptions.ResourceExhausted, exceptions.TooManyRequests, exceptions.ServiceUnavailable)
+RETRY_ERRORS = THROTTLE_ERRORS + (exceptions.InternalServerError, ConnectionError)
+# Give up retrying a request after this many seconds
+RETRY_TIMEOUT = 600.0
+RETRY_DELAY_PATTERNS = [
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),
+    re.compile(r"retryDelay\W+([\d.]+)s"),
+    re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE),
+]
+
+# One event loop, in its own thread, for every coroutine that talks to the API. The SDK caches its
+# async client and that client's grpc channel stays bound to the loop it was first used on, so a
+# new loop per call (asyncio.run) fails with "Event loop is closed" from the second call on
+loop = None
+loop_lock = threading.Lock()
+
+def get_loop():
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="gps-gemini-loop", daemon=True).start()
+        return loop
+
+async def in_context(context, coro):
+    # The task starts from the loop thread's context; carry over the caller's paper, stage and key
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+def run(coro):
+    """Run a coroutine on the shared event loop from any thread (not the loop's own) and wait for it"""
+    future = asyncio.run_coroutine_threadsafe(in_context(contextvars.copy_context(), coro), get_loop())
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+# Shared limiters, one per (rpm, tpm) configuration
+limiters = {}
+limiters_lock = threading.Lock()
+
+def get_limiter(max_rpm, max_tpm=0):
+    with limiters_lock:
+        key = (max_rpm, max_tpm)
+        if key not in limiters:
+            limiters[key] = RateLimiter(max_rpm, max_tpm)
+        return limiters[key]
+
+# Pool of API keys (gps.keypool.KeyPool), disabled if None
+key_pool = None
+
+def configure_key_pool(pool):
+    global key_pool
+    key_pool = pool
+    keypool.install()
+
+def is_bound(model, args):
+    """Whether the request refers to an uploaded file or context cache, which only its own key can see"""
+    return bool(getattr(model, "cached_content", None)) or any(not isinstance(arg, str) for arg in args)
+
+def select_key(model, args, max_rpm, max_tpm, tokens=0):
+    """Return the key (None without a pool) and limiter to send the next attempt of a request with"""
+    if not key_pool:
+        return None, get_limiter(max_rpm, max_tpm)
+    if is_bound(model, args):
+        # The paper's key, or the configured key outside of a paper
+        key = keypool.current_key.get() or key_pool.keys[0]
+    else:
+        key = key_pool.choose(tokens)
+    key.count_request()
+    metrics.add("key_requests", 1, key=key.name)
+    return key, key.limiter
+
+# Content-addressed response cache (gps.response_cache.ResponseCache), disabled if None
+response_cache = None
+
+def configure_response_cache(cache):
+    global response_cache
+    response_cache = cache
+
+def get_cached(cache_key):
+    if cache_key and response_cache:
+        if cached := response_cache.get(cache_key):
+            print(f"Using cached response: {cache_key[:12]}")
+            return cached[0], {}
+    return None
+
+# Per-call cost ledger (gps.ledger.Ledger), disabled if None
+cost_ledger = None
+
+def configure_ledger(ledger):
+    global cost_ledger
+    cost_ledger = ledger
+
+def record_call(model, usage, latency):
+    if cost_ledger and usage:
+        cost_ledger.record(
+            getattr(model, "model_name", None), usage, latency,
+            paper=metrics.current_paper.get(), kind=metrics.current_stage.get(),
+        )
+
+# Directory for partial streamed outputs (gps.partial), disabled if None
+partial_dir = None
+
+def configure_partial_dir(directory):
+    global partial_dir
+    partial_dir = directory
+
+def open_partial(cache_key):
+    if cache_key and partial_dir:
+        return PartialOutput(partial_dir, cache_key)
+    return None
+
+# Requests in flight by cache key. A duplicate (identical chunks, or the same PDF at two paths)
+# waits for the first one and takes its cached response instead of sharing its partial file
+inflight = {}
+inflight_lock = threading.Lock()
+
+async def wait_inflight(cache_key):
+    """Wait until no request with this key is in flight and mark this one; return the cached result if one appeared"""
+    while True:
+        with inflight_lock:
+            event = inflight.get(cache_key)
+            if event is None:
+                inflight[cache_key] = threading.Event()
+                return None
+        # Wait in a worker thread so the shared loop keeps serving other requests
+        await asyncio.to_thread(event.wait)
+        if cached := get_cached(cache_key):
+            return cached
+
+def done_inflight(cache_key):
+    with inflight_lock:
+        inflight.pop(cache_key).set()
+
+USAGE_COUNTS = ("prompt_token_count", "candidates_token_count", "cached_content_token_count", "total_token_count")
+
+def add_usage(total, chunk):
+    """Add the usage reported by the last chunk of an interrupted stream, which is billed too"""
+    if chunk is None:
+        return
+    usage = chunk.to_dict().get("usage_metadata") or {}
+    for k in USAGE_COUNTS:
+        if usage.get(k):
+            total[k] = total.get(k, 0) + usage[k]
+
+def retry_after(e):
+    """Return the server's retry hint for an error in seconds, or None"""
+    for detail in getattr(e, "details", None) or []:
+        # google.rpc.RetryInfo
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "seconds"):
+            return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers and headers.get("retry-after"):
+        try:
+            return float(headers.get("retry-after"))
+        except ValueError:
+            pass
+    text = f"{e} {getattr(e, 'details', '')}"
+    for pattern in RETRY_DELAY_PATTERNS:
+        if m := pattern.search(text):
+            return float(m.group(1))
+    return None
+
+def is_daily_quota(e):
+    """Whether the error is an exhausted per-day quota, which retrying today won't fix"""
+    return isinstance(e, THROTTLE_ERRORS) and "PerDay" in f"{e} {getattr(e, 'details', '')}"
+
+def retry_delay(limiter, e, attempt, started, deadline, key=None, movable=False):
+    """Feed a failed request back into the limiter and return the delay before retrying, or None to give up"""
+    if key and is_daily_quota(e):
+        # The key is done for today; requests that don't need this key move to another one
+        key.exhaust()
+        print(f"\n---- API key {key.name} has exhausted its daily quota")
+        return 0.0 if movable and time.monotonic() <= deadline else None
+    if not isinstance(e, RETRY_ERRORS) or is_daily_quota(e) or time.monotonic() > deadline:
+        return None
+    if isinstance(e, THROTTLE_ERRORS):
+        # The limiter pauses every caller; the retry waits for it in acquire
+        metrics.add("throttled_requests", 1)
+        pause = limiter.throttle(retry_after(e), started)
+        print(f"\n---- {type(e).__name__}, retrying in {pause:.1f} seconds: {e}")
+        return 0.0
+    delay = min(INITIAL_BACKOFF * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1.0)
+    print(f"\n---- {type(e).__name__}, retrying in {delay:.1f} seconds: {e}")
+    return delay
+
+def generate_content(*args, **kwargs):
+    """Run generate_content_async synchronously"""
+    return asyncio.run(generate_content_async(*args, **kwargs))
+
+# Limit the number of requests and tokens per minute
+async def generate_content_async(model, max_rpm, *args, max_tpm=0, estimated_tokens=0, cache_key=None):
+    if cached := get_cached(cache_key):
+        return cached
+    if not cache_key:
+        return await _generate_content_async(model, max_rpm, args, max_tpm, estimated_tokens, cache_key)
+    if cached := await wait_inflight(cache_key):
+        return cached
+    try:
+        return await _generate_content_async(model, max_rpm, args, max_tpm, estimated_tokens, cache_key)
+    finally:
+        done_inflight(cache_key)
+
+async def _generate_content_async(model, max_rpm, args, max_tpm, estimated_tokens, cache_key):
+    movable = not is_bound(model, args)
+    charged = set()
+    # Usage of interrupted attempts, added to the final attempt's
+    interrupted = {}
+
+    # Get the response, writing it through to a partial file
+    output = open_partial(cache_key)
+    deadline = time.monotonic() + RETRY_TIMEOUT
+    try:
+        for attempt in itertools.count():
+            key, limiter = select_key(model, args, max_rpm, max_tpm, estimated_tokens)
+            # Estimated tokens are charged once per limiter; retries only take a request
+            metrics.add("ratelimit_wait_seconds", await limiter.acquire_async(0 if limiter in charged else estimated_tokens))
+            charged.add(limiter)
+            started = time.monotonic()
+            received = {}
+            try:
+                with keypool.using(key):
+                    time1, time2, time3, rtext, chunk = await generate_content_stream_async(keypool.bind(model) if key else model, args, output, received)
+                limiter.succeeded()
+                break
+            except RETRY_ERRORS as e:
+                add_usage(interrupted, received.get("chunk"))
+                if (delay := retry_delay(limiter, e, attempt, started, deadline, key, movable)) is None:
+                    record_call(model, interrupted, time.monotonic() - started)
+                    raise
+            finally:
+                limiter.release()
+            await asyncio.sleep(delay)
+    finally:
+        if output:
+            output.close()
+    result = finish_content(limiter, estimated_tokens, cache_key, time1, time2, time3, rtext, chunk, interrupted)
+    record_call(model, result[1], time3 - time1)
+    if output:
+        output.discard()
+    return result
+
+def finish_content(limiter, estimated_tokens, cache_key, time1, time2, time3, rtext, chunk, interrupted=None):
     if not rtext.endswith("\n"):
         print(flush=True)
     rtext = rtext.rstrip() + "\n"
@@ -37,28 +269,51 @@ def generate_content(model, max_rpm, *args):
     chunk_dict = chunk.to_dict()
     if "usage_metadata" in chunk_dict:
         usage = chunk_dict["usage_metadata"]
+        # A resumed request is billed for every attempt, not only the one that finished
+        for k, v in (interrupted or {}).items():
+            usage[k] = usage.get(k, 0) + v
         usage["prompt_eval_duration"    ] = int((time2 - time1) * 1000)  # in ms
         usage["candidates_eval_duration"] = int((time3 - time2) * 1000)  # in ms
         set_stats(usage)
+        limiter.record_usage(usage.get("total_token_count", 0), estimated_tokens)
+        metrics.add("prompt_tokens", usage.get("prompt_token_count", 0))
+        metrics.add("candidates_tokens", usage.get("candidates_token_count", 0))
+        metrics.add("cached_tokens", usage.get("cached_content_token_count", 0))
     else:
         usage = {}
 
+    if cache_key and response_cache:
+        response_cache.put(cache_key, rtext, usage)
     return rtext, usage
 
-@retry.Retry(initial=10)
-def generate_content_retry(model, args):
+def resume_args(args, output):
+    """Return the request contents and the text already received for a resumed request"""
+    resumed = output.resume() if output else ""
+    if resumed:
+        # Continue after the last complete paragraph instead of starting over
+        print(f"\n---- Resuming after {len(resumed)} characters of previous output")
+        args = (*args, prompts.get_continuation_prompt(resumed))
+    return args, resumed
+
+async def generate_content_stream_async(model, args, output=None, received=None):
+    """Stream a response; received["chunk"] keeps the last chunk in case the stream is interrupted"""
+    args, resumed = resume_args(args, output)
     time1 = time.monotonic()
-    response = model.generate_content(args, stream=True)
+    response = await model.generate_content_async(args, stream=True)
     time2 = None
-    rtext = ""
-    for chunk in response:
+    parts = [resumed]
+    async for chunk in response:
+        if received is not None:
+            received["chunk"] = chunk
         if not time2:
             time2 = time.monotonic()
         chunk_text = chunk.text
         print(chunk_text, end="", flush=True)
-        rtext += chunk_text
+        parts.append(chunk_text)
+        if output:
+            output.write(chunk_text)
     time3 = time.monotonic()
-    return time1, time2, time3, rtext, chunk
+    return time1, time2, time3, "".join(parts), chunk
 
 def set_stats(st):
     dur1 = st.get("prompt_eval_duration"    , 0)
@@ -104,6 +359,8 @@ def iter_stats(st):
         yield k, st[k]
 
 def show_stats(st, prefix=""):
+    if response_cache:
+        st = {**st, **response_cache.stats()}
     if not st:
         return
     maxlen = max(len(k) for k in st)
@@ -0,0 +1,175 @@
+"""
+レンダリング用の画像の最適化
+
+markerが書き出した画像は元の解像度のままPDFに埋め込まれるため、図の多い論文では
+PDFが大きくなり、レンダリングも遅くなる。レンダリングの前に、テンプレートのレイアウト
+（B4・2段組みでは1段の幅）で印刷に必要な解像度まで縮小・再圧縮した画像を作成し、
+pandocに渡すマークダウンの一時ファイルからはそちらを参照する。元の画像は変更しない。
+
+最適化した画像は元の画像の内容（SHA-256）と設定をキーとしてキャッシュするため、
+同じ内容の画像（論文内で繰り返されるロゴや、再レンダリング）は1回だけ処理する。
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = "cache/images"
+# 印刷に必要な解像度
+DEFAULT_DPI = 300
+JPEG_QUALITY = 85
+# 最適化の方法を変更した場合は値を変えて古いキャッシュを無効にする
+KEY_VERSION = "1"
+
+# 用紙の大きさ（mm）
+PAPER_SIZES_MM = {
+    "a4paper": (210, 297),
+    "a5paper": (148, 210),
+    "b4paper": (257, 364),
+    "b5paper": (182, 257),
+    "letterpaper": (215.9, 279.4),
+}
+# テンプレートから読み取れない場合のレイアウト（configs/template.texと同じB4・2段組み）
+DEFAULT_PAPER = "b4paper"
+DEFAULT_MARGINS_MM = (20, 20, 25, 25)  # 左、右、上、下
+# LaTeXの\columnsepの既定値（10pt）
+COLUMN_SEP_MM = 3.5
+MM_PER_INCH = 25.4
+# 最適化の対象にする画像の拡張子
+EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+
+def printable_size(template=None) -> tuple[float, float]:
+    """
+    テンプレートで画像を表示できる最大の幅と高さ（インチ）を取得する
+
+    \\documentclassの用紙と2段組みの指定、geometryパッケージの余白（mmまたはtruemm）を読み取る。
+    """
+    text = ""
+    if template and os.path.isfile(template):
+        with open(template, "r", encoding="utf-8") as f:
+            text = f.read()
+    options = ""
+    if m := re.search(r"\\documentclass\[([^\]]*)\]", text):
+        options = m.group(1)
+    paper = next((p for p in PAPER_SIZES_MM if p in options), DEFAULT_PAPER)
+    twocolumn = "twocolumn" in options if m else True
+    margins = list(DEFAULT_MARGINS_MM)
+    if g := re.search(r"\\usepackage\[([^\]]*)\]\{geometry\}", text):
+        for i, side in enumerate(("left", "right", "top", "bottom")):
+            if v := re.search(rf"\b{side}\s*=\s*([\d.]+)\s*(?:true)?mm", g.group(1)):
+                margins[i] = float(v.group(1))
+    width, height = PAPER_SIZES_MM[paper]
+    text_width = width - margins[0] - margins[1]
+    if twocolumn:
+        text_width = (text_width - COLUMN_SEP_MM) / 2
+    text_height = height - margins[2] - margins[3]
+    return text_width / MM_PER_INCH, text_height / MM_PER_INCH
+
+
+class ImageOptimizer:
+    """画像をテンプレートの印刷解像度に縮小・再圧縮し、結果をキャッシュする"""
+
+    def __init__(self, cache_dir=DEFAULT_DIR, dpi=DEFAULT_DPI, template=None):
+        """
+        Args:
+            cache_dir (str): 最適化した画像の保存先
+            dpi (int): 印刷に必要な解像度
+            template (str, optional): 画像の最大の大きさを読み取るテンプレート
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        width, height = printable_size(template)
+        self.max_width = round(width * dpi)
+        self.max_height = round(height * dpi)
+        # レンダリング結果のキャッシュのキーに含める設定
+        self.options = f"v{KEY_VERSION}:{self.max_width}x{self.max_height}:q{JPEG_QUALITY}"
+        self._seen = set()
+        self.stats = {"images": 0, "unique_images": 0, "original_bytes": 0, "optimized_bytes": 0}
+
+    def _cached(self, key):
+        for ext in (".jpg", ".png"):
+            path = os.path.join(self.cache_dir, key[:2], key + ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def optimize(self, path) -> str:
+        """
+        画像を最適化し、レンダリングに使う画像のパスを返す
+
+        対象外の形式や読み込めない画像の場合は元のパスを返す。
+        """
+        if os.path.splitext(path)[1].lower() not in EXTENSIONS or not os.path.isfile(path):
+            return path
+        with open(path, "rb") as f:
+            data = f.read()
+        key = hashlib.sha256(f"{self.options}\0".encode("utf-8") + data).hexdigest()
+        optimized = self._cached(key)
+        if optimized is None:
+            try:
+                optimized = self._optimize(path, key)
+            except ImportError:
+                logger.warning("Pillowがインストールされていないため、画像を最適化しません")
+                return path
+            except Exception as e:
+                logger.warning(f"画像の最適化に失敗しました（元の画像を使用します）: {path}: {e}")
+                return path
+        self.stats["images"] += 1
+        # 同じ内容の画像は1回だけ数える
+        if key not in self._seen:
+            self._seen.add(key)
+            self.stats["unique_images"] += 1
+            self.stats["original_bytes"] += len(data)
+            self.stats["optimized_bytes"] += os.path.getsize(optimized)
+        return optimized
+
+    def _optimize(self, path, key):
+        from PIL import Image
+
+        with Image.open(path) as image:
+            image.load()
+            dpi = tuple(d or 72 for d in image.info.get("dpi", (72, 72)))
+            scale = min(1.0, self.max_width / image.width, self.max_height / image.height)
+            has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+            # 透過のある画像と、色数の少ないPNG（線画やグラフ）はPNG、写真などはJPEGで保存する
+            few_colors = image.format == "PNG" and image.getcolors(256) is not None
+            if has_alpha:
+                image = image.convert("RGBA")
+            else:
+                image = image.convert("L" if image.mode in ("1", "L", "I", "I;16") else "RGB")
+            if scale < 1.0:
+                size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+                image = image.resize(size, Image.LANCZOS)
+            # 表示される大きさが変わらないよう、縮小した分だけ解像度の情報を下げる
+            dpi = tuple(d * scale for d in dpi)
+
+            directory = os.path.join(self.cache_dir, key[:2])
+            os.makedirs(directory, exist_ok=True)
+            ext = ".png" if has_alpha or few_colors else ".jpg"
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=ext)
+            os.close(fd)
+            try:
+                if ext == ".png":
+                    if few_colors and image.mode == "RGB":
+                        image = image.quantize(256)
+                    image.save(tmp_path, "PNG", optimize=True, dpi=dpi)
+                else:
+                    image.save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True, dpi=dpi)
+                # 縮小せず、再圧縮しても小さくならない場合は元の画像をそのまま使う
+                if scale == 1.0 and os.path.getsize(tmp_path) >= os.path.getsize(path):
+                    ext = os.path.splitext(path)[1].lower().replace(".jpeg", ".jpg")
+                    shutil.copyfile(path, tmp_path)
+                optimized = os.path.join(directory, key + ext)
+                os.replace(tmp_path, optimized)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+        return optimized
+
+    def bytes_saved(self) -> int:
+        return self.stats["original_bytes"] - self.stats["optimized_bytes"]
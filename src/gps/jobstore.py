@@ -0,0 +1,284 @@
+"""
+PDFの処理状況を記録するジョブストア
+
+SQLite（WALモード）に状態を保存するため、状態の更新は1行の書き込みで済み、
+書き込み途中でクラッシュしてもファイルが壊れない。複数のワーカープロセスから
+同時に更新しても安全で、正規化したパスとPDFの内容のハッシュで検索できる。
+
+"processing" の状態には処理しているプロセス（ホスト名:PID）を記録する。そのプロセスが
+終了している場合や、PROCESSING_TIMEOUTを過ぎた場合は、クラッシュで残った状態とみなして再処理する。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "logs/pdf_processing.sqlite"
+# 以前のバージョンで使用していたJSON形式のログ
+LEGACY_LOG_FILE = "logs/pdf_processing_log.json"
+# 他のホスト（または記録のない）プロセスの "processing" を処理中とみなす時間
+PROCESSING_TIMEOUT = timedelta(hours=6)
+
+
+def normalize_path(file_path) -> str:
+    """パスを絶対パスに正規化する"""
+    return str(Path(file_path).resolve())
+
+
+def current_owner() -> str:
+    """このプロセスを識別する文字列（ホスト名:PID）"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def process_alive(pid) -> bool:
+    """このホストのプロセスが実行中かどうか"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_stale(entry, timeout=PROCESSING_TIMEOUT) -> bool:
+    """
+    "processing" の状態が、クラッシュなどで取り残されたものかどうかを判定する
+
+    このホストのプロセスの場合はプロセスが終了しているかどうか、他のホストのプロセスや
+    記録のない場合は最後の更新からtimeoutを過ぎているかどうかで判定する。
+    """
+    if entry["status"] != "processing":
+        return False
+    host, _, pid = (entry.get("owner") or "").rpartition(":")
+    if host == socket.gethostname() and pid.isdigit():
+        return not process_alive(int(pid))
+    try:
+        return datetime.now() - datetime.fromisoformat(entry["timestamp"]) > timeout
+    except ValueError:
+        return True
+
+
+def sha256_file(file_path, block_size=1024 * 1024) -> str:
+    """ファイルの内容のSHA-256を計算する"""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+class JobStore:
+    """処理状況（現在の状態と履歴）を保存するストア"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # 他のプロセスが書き込み中の場合は待つ
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " path TEXT PRIMARY KEY,"
+            " content_hash TEXT,"
+            " status TEXT NOT NULL,"
+            " timestamp TEXT NOT NULL,"
+            " error TEXT,"
+            " owner TEXT);"
+            "CREATE INDEX IF NOT EXISTS jobs_content_hash ON jobs(content_hash);"
+            "CREATE TABLE IF NOT EXISTS history ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " path TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " timestamp TEXT NOT NULL,"
+            " error TEXT);"
+            "CREATE INDEX IF NOT EXISTS history_path ON history(path);"
+        )
+        # 以前のバージョンで作成したジョブストアには処理しているプロセスの列がない
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def update(self, file_path, status, error=None, content_hash=None):
+        """
+        処理状況を更新する
+
+        Args:
+            file_path (str): PDFファイルのパス（正規化して保存する）
+            status (str): 状態（"processing", "success", "failed"など）
+            error (Exception, optional): 失敗した場合のエラー
+            content_hash (str, optional): PDFの内容のハッシュ。指定されない場合は以前の値を保持する
+        """
+        path = normalize_path(file_path)
+        timestamp = datetime.now().isoformat()
+        error = str(error) if error else None
+        owner = current_owner() if status == "processing" else None
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO history (path, status, timestamp, error) VALUES (?, ?, ?, ?)",
+                    (path, status, timestamp, error),
+                )
+                self._conn.execute(
+                    "INSERT INTO jobs (path, content_hash, status, timestamp, error, owner) VALUES (?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT(path) DO UPDATE SET"
+                    " content_hash = COALESCE(excluded.content_hash, jobs.content_hash),"
+                    " status = excluded.status, timestamp = excluded.timestamp, error = excluded.error,"
+                    " owner = excluded.owner",
+                    (path, content_hash, status, timestamp, error, owner),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.debug(f"ジョブストアを更新しました: {path}, 状態: {status}")
+
+    def claim(self, file_path, content_hash, force=False):
+        """
+        PDFを処理する権利を取得する（状態の確認と "processing" への更新を1つのトランザクションで行う）
+
+        同じ内容で処理済み（success）の場合と、他のプロセスが処理中（processing、is_staleでない）の
+        場合は取得しない。複数のプロセスが同時に呼び出しても、取得できるのは1つだけ。
+
+        Args:
+            file_path (str): PDFファイルのパス
+            content_hash (str): PDFの内容のハッシュ
+            force (bool): 他のプロセスが処理中でも取得する（ワークキューのリースを持つ場合）
+
+        Returns:
+            tuple[bool, dict]: (取得したかどうか, 以前の処理状況またはNone)
+        """
+        path = normalize_path(file_path)
+        timestamp = datetime.now().isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                entry = self._to_dict(self._conn.execute(
+                    "SELECT path, content_hash, status, timestamp, error, owner FROM jobs WHERE path = ?", (path,)
+                ).fetchone())
+                if entry and entry["content_hash"] in (None, content_hash):
+                    if entry["status"] == "success" or (
+                        entry["status"] == "processing" and not force and not is_stale(entry)
+                    ):
+                        self._conn.execute("COMMIT")
+                        return False, entry
+                self._conn.execute(
+                    "INSERT INTO history (path, status, timestamp, error) VALUES (?, 'processing', ?, NULL)",
+                    (path, timestamp),
+                )
+                self._conn.execute(
+                    "INSERT INTO jobs (path, content_hash, status, timestamp, error, owner)"
+                    " VALUES (?, ?, 'processing', ?, NULL, ?)"
+                    " ON CONFLICT(path) DO UPDATE SET content_hash = excluded.content_hash,"
+                    " status = excluded.status, timestamp = excluded.timestamp, error = NULL, owner = excluded.owner",
+                    (path, content_hash, timestamp, current_owner()),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return True, entry
+
+    def get(self, file_path):
+        """パスに対応する現在の処理状況を取得する。ない場合はNoneを返す"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path, content_hash, status, timestamp, error, owner FROM jobs WHERE path = ?",
+                (normalize_path(file_path),),
+            ).fetchone()
+        return self._to_dict(row)
+
+    def find_by_hash(self, content_hash):
+        """内容のハッシュが一致する処理状況のリストを取得する"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, content_hash, status, timestamp, error, owner FROM jobs WHERE content_hash = ?",
+                (content_hash,),
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def history(self, file_path):
+        """パスに対応する状態の履歴を古い順に取得する"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, timestamp, error FROM history WHERE path = ? ORDER BY id",
+                (normalize_path(file_path),),
+            ).fetchall()
+        return [{"status": r[0], "timestamp": r[1], "error": r[2]} for r in rows]
+
+    def list(self, status=None, limit=100):
+        """処理状況を新しい順に取得する（statusを指定した場合はその状態のみ）"""
+        query = "SELECT path, content_hash, status, timestamp, error, owner FROM jobs"
+        params = ()
+        if status:
+            query += " WHERE status = ?"
+            params = (status,)
+        query += " ORDER BY timestamp DESC LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(query, params + (limit,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def counts(self):
+        """状態ごとの件数を取得する"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def import_legacy_log(self, log_file=LEGACY_LOG_FILE):
+        """JSON形式のログをジョブストアに取り込む（ジョブストアが空の場合のみ）"""
+        if not os.path.exists(log_file) or self.count():
+            return 0
+        try:
+            with open(log_file, "r", encoding="utf-8") as f:
+                processing_log = json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"ログファイルの形式が不正なため、取り込みをスキップします: {log_file}")
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for path, entry in processing_log.items():
+                path = normalize_path(path)
+                for old in entry.get("history", []) + [entry]:
+                    if "status" not in old:
+                        continue
+                    self._conn.execute(
+                        "INSERT INTO history (path, status, timestamp, error) VALUES (?, ?, ?, ?)",
+                        (path, old["status"], old.get("timestamp") or "", old.get("error")),
+                    )
+                if "status" in entry:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO jobs (path, content_hash, status, timestamp, error)"
+                        " VALUES (?, NULL, ?, ?, ?)",
+                        (path, entry["status"], entry.get("timestamp") or "", entry.get("error")),
+                    )
+            self._conn.execute("COMMIT")
+        logger.info(f"既存のログファイルを取り込みました: {len(processing_log)}件のエントリがあります")
+        return len(processing_log)
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        return {
+            "path": row[0], "content_hash": row[1], "status": row[2], "timestamp": row[3], "error": row[4],
+            "owner": row[5],
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,205 @@
+"""
+複数のAPIキー（プロジェクト）にリクエストを振り分けるキープール（--key-pool）
+
+キーごとにRPM/TPMのレートリミッタと1日のリクエスト数の上限を持ち、リクエストは
+待ち時間が最も短い（余裕が最も大きい）キーに送る。制限（429/503）を受けたキーは
+一時停止するため、次の試行では他のキーが選ばれる。1日の上限に達したキーは翌日まで使わない。
+
+アップロードしたファイルとコンテキストキャッシュは作成したプロジェクトからしか参照できない。
+そのため論文ごとにキーを1つ選び（current_key）、アップロード、キャッシュ、それらを参照する
+リクエストはそのキーで行う。ファイルを参照しないリクエスト（チャンク翻訳など）は
+リクエストごとにキーを選ぶ。
+
+設定ファイル（JSON）の例:
+
+    {"keys": [
+        {"name": "project-a", "api_key_env": "GEMINI_API_KEY_A", "rpm": 1000, "tpm": 1000000, "rpd": 10000},
+        {"name": "project-b", "api_key_env": "GEMINI_API_KEY_B"}
+    ]}
+
+キーは api_key（値）または api_key_env（環境変数名）で指定する。rpm/tpmを省略した場合は
+--rpm/--tpmの値を使い、rpd（1日のリクエスト数）を省略した場合は無制限とする。
+"""
+
+import contextvars
+import copy
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from .ratelimit import RateLimiter
+
+# Geminiの1日の上限は太平洋時間の0時にリセットされる（夏時間は考慮しない）
+QUOTA_TIMEZONE = timezone(timedelta(hours=-8))
+
+# 現在の論文（または処理）で使うキー。Noneの場合はgenai.configureで設定したキー
+current_key = contextvars.ContextVar("current_key", default=None)
+
+
+class QuotaExhausted(Exception):
+    """全てのキーが1日の上限に達した"""
+
+
+def quota_day():
+    return datetime.now(QUOTA_TIMEZONE).date()
+
+
+class ApiKey:
+    """プール内の1つのキーと、そのレートリミッタ・1日の使用数"""
+
+    def __init__(self, name, api_key, rpm=0, tpm=0, rpd=0):
+        self.name = name
+        self.api_key = api_key
+        self.rpd = rpd
+        self.limiter = RateLimiter(rpm, tpm)
+        self.lock = threading.Lock()
+        self.day = quota_day()
+        self.requests_today = 0
+        self.requests = 0
+        self.exhausted = False
+        self._clients = None
+
+    def _roll(self):
+        """日付が変わっていれば1日の使用数をリセットする"""
+        today = quota_day()
+        if today != self.day:
+            self.day = today
+            self.requests_today = 0
+            self.exhausted = False
+
+    def available(self) -> bool:
+        """今日このキーにリクエストを送れるかどうか"""
+        with self.lock:
+            self._roll()
+            return not self.exhausted and (not self.rpd or self.requests_today < self.rpd)
+
+    def count_request(self):
+        with self.lock:
+            self._roll()
+            self.requests_today += 1
+            self.requests += 1
+
+    def exhaust(self):
+        """1日の上限に達したことを記録する（翌日まで選ばない）"""
+        with self.lock:
+            self._roll()
+            self.exhausted = True
+
+    def clients(self):
+        """このキーで設定したgoogle.generativeaiのクライアントマネージャを取得する"""
+        with self.lock:
+            if self._clients is None:
+                from google.generativeai.client import _ClientManager
+                self._clients = _ClientManager()
+                self._clients.configure(api_key=self.api_key)
+            return self._clients
+
+
+class KeyPool:
+    """APIキーのプール"""
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError("キープールにキーがありません")
+        self.keys = list(keys)
+
+    @classmethod
+    def load(cls, path, rpm=0, tpm=0):
+        """
+        設定ファイル（JSON）からプールを作成する
+
+        Args:
+            path (str): 設定ファイルのパス
+            rpm (int): rpmを省略したキーのRPM
+            tpm (int): tpmを省略したキーのTPM
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        keys = []
+        for i, entry in enumerate(config.get("keys", [])):
+            name = entry.get("name") or f"key{i + 1}"
+            api_key = entry.get("api_key")
+            if not api_key and entry.get("api_key_env"):
+                api_key = os.environ.get(entry["api_key_env"])
+            if not api_key:
+                raise ValueError(f"キー {name} の api_key または api_key_env（環境変数）が設定されていません: {path}")
+            keys.append(ApiKey(name, api_key, entry.get("rpm", rpm), entry.get("tpm", tpm), entry.get("rpd", 0)))
+        return cls(keys)
+
+    def choose(self, tokens=0):
+        """
+        待ち時間が最も短いキーを選ぶ
+
+        待ち時間が同じ場合は、すぐに送れるリクエスト数が多く、処理中のリクエストが少ないキーを選ぶ。
+        全てのキーが1日の上限に達している場合はQuotaExhaustedを送出する。
+        """
+        keys = [key for key in self.keys if key.available()]
+        if not keys:
+            raise QuotaExhausted("全てのAPIキーが1日の上限に達しました")
+        return min(keys, key=lambda key: (key.limiter.delay(tokens), -key.limiter.headroom(), key.limiter.inflight))
+
+    def stats(self):
+        """キーごとのリクエスト数、制限を受けた回数、待ち時間"""
+        return [
+            {
+                "name": key.name,
+                "requests": key.requests,
+                "requests_today": key.requests_today,
+                "throttled": key.limiter.throttled,
+                "waited": key.limiter.waited,
+                "exhausted": key.exhausted,
+            }
+            for key in self.keys
+        ]
+
+
+@contextmanager
+def using(key):
+    """ブロック内（から作成したタスク）のgoogle.generativeaiの呼び出しにkeyを使う"""
+    token = current_key.set(key) if key else None
+    try:
+        yield key
+    finally:
+        if token:
+            current_key.reset(token)
+
+
+def bind(model):
+    """
+    モデルのクライアントをcurrent_keyのキーで作り直すためのコピーを作成する
+
+    GenerativeModelは最初の呼び出しでクライアントを保持するため、キーを切り替える
+    リクエストごとにコピーして、保持したクライアントを破棄する。
+    """
+    model = copy.copy(model)
+    for attr in ("_client", "_async_client"):
+        if hasattr(model, attr):
+            setattr(model, attr, None)
+    return model
+
+
+class KeyedClientManager:
+    """current_keyが設定されている場合はそのキーのクライアントを返すクライアントマネージャ"""
+
+    def __init__(self, default):
+        self.default = default
+
+    def get_default_client(self, name):
+        key = current_key.get()
+        return (key.clients() if key else self.default).get_default_client(name)
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+def install():
+    """google.generativeaiのクライアントの取得をcurrent_keyに従わせる（プロセスで一度だけ）"""
+    try:
+        from google.generativeai import client
+    except ImportError:
+        # gps.fakesの代替実装など、キーごとのクライアントを持たない場合
+        return
+    if not isinstance(client._client_manager, KeyedClientManager):
+        client._client_manager = KeyedClientManager(client._client_manager)
@@ -0,0 +1,198 @@
+"""
+Gemini APIの呼び出しごとの料金台帳と、実行前の料金の見積もり
+
+呼び出しごとにモデル、トークン数（キャッシュ済みトークンを含む）、所要時間、料金を
+SQLite（WALモード）に記録し、JSONLにも書き出せるようにする。実行中の合計は
+--budgetによる上限の判定に使う。
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from .chunking import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "logs/cost_ledger.sqlite"
+
+# 100万トークンあたりの料金（円）。前方一致でモデルを選び、該当しない場合はDEFAULT_RATES
+MODEL_RATES = {
+    "gemini-2.5-flash": (25, 100),
+}
+DEFAULT_RATES = (25, 100)
+# キャッシュ済みトークンは入力料金の25%、Batch APIは通常の50%
+CACHED_RATIO = 0.25
+BATCH_RATIO = 0.5
+# 要約の出力トークン数の見込み、翻訳の出力トークン数の入力に対する比率の見込み
+SUMMARY_OUTPUT_TOKENS = 1500
+TRANSLATION_OUTPUT_RATIO = 1.2
+
+
+def rates_for(model_name):
+    """モデルの (入力, 出力) の100万トークンあたりの料金を取得する"""
+    if model_name and model_name.startswith("models/"):
+        model_name = model_name[len("models/"):]
+    for prefix, rates in MODEL_RATES.items():
+        if model_name and model_name.startswith(prefix):
+            return rates
+    return DEFAULT_RATES
+
+
+def cost(model_name, prompt_tokens, candidates_tokens, cached_tokens=0, batch=False):
+    """
+    トークン数から料金（円）を計算する
+
+    prompt_tokensはキャッシュ済みトークンを含む（APIのusage_metadataと同じ）。
+
+    Returns:
+        tuple: (入力料金, 出力料金, 合計料金)
+    """
+    input_rate, output_rate = rates_for(model_name)
+    input_cost = ((prompt_tokens - cached_tokens) + cached_tokens * CACHED_RATIO) * input_rate / 1000000
+    output_cost = candidates_tokens * output_rate / 1000000
+    if batch:
+        input_cost *= BATCH_RATIO
+        output_cost *= BATCH_RATIO
+    return input_cost, output_cost, input_cost + output_cost
+
+
+class Ledger:
+    """呼び出しごとの料金を記録する台帳"""
+
+    def __init__(self, path=DEFAULT_PATH, run_id=None):
+        self.path = path
+        self.run_id = run_id or f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self._lock = threading.Lock()
+        # この実行の合計料金（--budgetの判定用）
+        self.run_total = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS calls ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " time REAL NOT NULL,"
+            " run TEXT NOT NULL,"
+            " paper TEXT,"
+            " kind TEXT,"
+            " model TEXT,"
+            " prompt_tokens INTEGER NOT NULL,"
+            " cached_tokens INTEGER NOT NULL,"
+            " candidates_tokens INTEGER NOT NULL,"
+            " latency REAL,"
+            " batch INTEGER NOT NULL,"
+            " cost REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS calls_run ON calls(run);"
+        )
+
+    def record(self, model_name, usage, latency=None, paper=None, kind=None, batch=False):
+        """
+        1回の呼び出しを記録する
+
+        Args:
+            model_name (str): モデル名
+            usage (dict): usage_metadata（prompt_token_countなど）
+            latency (float, optional): 所要時間（秒）
+            paper (str, optional): 論文（PDFのパス）
+            kind (str, optional): 呼び出しの種類（summary, translation, chunkなど）
+            batch (bool): Batch APIの呼び出しかどうか
+
+        Returns:
+            float: 料金（円）
+        """
+        prompt_tokens = usage.get("prompt_token_count", 0)
+        cached_tokens = usage.get("cached_content_token_count", 0)
+        candidates_tokens = usage.get("candidates_token_count", 0)
+        _, _, total = cost(model_name, prompt_tokens, candidates_tokens, cached_tokens, batch)
+        with self._lock:
+            self.run_total += total
+            self._conn.execute(
+                "INSERT INTO calls (time, run, paper, kind, model, prompt_tokens, cached_tokens,"
+                " candidates_tokens, latency, batch, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), self.run_id, paper, kind, model_name, prompt_tokens, cached_tokens,
+                 candidates_tokens, latency, int(batch), total),
+            )
+        return total
+
+    def totals(self, run=None):
+        """合計のトークン数と料金を取得する（runを指定した場合はその実行のみ）"""
+        query = ("SELECT COUNT(*), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(cached_tokens), 0),"
+                 " COALESCE(SUM(candidates_tokens), 0), COALESCE(SUM(cost), 0) FROM calls")
+        params = ()
+        if run:
+            query += " WHERE run = ?"
+            params = (run,)
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+        return dict(zip(("calls", "prompt_tokens", "cached_tokens", "candidates_tokens", "cost"), row))
+
+    def export_jsonl(self, path, run=None):
+        """記録をJSONLに書き出す"""
+        query = "SELECT * FROM calls"
+        params = ()
+        if run:
+            query += " WHERE run = ?"
+            params = (run,)
+        with self._lock:
+            cursor = self._conn.execute(query + " ORDER BY id", params)
+            columns = [c[0] for c in cursor.description]
+            rows = cursor.fetchall()
+        with open(path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def cache_savings(model_name, cached_tokens):
+    """キャッシュ済みトークンによる入力料金の削減額（円）を計算する（保存料金は含まない）"""
+    input_rate, _ = rates_for(model_name)
+    return cached_tokens * input_rate * (1 - CACHED_RATIO) / 1000000
+
+
+def estimate_output_tokens(kind, input_tokens):
+    """出力トークン数を見込む（要約は一定、翻訳は入力に比例）"""
+    if kind == "summary":
+        return SUMMARY_OUTPUT_TOKENS
+    return int(input_tokens * TRANSLATION_OUTPUT_RATIO)
+
+
+def estimate(requests, model_name, count_tokens=None, batch=False):
+    """
+    リクエスト（gps.batch.collect_requestsの形式）の料金を見積もる
+
+    Args:
+        requests (list[dict]): {"key", "kind", "request"} のリスト
+        model_name (str): モデル名
+        count_tokens (callable, optional): (parts, system_instruction) から入力トークン数を返す関数。
+            指定しない場合はローカルで概算する
+        batch (bool): Batch APIで実行する場合の料金で見積もる
+
+    Returns:
+        dict: リクエスト数、入力・出力トークン数、料金
+    """
+    totals = {"requests": 0, "prompt_tokens": 0, "candidates_tokens": 0, "cost": 0.0}
+    for request in requests:
+        body = request["request"]
+        parts = [p["text"] for c in body["contents"] for p in c["parts"]]
+        system_instruction = "".join(p["text"] for p in body.get("systemInstruction", {}).get("parts", []))
+        if count_tokens:
+            prompt_tokens = count_tokens(parts, system_instruction)
+        else:
+            prompt_tokens = estimate_tokens(system_instruction + "".join(parts))
+        # 翻訳の出力は本文（プロンプトを除いた部分）に比例する
+        body_tokens = estimate_tokens(max(parts, key=len)) if parts else 0
+        candidates_tokens = estimate_output_tokens(request.get("kind"), body_tokens)
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["candidates_tokens"] += candidates_tokens
+        totals["cost"] += cost(model_name, prompt_tokens, candidates_tokens, batch=batch)[2]
+    return totals
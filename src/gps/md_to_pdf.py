@@ -8,12 +8,16 @@ import argparse
 import os
 import sys
 import logging
-import re
 import tempfile
 import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from .render_cache import IMAGE_PATTERN, RenderCache, render_key
+from . import render_cache
+from . import tex_cache
+from . import image_opt
 from pathlib import Path
 from glob import glob
-import pypandoc
 
 # ロガーの設定
 logging.basicConfig(
@@ -23,15 +27,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def convert_image_paths_to_absolute(md_path):
-    """マークダウンファイル内の画像パスを絶対パスに変換する"""
+def convert_image_paths_to_absolute(md_path, scratch_dir=None, optimizer=None):
+    """
+    マークダウンファイル内の画像パスを絶対パスに変換する（scratch_dirが指定された場合はそこに一時ファイルを作成）
+    
+    optimizerが指定された場合は、最適化した画像のパスに置き換える（元の画像とマークダウンは変更しない）。
+    """
     try:
         # 入力ファイルの絶対パスとディレクトリパスを取得
         md_path = os.path.abspath(md_path)
         md_dir = os.path.dirname(md_path)
         
         # 一時ファイルを作成
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".md", mode="w", encoding="utf-8")
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".md", mode="w", encoding="utf-8", dir=scratch_dir)
         temp_path = temp_file.name
         
         logger.info(f"画像パスを絶対パスに変換しています: {md_path}")
@@ -45,10 +53,12 @@ def convert_image_paths_to_absolute(md_path):
             if not image_path.startswith('/') and not image_path.startswith('http'):
                 # 相対パスの場合、絶対パスに変換
                 abs_image_path = os.path.join(md_dir, image_path)
+                if optimizer:
+                    abs_image_path = optimizer.optimize(abs_image_path)
                 return f'![{match.group(1)}]({abs_image_path})'
             return match.group(0)
         
-        modified_content = re.sub(r'!\[(.*?)\]\((.*?)\)', replace_image_path, content)
+        modified_content = IMAGE_PATTERN.sub(replace_image_path, content)
         
         # 変換後のコンテンツを一時ファイルに書き込み
         temp_file.write(modified_content)
@@ -60,8 +70,73 @@ def convert_image_paths_to_absolute(md_path):
         logger.error(f"画像パスの変換に失敗しました: {e}")
         return None
 
-def convert_md_to_pdf(md_path, output_path=None, font="IPAexGothic", template='configs/template.tex', pdf_engine="lualatex"):
-    """マークダウンファイルをPDFに変換する"""
+def build_pandoc_args(font, template, pdf_engine):
+    """pandocコマンドオプションに相当する引数を作成する"""
+    extra_args = []
+    
+    # PDF出力エンジンを設定
+    extra_args.extend(["--pdf-engine", pdf_engine])
+    
+    # テンプレートを設定（指定されている場合）
+    # 作業ディレクトリが変わっても参照できるよう絶対パスにする
+    if template:
+        extra_args.extend(["--template", os.path.abspath(template)])
+    
+    # フォントを設定
+    if font:
+        extra_args.extend(["-V", f"mainfont={font}"])
+    return extra_args
+
+# TeXキャッシュを作成するためにレンダリングする文書（テンプレートのフォントと主なパッケージを読み込ませる）
+WARM_UP_MARKDOWN = """# ウォームアップ
+
+日本語の本文と**太字**、数式 $E = mc^2$ を含む文書。
+
+| a | b |
+|---|---|
+| 1 | 2 |
+"""
+
+def prepare_tex_cache(font="IPAexGothic", template='configs/template.tex', pdf_engine="lualatex", base_dir=tex_cache.DEFAULT_DIR):
+    """
+    テンプレートに対応する永続的なTeXキャッシュを用意して有効にする（未作成の場合は1回レンダリングして作成）
+    """
+    def warm_up():
+        import pypandoc
+        scratch_dir = tempfile.mkdtemp(prefix="md-to-pdf-warmup-")
+        try:
+            pypandoc.convert_text(
+                WARM_UP_MARKDOWN,
+                'pdf',
+                format='markdown',
+                outputfile=os.path.join(scratch_dir, "warmup.pdf"),
+                extra_args=build_pandoc_args(font, template, pdf_engine),
+                cworkdir=scratch_dir,
+            )
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    
+    try:
+        return tex_cache.prepare(template, font, pdf_engine, warm_up, base_dir)
+    except Exception as e:
+        logger.warning(f"TeXキャッシュの作成に失敗しました: {e}")
+        return None
+
+def convert_md_to_pdf(md_path, output_path=None, font="IPAexGothic", template='configs/template.tex', pdf_engine="lualatex", scratch_dir=None, cache_dir=None, stats=None, image_cache_dir=None, image_dpi=image_opt.DEFAULT_DPI):
+    """
+    マークダウンファイルをPDFに変換する
+    
+    scratch_dirが指定された場合、一時ファイルとpandocの作業ディレクトリをそこに置き、
+    並行して実行される他の変換と衝突しないようにする。
+    cache_dirが指定された場合、マークダウン・画像・テンプレート・フォント・エンジンが
+    同じであれば、レンダリングせずにキャッシュされたPDFを使用する。
+    image_cache_dir が指定された場合、画像をimage_dpiの解像度に縮小・再圧縮してから埋め込む（image_opt）。
+    statsに辞書を渡すと、キャッシュの使用有無（cached）とレンダリング時間（render_seconds）、
+    画像の最適化で削減したバイト数（image_bytes_saved）を記録する。
+    """
+    if stats is None:
+        stats = {}
+    stats["cached"] = False
     try:
         # 入力ファイルの絶対パスを取得
         md_path = os.path.abspath(md_path)
@@ -80,35 +155,61 @@ def convert_md_to_pdf(md_path, output_path=None, font="IPAexGothic", template='c
         # 出力ディレクトリが存在しない場合は作成
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
+        # 入力が変わっていなければキャッシュされたPDFを使用
+        optimizer = image_opt.ImageOptimizer(image_cache_dir, image_dpi, template) if image_cache_dir else None
+        cache = None
+        if cache_dir:
+            cache = RenderCache(cache_dir)
+            key = render_key(md_path, template, font, pdf_engine, optimizer.options if optimizer else None)
+            found = cache.lookup(key)
+            if found and cache.place(key, output_path):
+                stats["cached"] = True
+                stats["render_seconds"] = 0.0
+                logger.info(f"キャッシュされたPDFを使用します（前回のレンダリング時間: {found[1]:.1f}秒）: {output_path}")
+                cache.close()
+                return output_path
+        
+        render_start = time.monotonic()
+        
+        # 出力先がキャッシュへのハードリンクの場合、上書きでキャッシュを壊さないよう先に削除
+        if os.path.exists(output_path) and os.stat(output_path).st_nlink > 1:
+            os.unlink(output_path)
+        
         # 画像パスを絶対パスに変換
-        temp_md_path = convert_image_paths_to_absolute(md_path)
+        temp_md_path = convert_image_paths_to_absolute(md_path, scratch_dir, optimizer)
         if not temp_md_path:
             logger.error("画像パスの変換に失敗したため、変換を中止します")
             return None
+        if optimizer and optimizer.stats["images"]:
+            stats["images"] = optimizer.stats["images"]
+            stats["image_bytes_saved"] = optimizer.bytes_saved()
+            logger.info(
+                f"画像を最適化しました: {optimizer.stats['images']}枚（重複を除いて{optimizer.stats['unique_images']}枚）, "
+                f"{optimizer.stats['original_bytes'] / 1e6:.1f}MB → {optimizer.stats['optimized_bytes'] / 1e6:.1f}MB"
+            )
         
         logger.info(f"'{temp_md_path}' を '{output_path}' に変換しています...")
         
         # pandocコマンドオプションに相当する引数を設定
-        extra_args = []
+        extra_args = build_pandoc_args(font, template, pdf_engine)
         
-        # PDF出力エンジンを設定
-        extra_args.extend(["--pdf-engine", pdf_engine])
-        
-        # テンプレートを設定（指定されている場合）
-        if template:
-            extra_args.extend(["--template", template])
-        
-        # フォントを設定
-        if font:
-            extra_args.extend(["-V", f"mainfont={font}"])
-        
-        # pypandocを使って変換
-        output = pypandoc.convert_file(
-            temp_md_path, 
-            'pdf', 
-            outputfile=output_path,
-            extra_args=extra_args
-        )
+        # pypandocを使って変換（インポートが重いため、変換時に読み込む）
+        # 途中で中断しても不完全なPDFが残らないよう、同じディレクトリの一時ファイルに出力してから置き換える
+        # （pandocは拡張子でPDFの出力を判定するため、一時ファイルも.pdfで終わる名前にする）
+        import pypandoc
+        part_path = f"{os.path.splitext(output_path)[0]}.part{os.getpid()}.pdf"
+        try:
+            output = pypandoc.convert_file(
+                temp_md_path, 
+                'pdf', 
+                outputfile=part_path,
+                extra_args=extra_args,
+                cworkdir=scratch_dir,
+            )
+            os.replace(part_path, output_path)
+        finally:
+            if os.path.exists(part_path):
+                os.unlink(part_path)
 
         
         # 一時ファイルを削除
@@ -119,15 +220,55 @@ def convert_md_to_pdf(md_path, output_path=None, font="IPAexGothic", template='c
             logger.warning(f"一時ファイルの削除に失敗しました: {e}")
         
         
-        logger.info(f"マークダウンをPDFに変換しました: {output_path}")
+        stats["render_seconds"] = time.monotonic() - render_start
+        if cache:
+            cache.store(key, output_path, stats["render_seconds"], md_path)
+            cache.close()
+        
+        logger.info(f"マークダウンをPDFに変換しました（{stats['render_seconds']:.1f}秒）: {output_path}")
         return output_path
     except Exception as e:
         logger.error(f"PDFへの変換に失敗しました: {e}")
 
         return None
 
-def process_directory(input_dir, output_dir=None, font="IPAexGothic", recursive=False, template=None, pdf_engine="lualatex"):
-    """ディレクトリ内のマークダウンファイルをPDFに変換する"""
+def convert_isolated(md_path, output_path=None, font="IPAexGothic", template='configs/template.tex', pdf_engine="lualatex", cache_dir=render_cache.DEFAULT_DIR, tex_cache_dir=tex_cache.DEFAULT_DIR, image_cache_dir=image_opt.DEFAULT_DIR, image_dpi=image_opt.DEFAULT_DPI, stats=None):
+    """
+    ジョブ専用の一時ディレクトリでマークダウンをPDFに変換する
+    
+    tex_cache_dirが指定された場合は、永続的なTeXキャッシュを使用する。
+    statsはconvert_md_to_pdfと同じ。
+    
+    Returns:
+        tuple: (入力ファイル, 出力PDFのパスまたはNone, 変換時間（秒）, キャッシュを使用したかどうか)
+    """
+    if tex_cache_dir:
+        prepare_tex_cache(font, template, pdf_engine, tex_cache_dir)
+    start = time.monotonic()
+    scratch_dir = tempfile.mkdtemp(prefix="md-to-pdf-")
+    if stats is None:
+        stats = {}
+    try:
+        result = convert_md_to_pdf(md_path, output_path, font, template, pdf_engine, scratch_dir, cache_dir, stats, image_cache_dir, image_dpi)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return md_path, result, time.monotonic() - start, stats.get("cached", False)
+
+def _convert_job(job):
+    """プロセスプールのワーカーで1件の変換を実行する"""
+    # pandocやLaTeXが作る一時ファイルもジョブごとのディレクトリに置く
+    # （ワーカープロセスは同時に1件しか処理しないため、環境変数を変更してよい）
+    scratch_root = tempfile.mkdtemp(prefix="md-to-pdf-tmp-")
+    os.environ["TMPDIR"] = scratch_root
+    tempfile.tempdir = scratch_root
+    try:
+        return convert_isolated(*job)
+    finally:
+        tempfile.tempdir = None
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+def process_directory(input_dir, output_dir=None, font="IPAexGothic", recursive=False, template=None, pdf_engine="lualatex", jobs=1, cache_dir=render_cache.DEFAULT_DIR, tex_cache_dir=tex_cache.DEFAULT_DIR, image_cache_dir=image_opt.DEFAULT_DIR, image_dpi=image_opt.DEFAULT_DPI):
+    """ディレクトリ内のマークダウンファイルをPDFに変換する（jobsが2以上の場合はプロセスプールで並行に変換）"""
     logger.info(f"ディレクトリ '{input_dir}' 内のマークダウンファイルを処理しています...")
     
     # 入力ディレクトリの絶対パスを取得
@@ -150,11 +291,9 @@ def process_directory(input_dir, output_dir=None, font="IPAexGothic", recursive=
     
     logger.info(f"{len(md_files)}個のマークダウンファイルを見つけました")
     
-    # 各マークダウンファイルを変換
-    success_count = 0
+    # 各マークダウンファイルの変換ジョブを作成
+    conversion_jobs = []
     for md_file in md_files:
-        # 出力PDFのパスを設定
-        rel_path = os.path.relpath(md_file, input_dir)
         # mdファイルが含まれるディレクトリの名前を取得
         dir_name = os.path.basename(os.path.dirname(md_file))
         # 親ディレクトリに保存
@@ -162,13 +301,35 @@ def process_directory(input_dir, output_dir=None, font="IPAexGothic", recursive=
         
         # ディレクトリがない場合は作成
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        # 変換を実行
-        result = convert_md_to_pdf(md_file, output_path, font, template, pdf_engine)
-        if result:
-            success_count += 1
+        conversion_jobs.append((md_file, output_path, font, template, pdf_engine, cache_dir, tex_cache_dir, image_cache_dir, image_dpi))
     
-    logger.info(f"処理完了: {success_count}/{len(md_files)}ファイルを変換しました")
+    # 並行に変換する前に、全ジョブで共有するTeXキャッシュを作成しておく
+    if tex_cache_dir and conversion_jobs:
+        prepare_tex_cache(font, template, pdf_engine, tex_cache_dir)
+    
+    # 変換を実行
+    start = time.monotonic()
+    if jobs > 1 and len(conversion_jobs) > 1:
+        logger.info(f"{jobs}個のプロセスで並行に変換します")
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_convert_job, conversion_jobs))
+    else:
+        results = [convert_isolated(*job) for job in conversion_jobs]
+    elapsed = time.monotonic() - start
+    
+    # 結果の集計
+    success_count = sum(1 for _, result, _, _ in results if result)
+    failed = [md_file for md_file, result, _, _ in results if not result]
+    cached_count = sum(1 for _, result, _, cached in results if result and cached)
+    render_time = sum(t for _, _, t, _ in results)
+    logger.info(f"処理完了: {success_count}/{len(md_files)}ファイルを変換しました（うちキャッシュ使用: {cached_count}ファイル）")
+    if results:
+        logger.info(
+            f"経過時間: {elapsed:.1f}秒, 変換時間の合計: {render_time:.1f}秒, "
+            f"1ファイルあたり: {render_time / len(results):.1f}秒, 並列度: {render_time / max(elapsed, 1e-9):.1f}"
+        )
+    for md_file in failed:
+        logger.warning(f"変換に失敗しました: {md_file}")
     return success_count
 
 def main():
@@ -180,13 +341,26 @@ def main():
     parser.add_argument("-f", "--font", default="IPAexGothic", help="PDFで使用するフォント名")
     parser.add_argument("-t", "--template", default="configs/template.tex", help="PDFテンプレートファイルへのパス")
     parser.add_argument("-e", "--engine", default="lualatex", help="PDF変換エンジン (例: lualatex, xelatex)")
+    parser.add_argument("--cache-dir", default=render_cache.DEFAULT_DIR, help=f"レンダリング結果のキャッシュディレクトリ (デフォルト: {render_cache.DEFAULT_DIR})")
+    parser.add_argument("--no-cache", action="store_true", help="レンダリング結果のキャッシュを使用しない")
+    parser.add_argument("--tex-cache-dir", default=tex_cache.DEFAULT_DIR, help=f"TeXのフォント・フォーマットキャッシュのディレクトリ (デフォルト: {tex_cache.DEFAULT_DIR})")
+    parser.add_argument("--no-tex-cache", action="store_true", help="ツールが管理するTeXキャッシュを使用しない")
+    parser.add_argument("--image-cache-dir", default=image_opt.DEFAULT_DIR, help=f"最適化した画像のキャッシュディレクトリ (デフォルト: {image_opt.DEFAULT_DIR})")
+    parser.add_argument("--image-dpi", type=int, default=image_opt.DEFAULT_DPI, help=f"画像を縮小する解像度 (デフォルト: {image_opt.DEFAULT_DPI})")
+    parser.add_argument("--no-image-opt", action="store_true", help="画像を最適化せず元の画像を埋め込む")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="並行に変換するプロセス数 (デフォルト: CPUコア数)")
     args = parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache_dir
+    tex_cache_dir = None if args.no_tex_cache else args.tex_cache_dir
+    image_cache_dir = None if args.no_image_opt else args.image_cache_dir
     
     # 入力がディレクトリかファイルかを判定
     if os.path.isdir(args.input):
-        process_directory(args.input, args.output, args.font, args.recursive, args.template, args.engine)
+        process_directory(args.input, args.output, args.font, args.recursive, args.template, args.engine, args.jobs, cache_dir, tex_cache_dir, image_cache_dir, args.image_dpi)
     elif os.path.isfile(args.input) and args.input.lower().endswith('.md'):
-        convert_md_to_pdf(args.input, args.output, args.font, args.template, args.engine)
+        if tex_cache_dir:
+            prepare_tex_cache(args.font, args.template, args.engine, tex_cache_dir)
+        convert_md_to_pdf(args.input, args.output, args.font, args.template, args.engine, cache_dir=cache_dir, image_cache_dir=image_cache_dir, image_dpi=args.image_dpi)
     else:
         logger.error(f"入力 '{args.input}' は有効なマークダウンファイルまたはディレクトリではありません")
         sys.exit(1)
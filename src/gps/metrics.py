@@ -0,0 +1,253 @@
+"""
+パイプラインの各ステージの計測（スパン）とカウンタ
+
+論文ごと・ステージごと（convert, upload, ccache, summary, translation, continuation,
+merge, render など）の所要時間、レート制限による待ち時間、トークン数、料金を記録する。
+記録はJSONL（1行1イベント）に追記し、実行の終了時にPrometheusのテキスト形式でも書き出す。
+`gps report` はJSONLを読み込み、ステージごとのp50/p95とスループットを集計する。
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_PATH = "logs/metrics.jsonl"
+DEFAULT_PROMETHEUS_PATH = "logs/metrics.prom"
+
+# 現在処理中の論文（スパンやカウンタのラベルに使う）
+current_paper = contextvars.ContextVar("current_paper", default=None)
+# 現在のステージ（最も内側のスパン）
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+class Metrics:
+    """スパンとカウンタを集計し、JSONLに書き出すコレクタ"""
+
+    def __init__(self, path=None, run_id=None):
+        self.path = path
+        self.run_id = run_id or f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8")
+        # ステージごとの所要時間（秒）と、(名前, ラベル) ごとのカウンタ
+        self.durations = defaultdict(list)
+        self.counters = defaultdict(float)
+
+    def emit(self, record):
+        record = {"run": self.run_id, "time": time.time(), **record}
+        if self._file:
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+            with self._lock:
+                self._file.write(line)
+                self._file.flush()
+
+    @contextmanager
+    def span(self, stage, paper=None, **attrs):
+        """
+        ステージの所要時間を計測する
+
+        paperを指定した場合は、ブロック内（から作成したタスク）の既定の論文になる。
+        """
+        token = current_paper.set(paper) if paper else None
+        stage_token = current_stage.set(stage)
+        paper = paper or current_paper.get()
+        start = time.time()
+        t0 = time.monotonic()
+        ok = False
+        try:
+            yield attrs
+            ok = True
+        finally:
+            duration = time.monotonic() - t0
+            current_stage.reset(stage_token)
+            if token:
+                current_paper.reset(token)
+            with self._lock:
+                self.durations[stage].append(duration)
+            self.emit({"type": "span", "stage": stage, "paper": paper, "start": start,
+                       "duration": duration, "ok": ok, **attrs})
+
+    def add(self, name, value, **labels):
+        """カウンタに値を加算する（トークン数、料金、待ち時間など）"""
+        if not value:
+            return
+        paper = labels.pop("paper", None) or current_paper.get()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += value
+        self.emit({"type": "counter", "name": name, "value": value, "paper": paper, **labels})
+
+    def prometheus(self) -> str:
+        """この実行の集計をPrometheusのテキスト形式で取得する"""
+        lines = [
+            "# HELP gps_stage_duration_seconds Time spent in each pipeline stage",
+            "# TYPE gps_stage_duration_seconds summary",
+        ]
+        with self._lock:
+            durations = {stage: sorted(values) for stage, values in self.durations.items()}
+            counters = dict(self.counters)
+        for stage, values in sorted(durations.items()):
+            for q in (0.5, 0.95):
+                lines.append(f'gps_stage_duration_seconds{{stage="{stage}",quantile="{q}"}} {percentile(values, q):.6f}')
+            lines.append(f'gps_stage_duration_seconds_sum{{stage="{stage}"}} {sum(values):.6f}')
+            lines.append(f'gps_stage_duration_seconds_count{{stage="{stage}"}} {len(values)}')
+        names = sorted({name for name, _ in counters})
+        for name in names:
+            lines.append(f"# TYPE gps_{name}_total counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name != name:
+                    continue
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"gps_{name}_total{{{label_text}}} {value:g}" if label_text else f"gps_{name}_total {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=DEFAULT_PROMETHEUS_PATH):
+        """Prometheusのテキスト形式で書き出す（node_exporterのtextfile collectorなどで読み込める）"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+# 記録先を設定するまでは集計のみ行う
+metrics = Metrics()
+
+
+def configure(path=DEFAULT_PATH):
+    """JSONLの記録先を設定する"""
+    global metrics
+    metrics = Metrics(path)
+    return metrics
+
+
+def span(stage, paper=None, **attrs):
+    return metrics.span(stage, paper, **attrs)
+
+
+def add(name, value, **labels):
+    metrics.add(name, value, **labels)
+
+
+async def traced(stage, awaitable, **attrs):
+    """コルーチンの所要時間をスパンとして計測する"""
+    with metrics.span(stage, **attrs):
+        return await awaitable
+
+
+def percentile(values, q):
+    """ソート済みの値のパーセンタイル（線形補間）"""
+    if not values:
+        return 0.0
+    pos = (len(values) - 1) * q
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+def load(path=DEFAULT_PATH):
+    """JSONLの記録を読み込む（壊れた行は無視する）"""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def summarize_runs(records, last=None):
+    """
+    記録をステージごと・実行ごとに集計する
+
+    Args:
+        records (list[dict]): loadで読み込んだ記録
+        last (int, optional): 直近の実行のみを集計する場合の実行数
+
+    Returns:
+        tuple[dict, list[dict]]: ステージごとの集計と、実行ごとの集計
+    """
+    runs = []
+    for record in records:
+        if record.get("run") not in runs:
+            runs.append(record.get("run"))
+    if last:
+        runs = runs[-last:]
+    selected = set(runs)
+
+    stages = defaultdict(list)
+    failures = defaultdict(int)
+    per_run = {run: {"run": run, "start": None, "end": None, "papers": set(), "counters": defaultdict(float)} for run in runs}
+    for record in records:
+        run = per_run.get(record.get("run")) if record.get("run") in selected else None
+        if run is None:
+            continue
+        if record["type"] == "span":
+            stages[record["stage"]].append(record["duration"])
+            if not record.get("ok"):
+                failures[record["stage"]] += 1
+            end = record["start"] + record["duration"]
+            run["start"] = record["start"] if run["start"] is None else min(run["start"], record["start"])
+            run["end"] = end if run["end"] is None else max(run["end"], end)
+            if record["stage"] == "render" and record.get("ok") and record.get("paper"):
+                run["papers"].add(record["paper"])
+        elif record["type"] == "counter":
+            run["counters"][record["name"]] += record["value"]
+
+    stage_summary = {}
+    for stage, values in stages.items():
+        values.sort()
+        stage_summary[stage] = {
+            "count": len(values),
+            "failed": failures[stage],
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "max": values[-1],
+            "total": sum(values),
+        }
+    run_summary = []
+    for run in per_run.values():
+        wall = (run["end"] - run["start"]) if run["start"] is not None else 0.0
+        run_summary.append({
+            "run": run["run"],
+            "wall": wall,
+            "papers": len(run["papers"]),
+            "papers_per_hour": len(run["papers"]) / wall * 3600 if wall else 0.0,
+            **run["counters"],
+        })
+    return stage_summary, run_summary
+
+
+def format_report(stage_summary, run_summary) -> str:
+    """集計を表形式の文字列にする"""
+    lines = [f"{'stage':<14}{'count':>7}{'failed':>8}{'p50 s':>10}{'p95 s':>10}{'max s':>10}{'total s':>11}"]
+    # 合計時間の長い（ボトルネックになっている可能性が高い）ステージから表示
+    for stage, s in sorted(stage_summary.items(), key=lambda item: -item[1]["total"]):
+        lines.append(
+            f"{stage:<14}{s['count']:>7}{s['failed']:>8}{s['p50']:>10.2f}{s['p95']:>10.2f}{s['max']:>10.2f}{s['total']:>11.1f}"
+        )
+    lines.append("")
+    lines.append(f"{'run':<26}{'papers':>7}{'wall s':>10}{'papers/h':>10}{'wait s':>9}{'tokens':>11}{'cost':>9}")
+    for r in run_summary:
+        tokens = r.get("prompt_tokens", 0) + r.get("candidates_tokens", 0)
+        lines.append(
+            f"{r['run']:<26}{r['papers']:>7}{r['wall']:>10.1f}{r['papers_per_hour']:>10.1f}"
+            f"{r.get('ratelimit_wait_seconds', 0):>9.1f}{tokens:>11.0f}{r.get('cost_yen', 0):>9.2f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,113 @@
+"""
+Geminiのストリーミング出力を逐次ディスクに書き出し、中断した位置から再開する
+
+受信したチャンクは <キー>.md に追記し、段落の区切り（空行）を受信するたびに
+確定した長さを <キー>.json（チェックポイント）に記録する。接続が切れて再試行する場合や、
+プロセスが異常終了して再実行した場合は、最後に確定した段落までの出力を引き継ぎ、
+続きだけを生成する。キーは応答キャッシュと同じ（入力・プロンプト・モデルのハッシュ）。
+"""
+
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = "cache/partial"
+# 段落の区切り
+PARAGRAPH_BREAK = "\n\n"
+
+
+class PartialOutput:
+    """1つのリクエストの途中までの出力とチェックポイント"""
+
+    def __init__(self, directory, key):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{key}.md")
+        self.checkpoint_path = os.path.join(directory, f"{key}.json")
+        self._file = None
+        # ファイルに書き込んだバイト数と、確定した（段落の区切りまでの）バイト数
+        self._written = 0
+        self._committed = 0
+        # 最後に確定してから書き込んだテキスト
+        self._pending = []
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_checkpoint(self, attempts=None):
+        checkpoint = self._read_checkpoint()
+        checkpoint["committed"] = self._committed
+        checkpoint["updated"] = time.time()
+        if attempts is not None:
+            checkpoint["attempts"] = attempts
+        tmp_path = f"{self.checkpoint_path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def resume(self) -> str:
+        """
+        確定済みの出力を読み込み、それ以降の（未確定の）部分を切り捨てて追記を開始する
+
+        Returns:
+            str: 確定済みの出力（ない場合は空文字列）
+        """
+        self.close()
+        checkpoint = self._read_checkpoint()
+        committed = checkpoint.get("committed", 0)
+        text = b""
+        if committed and os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                text = f.read(committed)
+        # ファイルがチェックポイントより短い場合は、読めた範囲の最後の段落まで
+        if len(text) < committed:
+            end = text.rfind(PARAGRAPH_BREAK.encode("utf-8"))
+            text = text[:end + len(PARAGRAPH_BREAK)] if end >= 0 else b""
+        self._file = open(self.path, "ab")
+        self._file.truncate(len(text))
+        self._written = self._committed = len(text)
+        self._pending = []
+        self._write_checkpoint(attempts=checkpoint.get("attempts", 0) + 1)
+        return text.decode("utf-8", errors="replace")
+
+    def write(self, text):
+        """受信したテキストを追記し、段落の区切りを受信していればチェックポイントを更新する"""
+        if self._file is None:
+            self.resume()
+        data = text.encode("utf-8")
+        self._file.write(data)
+        self._file.flush()
+        self._written += len(data)
+        self._pending.append(text)
+        if "\n" not in text:
+            return
+        # チャンクの境界をまたぐ区切りも検出するため、未確定のテキストをまとめて調べる
+        pending = "".join(self._pending)
+        end = pending.rfind(PARAGRAPH_BREAK)
+        if end < 0:
+            self._pending = [pending]
+            return
+        end += len(PARAGRAPH_BREAK)
+        self._committed += len(pending[:end].encode("utf-8"))
+        self._pending = [pending[end:]] if end < len(pending) else []
+        self._write_checkpoint()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """完了したリクエストの途中経過を削除する"""
+        self.close()
+        for path in (self.path, self.checkpoint_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,87 @@
+"""
+論文処理をステージ（PDF→マークダウン変換、Gemini呼び出し、PDFレンダリング）に分割し、
+ステージごとのワーカープールで並行実行するスケジューラ
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """パイプラインの1ステージ"""
+
+    def __init__(self, name, func, workers=1, queue_size=None):
+        """
+        Args:
+            name (str): ステージ名（ログ表示用）
+            func (callable): 前ステージの結果を受け取り、次ステージへ渡す値を返す関数。
+                Noneを返した場合、そのアイテムは以降のステージに進まない
+            workers (int): 同時に実行するワーカー数
+            queue_size (int, optional): 実行中＋待機中のアイテム数の上限。
+                指定されない場合はワーカー数の2倍
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue_size = queue_size or self.workers * 2
+        self.executor = None
+        self.slots = None
+
+
+class Pipeline:
+    """
+    ステージごとに上限付きのワーカープールを持つパイプライン
+
+    アイテムN+1の変換中にアイテムNのGemini呼び出しとアイテムN-1のレンダリングを
+    並行して進める。各ステージの待機数には上限があり、後段が詰まると前段が待つ。
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self._pending = 0
+        self._cond = threading.Condition()
+
+    def run(self, items):
+        """全アイテムをパイプラインに流し、全ステージの完了を待つ"""
+        for stage in self.stages:
+            stage.executor = ThreadPoolExecutor(
+                max_workers=stage.workers, thread_name_prefix=f"gps-{stage.name}"
+            )
+            stage.slots = threading.BoundedSemaphore(stage.queue_size)
+        try:
+            for item in items:
+                self._submit(0, item)
+            with self._cond:
+                while self._pending:
+                    self._cond.wait()
+        finally:
+            for stage in self.stages:
+                stage.executor.shutdown(wait=True)
+
+    def _submit(self, index, item):
+        stage = self.stages[index]
+        # 待機数の上限に達している場合は空きが出るまで待つ（背圧）
+        stage.slots.acquire()
+        with self._cond:
+            self._pending += 1
+        stage.executor.submit(self._run_stage, index, item)
+
+    def _run_stage(self, index, item):
+        stage = self.stages[index]
+        try:
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                logger.error(f"ステージ '{stage.name}' でエラーが発生しました: {e}")
+                result = None
+            finally:
+                stage.slots.release()
+            if result is not None and index + 1 < len(self.stages):
+                self._submit(index + 1, result)
+        finally:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
@@ -40,6 +40,19 @@ single_prompt = """
 - 出力の最後には<EOF>を出力してください。
 """
 
+chunk_prompt = """
+- 以下は論文のマークダウンファイルの一部です。この部分だけを和訳してください。前後の部分は別途翻訳されます。
+- タグなどはそのままにしてください。
+- 画像の参照（例：　![](_page_1_Picture_1.jpeg)）は消さないでください。画像及びそのレジェンドは、本文で登場した位置の次の段落にくるように移動させてください。
+- テーブルは翻訳しないでそのままにしてください。
+- referenceはタイトルを和訳したものを使用してください。
+- 出力の最後には<EOF>を出力してください。
+"""
+
+# 翻訳メモリで埋めた部分をプレースホルダーに置き換えたチャンク用
+chunk_memory_prompt = chunk_prompt + """- <!-- tm:1 --> のようなコメントは翻訳済みの部分です。翻訳せず、その位置にそのまま出力してください。
+"""
+
 def get_continuation_prompt(result):
     return f"""以下のマークダウンファイルを和訳してください。ただし、タグやセクション、画像の参照（例：　![](_page_1_Picture_1.jpeg)）などの構造はそのままにしてください。途中まで翻訳されているので続きを翻訳してください。最後に<EOF>タグを付けてください。
 
@@ -0,0 +1,210 @@
+import asyncio, random, threading, time
+
+# Quotas are defined per minute
+PERIOD = 60
+
+# Adaptive control (AIMD): a throttling response multiplies the request rate and
+# the number of requests in flight by DECREASE, each success adds INCREASE of the
+# configured rate (and about one request in flight per window) back
+DECREASE = 0.5
+INCREASE = 0.05
+MIN_FACTOR = 0.1
+# Pause after a throttling response without a retry hint, doubled per decrease
+INITIAL_BACKOFF = 10.0
+MAX_BACKOFF = 120.0
+# Spread callers resuming after a pause over this fraction of the pause
+PAUSE_JITTER = 0.25
+# Polling interval while waiting for a free slot under the concurrency limit
+SLOT_POLL = 0.1
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of blocking.
+
+    ``reserve`` always succeeds and returns how long the caller must wait
+    before using the reservation.  The level may go negative, which queues
+    later callers behind earlier ones without holding a lock while waiting.
+    """
+
+    def __init__(self, capacity, period=PERIOD):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def peek(self, now):
+        """Return the level at ``now`` without changing the bucket."""
+        return min(self.capacity, self.level + (now - self.updated) * self.rate)
+
+    def reserve(self, amount, now):
+        self._refill(now)
+        # A single request larger than the bucket would never be admitted
+        self.level -= min(amount, self.capacity)
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+    def adjust(self, amount, now):
+        """Charge (or refund, if negative) tokens after the fact."""
+        self._refill(now)
+        self.level -= amount
+
+    def resize(self, capacity, now):
+        """Change the capacity (and the refill rate with it)."""
+        self._refill(now)
+        self.rate = capacity / self.period
+        self.capacity = capacity
+        self.level = min(self.level, capacity)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limiter shared by all callers.
+
+    Usable from threads (``acquire``) and from any asyncio event loop
+    (``acquire_async``).  A limit of 0 disables that bucket.
+
+    The limiter also adapts to the server: callers report throttling responses
+    (``throttle``) and successes (``succeeded``), and every caller sharing the
+    limiter slows down together.  A throttling response pauses all callers
+    (for the server's retry hint if there is one), lowers the request rate and
+    caps the number of requests in flight (``acquire`` takes a slot that the
+    caller gives back with ``release``); successes raise both back again.
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.lock = threading.Lock()
+        self.waited = 0.0  # total seconds callers spent blocked
+        self.factor = 1.0  # fraction of the configured rpm currently allowed
+        self.concurrency = None  # requests allowed in flight, unlimited until throttled
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.last_decrease = float("-inf")
+        self.backoff = INITIAL_BACKOFF
+        self.throttled = 0  # number of throttling responses reported
+
+    def reserve(self, tokens=0):
+        """Reserve one request and ``tokens`` tokens; return the wait in seconds."""
+        with self.lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens and tokens:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+            if self.paused_until > now:
+                pause = self.paused_until - now
+                wait = max(wait, pause + random.uniform(0, PAUSE_JITTER * pause))
+            self.waited += wait
+            return wait
+
+    def delay(self, tokens=0):
+        """Return how long a request for ``tokens`` tokens would wait now, without reserving it."""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                if bucket and amount:
+                    level = bucket.peek(now) - min(amount, bucket.capacity)
+                    if level < 0:
+                        wait = max(wait, -level / bucket.rate)
+            if self.concurrency is not None and self.inflight >= int(self.concurrency):
+                wait = max(wait, SLOT_POLL)
+            return wait
+
+    def headroom(self):
+        """Return the number of requests that could be sent now without waiting."""
+        with self.lock:
+            if not self.requests:
+                return float("inf")
+            return max(0.0, self.requests.peek(time.monotonic()))
+
+    def _enter(self):
+        """Take a slot under the concurrency limit if one is free."""
+        with self.lock:
+            if self.concurrency is not None and self.inflight >= int(self.concurrency):
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self):
+        """Give back the slot taken by ``acquire``."""
+        with self.lock:
+            self.inflight -= 1
+
+    def _resize(self, now):
+        if self.requests:
+            self.requests.resize(self.rpm * self.factor, now)
+
+    def throttle(self, retry_after=None, started=None):
+        """Report a throttling response (429/503) and return the pause in seconds.
+
+        ``retry_after`` is the server's retry hint, if any.  Responses to
+        requests started before the last decrease belong to the same burst and
+        only extend the pause, so a burst of errors lowers the limits once.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.throttled += 1
+            decrease = started is None or started >= self.last_decrease
+            pause = retry_after if retry_after is not None else self.backoff
+            if decrease:
+                self.last_decrease = now
+                self.factor = max(MIN_FACTOR, self.factor * DECREASE)
+                self.concurrency = max(1.0, (self.concurrency or self.inflight) * DECREASE)
+                self._resize(now)
+                if retry_after is None:
+                    self.backoff = min(MAX_BACKOFF, self.backoff * 2)
+                rate = f"{self.rpm * self.factor:.1f} rpm, " if self.rpm else ""
+                print(f"Throttled: pausing {pause:.1f} seconds, limiting to {rate}{int(self.concurrency)} in flight")
+            self.paused_until = max(self.paused_until, now + pause)
+            pause = self.paused_until - now
+            # Queue the requests behind the pause instead of releasing them all at once
+            if self.requests:
+                self.requests.adjust(max(0.0, self.requests.level + pause * self.requests.rate), now)
+            return pause
+
+    def succeeded(self):
+        """Report a successful request, probing the limits back up."""
+        with self.lock:
+            self.backoff = INITIAL_BACKOFF
+            if self.factor < 1.0:
+                self.factor = min(1.0, self.factor + INCREASE)
+                self._resize(time.monotonic())
+            if self.concurrency is not None:
+                self.concurrency += 1 / self.concurrency
+
+    def record_usage(self, actual, estimated=0):
+        """Charge the difference between actual and estimated token usage."""
+        if not self.tokens or actual == estimated:
+            return
+        with self.lock:
+            self.tokens.adjust(actual - estimated, time.monotonic())
+
+    def acquire(self, tokens=0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            print(f"Waiting {wait:.1f} seconds...")
+            time.sleep(wait)
+        while not self._enter():
+            time.sleep(SLOT_POLL)
+            wait += SLOT_POLL
+        return wait
+
+    async def acquire_async(self, tokens=0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            print(f"Waiting {wait:.1f} seconds...")
+            await asyncio.sleep(wait)
+        while not self._enter():
+            await asyncio.sleep(SLOT_POLL)
+            wait += SLOT_POLL
+        return wait
@@ -0,0 +1,163 @@
+"""
+レンダリング済みPDFのキャッシュ
+
+マークダウン、参照している画像、テンプレート、フォント、PDFエンジンの内容から
+キーを計算し、同じ入力であればpandoc/lualatexを実行せずに以前のPDFを再利用する。
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = "cache/render"
+# レンダリング方法を変更した場合は値を変えて古いキャッシュを無効にする
+KEY_VERSION = "1"
+
+# 画像の参照（convert_image_paths_to_absoluteと同じ形式）
+IMAGE_PATTERN = re.compile(r'!\[(.*?)\]\((.*?)\)')
+
+
+def _hash_file(h, path):
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            h.update(block)
+
+
+def render_key(md_path, template, font, pdf_engine, image_options=None) -> str:
+    """
+    レンダリング結果を決める入力からキャッシュのキーを計算する
+
+    Args:
+        md_path (str): マークダウンファイルのパス
+        template (str): テンプレートファイルのパス
+        font (str): フォント名
+        pdf_engine (str): PDFエンジン
+        image_options (str, optional): 画像の最適化の設定（ImageOptimizer.options）
+
+    Returns:
+        str: キー（SHA-256の16進文字列）
+    """
+    md_path = os.path.abspath(md_path)
+    md_dir = os.path.dirname(md_path)
+    h = hashlib.sha256()
+    h.update(f"version:{KEY_VERSION}\0font:{font}\0engine:{pdf_engine}\0".encode("utf-8"))
+    if image_options:
+        h.update(f"images:{image_options}\0".encode("utf-8"))
+
+    with open(md_path, "rb") as f:
+        content = f.read()
+    h.update(b"markdown\0")
+    h.update(content)
+
+    # 参照している画像の内容（convert_image_paths_to_absoluteと同じ規則でパスを解決）
+    for match in IMAGE_PATTERN.finditer(content.decode("utf-8", errors="replace")):
+        image_path = match.group(2)
+        h.update(f"\0image:{image_path}\0".encode("utf-8"))
+        if image_path.startswith("http"):
+            continue
+        if not image_path.startswith("/"):
+            image_path = os.path.join(md_dir, image_path)
+        if os.path.isfile(image_path):
+            _hash_file(h, image_path)
+        else:
+            h.update(b"missing")
+
+    if template and os.path.isfile(template):
+        h.update(b"\0template\0")
+        _hash_file(h, template)
+    else:
+        h.update(f"\0template:{template}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def same_file(a, b) -> bool:
+    """2つのファイルが同じ実体または同じ内容かどうかを判定する"""
+    if not (os.path.exists(a) and os.path.exists(b)):
+        return False
+    if os.path.samefile(a, b):
+        return True
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+    ha, hb = hashlib.sha256(), hashlib.sha256()
+    _hash_file(ha, a)
+    _hash_file(hb, b)
+    return ha.digest() == hb.digest()
+
+
+class RenderCache:
+    """キーごとにPDFを保存し、レンダリング時間を記録するキャッシュ"""
+
+    def __init__(self, cache_dir=DEFAULT_DIR):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(self.cache_dir, "index.sqlite"), timeout=60, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS renders ("
+            " key TEXT PRIMARY KEY,"
+            " source TEXT,"
+            " render_seconds REAL NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+
+    def _pdf_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pdf")
+
+    def lookup(self, key):
+        """
+        キャッシュを検索する
+
+        Returns:
+            tuple: (キャッシュされたPDFのパス, 前回のレンダリング時間（秒）)。ない場合はNone
+        """
+        pdf_path = self._pdf_path(key)
+        if not os.path.exists(pdf_path):
+            return None
+        row = self._conn.execute("SELECT render_seconds FROM renders WHERE key = ?", (key,)).fetchone()
+        return pdf_path, row[0] if row else 0.0
+
+    def place(self, key, output_path) -> bool:
+        """
+        キャッシュされたPDFを出力先に配置する（可能であればハードリンク、できなければコピー）
+
+        出力先に同じ内容のPDFが既にある場合は何もしない。
+        """
+        found = self.lookup(key)
+        if not found:
+            return False
+        cached_path, _ = found
+        if same_file(cached_path, output_path):
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        tmp_path = f"{output_path}.tmp{os.getpid()}"
+        try:
+            os.link(cached_path, tmp_path)
+        except OSError:
+            shutil.copyfile(cached_path, tmp_path)
+        os.replace(tmp_path, output_path)
+        return True
+
+    def store(self, key, pdf_path, render_seconds, source=None):
+        """レンダリングしたPDFとレンダリング時間をキャッシュに保存する"""
+        cached_path = self._pdf_path(key)
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cached_path), suffix=".pdf")
+        os.close(fd)
+        shutil.copyfile(pdf_path, tmp_path)
+        os.replace(tmp_path, cached_path)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO renders (key, source, render_seconds, created) VALUES (?, ?, ?, ?)",
+            (key, source, render_seconds, time.time()),
+        )
+
+    def close(self):
+        self._conn.close()
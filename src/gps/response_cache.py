@@ -0,0 +1,152 @@
+"""
+Geminiの応答をローカルに保存する、入力内容をキーとしたキャッシュ
+
+キーは入力（マークダウンやチャンク）のSHA-256、モデル名、プロンプト、
+システムインストラクション、generation_configから計算するため、
+ファイル名が異なっても内容が同じであれば再利用される。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "cache/gemini_responses.sqlite"
+# 何回の書き込みごとに古いエントリを削除するか
+EVICT_INTERVAL = 50
+
+
+def sha256_text(text: str) -> str:
+    """テキストのSHA-256を計算する"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_key(input_text, prompt, model_name, system_instruction, generation_config) -> str:
+    """
+    キャッシュのキーを計算する
+
+    Args:
+        input_text (str): 入力となるマークダウンまたはチャンクの内容
+        prompt (str): プロンプト
+        model_name (str): モデル名（"models/"の有無は区別しない）
+        system_instruction (str): システムインストラクション
+        generation_config (dict): 生成時の設定
+
+    Returns:
+        str: キー（SHA-256の16進文字列）
+    """
+    if model_name.startswith("models/"):
+        model_name = model_name[len("models/"):]
+    material = json.dumps(
+        {
+            "input": sha256_text(input_text),
+            "prompt": prompt,
+            "model": model_name,
+            "system_instruction": system_instruction,
+            "generation_config": generation_config,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return sha256_text(material)
+
+
+class ResponseCache:
+    """SQLiteに応答テキストと統計情報を保存するキャッシュ"""
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=1024 * 1024 * 1024, max_age_days=30):
+        """
+        Args:
+            path (str): SQLiteファイルのパス
+            max_bytes (int): 保存する応答の合計サイズの上限（0で無制限）
+            max_age_days (float): エントリの保持期間（日数、0で無期限）
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " text TEXT NOT NULL,"
+            " usage TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+
+    def get(self, key):
+        """キャッシュされた応答を取得する。ない場合はNoneを返す"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, usage, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self.max_age_days and row[2] < time.time() - self.max_age_days * 86400:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0], json.loads(row[1])
+
+    def put(self, key, text, usage):
+        """応答を保存する"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, text, usage, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, text, json.dumps(usage, ensure_ascii=False), len(text.encode("utf-8")), now, now),
+            )
+            self._puts += 1
+            if self._puts % EVICT_INTERVAL == 1:
+                self._evict()
+
+    def delete(self, key):
+        """エントリを削除する（不完全な応答を再利用しないようにするため）"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def evict(self):
+        """保持期間を過ぎたエントリと、サイズ上限を超えた分の古いエントリを削除する"""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        if self.max_age_days:
+            self._conn.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_days * 86400,)
+            )
+        if self.max_bytes:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                removed = 0
+                rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+                for key, size in rows:
+                    if total - removed <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    removed += size
+                logger.info(f"応答キャッシュから{removed}バイトを削除しました")
+
+    def stats(self):
+        """ヒット数とミス数を返す"""
+        return {"response_cache_hits": self.hits, "response_cache_misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,284 @@
+"""
+フォルダを監視してPDFを処理し続ける常駐モード
+
+markerのモデルとGeminiのクライアントを読み込んだままにしておき、監視フォルダに
+置かれたPDFを（inotify、使えない場合はポーリングで検出して）パイプラインに投入する。
+ローカルのHTTPエンドポイントからジョブの投入と状態の確認もできる。
+"""
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+# inotifyのイベント（<sys/inotify.h>）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """inotifyでディレクトリ（サブディレクトリを含む）への書き込み完了と移動を監視する"""
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc が見つかりません")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init"):
+            raise OSError("inotify は利用できません")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init に失敗しました")
+        self.watches = {}
+        for path in [Path(directory), *[p for p in Path(directory).rglob("*") if p.is_dir()]]:
+            self._add_watch(path)
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(str(path)), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        )
+        if wd >= 0:
+            self.watches[wd] = Path(path)
+
+    def run(self, callback, stop_event):
+        """イベントを読み、完成したPDFのパスでcallbackを呼び出す"""
+        import select
+        while not stop_event.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 1.0)
+            if not ready:
+                continue
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+                offset += length
+                directory = self.watches.get(wd)
+                if directory is None or not name:
+                    continue
+                path = directory / name
+                if mask & IN_ISDIR:
+                    # 新しいサブディレクトリも監視し、既に置かれたPDFを拾う
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._add_watch(path)
+                        for pdf in path.rglob("*.pdf"):
+                            callback(pdf)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and path.suffix.lower() == ".pdf":
+                    callback(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """一定間隔でディレクトリを走査し、サイズが変化しなくなったPDFを検出する"""
+
+    def __init__(self, directory, interval=2.0):
+        self.directory = Path(directory)
+        self.interval = interval
+        self.sizes = {}
+        # 検出済みのPDFの (サイズ, 更新日時)（変化しない限り再び検出しない）
+        self.reported = {}
+
+    def run(self, callback, stop_event):
+        while not stop_event.is_set():
+            current = {}
+            for pdf in self.directory.rglob("*.pdf"):
+                try:
+                    current[pdf] = (pdf.stat().st_size, pdf.stat().st_mtime)
+                except FileNotFoundError:
+                    continue
+                # 前回の走査からサイズと更新日時が変わっていなければ書き込み完了とみなす
+                previous = self.sizes.get(pdf)
+                if previous == current[pdf] and self.reported.get(pdf) != current[pdf]:
+                    self.reported[pdf] = current[pdf]
+                    callback(pdf)
+            self.sizes = current
+            self.reported = {pdf: stat for pdf, stat in self.reported.items() if pdf in current}
+            stop_event.wait(self.interval)
+
+    def close(self):
+        pass
+
+
+def create_watcher(directory, poll_interval=2.0, force_polling=False):
+    """inotifyが使える場合はInotifyWatcher、使えない場合はPollingWatcherを作成する"""
+    if not force_polling:
+        try:
+            watcher = InotifyWatcher(directory)
+            logger.info(f"inotifyでフォルダを監視します: {directory}")
+            return watcher
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotifyが使用できないため、ポーリングで監視します: {e}")
+    return PollingWatcher(directory, poll_interval)
+
+
+class JobQueue:
+    """
+    パイプラインに投入するジョブのキュー
+
+    同じ内容のPDFは、キューで待っているか処理中の間は重複して投入しない。処理が終わった
+    （done）PDFは再び投入でき、処理済みのものはジョブストアでスキップ、失敗したものは再試行される。
+    """
+
+    def __init__(self, make_job):
+        self.make_job = make_job
+        self.queue = queue.Queue()
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def submit(self, pdf_path):
+        """PDFをキューに追加する。追加した場合はTrueを返す"""
+        pdf_path = Path(pdf_path)
+        if not pdf_path.is_file() or pdf_path.suffix.lower() != ".pdf":
+            return False
+        stat = pdf_path.stat()
+        key = str(pdf_path.resolve())
+        with self.lock:
+            if self.seen.get(key) == (stat.st_size, stat.st_mtime):
+                return False
+            self.seen[key] = (stat.st_size, stat.st_mtime)
+        logger.info(f"ジョブを追加しました: {pdf_path}")
+        self.queue.put(self.make_job(pdf_path))
+        return True
+
+    def done(self, job):
+        """ジョブの処理が終わった（途中のステージで止まった場合を含む）PDFを再び投入できるようにする"""
+        with self.lock:
+            self.seen.pop(str(Path(job["pdf_path"]).resolve()), None)
+
+    def __iter__(self):
+        # Noneを受け取るまでジョブを返し続ける
+        return iter(self.queue.get, None)
+
+    def close(self):
+        self.queue.put(None)
+
+
+def make_handler(job_queue, job_store):
+    """ジョブの投入と状態確認のHTTPハンドラを作成する"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/jobs" and "path" in query:
+                entry = job_store.get(query["path"][0])
+                self._send(200 if entry else 404, entry or {"error": "not found"})
+            elif url.path == "/jobs":
+                status = query.get("status", [None])[0]
+                self._send(200, job_store.list(status))
+            elif url.path == "/status":
+                self._send(200, {"queued": job_queue.queue.qsize(), "counts": job_store.counts()})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/jobs":
+                self._send(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                path = body["path"]
+            except (ValueError, KeyError):
+                self._send(400, {"error": 'expected JSON body {"path": "..."}'})
+                return
+            if not os.path.isfile(path):
+                self._send(404, {"error": f"file not found: {path}"})
+                return
+            queued = job_queue.submit(path)
+            self._send(202, {"path": path, "queued": queued})
+
+        def log_message(self, format, *args):
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+    return Handler
+
+
+def serve(watch_dir, output_dir, process_jobs, job_store, host="127.0.0.1", port=8765,
+          poll_interval=2.0, force_polling=False):
+    """
+    フォルダの監視とHTTPエンドポイントを開始し、停止されるまでジョブを処理し続ける
+
+    Args:
+        watch_dir (str): 監視するディレクトリ
+        output_dir (str): 出力ディレクトリ
+        process_jobs (callable): ジョブのキュー（JobQueue）を処理し続ける関数（run_pipelineなど）。
+            処理が終わったジョブごとにJobQueue.doneを呼び出す
+        job_store (JobStore): ジョブの状態を確認するためのジョブストア
+        host (str): HTTPエンドポイントのホスト
+        port (int): HTTPエンドポイントのポート（0で無効）
+        poll_interval (float): ポーリングで監視する場合の間隔（秒）
+        force_polling (bool): inotifyが使える場合もポーリングで監視する
+    """
+    watch_dir = Path(watch_dir).resolve()
+    output_dir = Path(output_dir)
+
+    def make_job(pdf_path):
+        pdf_path = Path(pdf_path).resolve()
+        try:
+            relative_path = pdf_path.relative_to(watch_dir)
+        except ValueError:
+            # 監視フォルダ外から投入されたPDF
+            relative_path = Path(pdf_path.name)
+        output_path = output_dir / relative_path.parent / pdf_path.stem
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        return {"pdf_path": str(pdf_path), "output_dir": str(output_path)}
+
+    job_queue = JobQueue(make_job)
+    stop_event = threading.Event()
+
+    worker = threading.Thread(target=process_jobs, args=(job_queue,), name="gps-serve-pipeline")
+    worker.start()
+
+    # 既に置かれているPDFも処理対象にする（処理済みのものはジョブストアでスキップされる）
+    for pdf in sorted(watch_dir.rglob("*.pdf")):
+        job_queue.submit(pdf)
+
+    watcher = create_watcher(watch_dir, poll_interval, force_polling)
+    watch_thread = threading.Thread(
+        target=watcher.run, args=(job_queue.submit, stop_event), name="gps-serve-watch", daemon=True
+    )
+    watch_thread.start()
+
+    httpd = None
+    if port:
+        httpd = ThreadingHTTPServer((host, port), make_handler(job_queue, job_store))
+        logger.info(f"ジョブの投入: POST http://{host}:{port}/jobs, 状態の確認: GET http://{host}:{port}/jobs")
+    try:
+        if httpd:
+            httpd.serve_forever()
+        else:
+            stop_event.wait()
+    except KeyboardInterrupt:
+        logger.info("停止します（処理中のジョブの完了を待ちます）")
+    finally:
+        stop_event.set()
+        if httpd:
+            httpd.server_close()
+        watch_thread.join(timeout=5)
+        watcher.close()
+        job_queue.close()
+        worker.join()
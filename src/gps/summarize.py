@@ -1,9 +1,18 @@
 import os
+import asyncio
 import google.generativeai as genai
 import gps.prompts as prompts
 from . import gemini
+from . import chunking
+from . import response_cache
+from . import translation_memory
+from . import metrics
 
-def summarize(
+def summarize(*args, **kwargs):
+    """summarize_asyncを同期的に実行する"""
+    return asyncio.run(summarize_async(*args, **kwargs))
+
+async def summarize_async(
     model_name,
     generation_config,
     system_instruction,
@@ -14,7 +23,21 @@ def summarize(
     output_suffix=None,
     prefix="",
     use_cache=False,
+    max_tpm=0,
+    uploaded_file=None,
+    cached_content=None,
+    chunk_tokens=0,
+    chunk_concurrency=4,
+    memory=None,
 ):
+    """
+    マークダウンファイルを翻訳してtranslation.mdとして保存する
+    
+    uploaded_file / cached_content が指定された場合はそれを使用し、
+    アップロードやキャッシュの作成・削除は呼び出し元に任せる。
+    chunk_tokens が指定された場合は、マークダウンをチャンクに分割して並行に翻訳する。
+    memory（TranslationMemory）が指定された場合は、チャンク翻訳で翻訳メモリにあるセグメントを埋める。
+    """
     # 単一のプロンプトを使用
     prompt = prompts.single_prompt
     
@@ -36,14 +59,15 @@ def summarize(
     
     file = None
     cache = None
+    owns_resources = uploaded_file is None
     result = ""
     stats = {}
-    retry_count = 0  # 再試行回数を追跡
     
     try:
         md = os.path.join(outdir, "translation.md")
+        exists = os.path.exists(md)
         
-        if os.path.exists(md):
+        if exists:
             print(f"Skipping existing file: {md}")
             with open(md, "r", encoding="utf-8") as f:
                 result = f.read()
@@ -56,7 +80,11 @@ def summarize(
                     k = j
                 elif k < 0:
                     gemini.update_stats(stats, *gemini.get_kv(line))
-        else:
+        elif not owns_resources:
+            # 呼び出し元でアップロード済みのファイルとキャッシュを使用
+            file = uploaded_file
+            cache = cached_content
+        elif not chunk_tokens:
             # マークダウンファイルをアップロード
             file = genai.upload_file(path, mime_type="text/markdown")
             print(f"Uploaded markdown file '{file.display_name}' as: {file.uri}")
@@ -68,60 +96,30 @@ def summarize(
                     contents=[file],
                 )
             
+        if not exists:
             # プロンプトの準備
             text = "# Translation\n\n"
             print(f"---- {prefix}Translating markdown file")
             
-            # モデルの準備
-            if cache:
-                model = genai.GenerativeModel.from_cached_content(cache)
-                model.generation_config = generation_config
-            else:
+            with open(path, "r", encoding="utf-8") as f:
+                markdown = f.read()
+            # 応答キャッシュのキーに使う設定
+            cache_params = (model_name, system_instruction, generation_config)
+            
+            if chunk_tokens:
+                # 見出しと段落の境界で分割し、チャンクごとに並行して翻訳
                 model = genai.GenerativeModel(
                     model_name=model_name,
                     generation_config=generation_config,
                     system_instruction=system_instruction,
                 )
-            
-            # 初回の翻訳
-            if cache:
-                result, usage = gemini.generate_content(model, max_rpm, prompt)
-            else:
-                result, usage = gemini.generate_content(model, max_rpm, file, prompt)
-            
-            # 初回の統計情報を保存
-            total_usage = usage.copy() if usage else {}
-            
-            # <EOF>タグがない場合、翻訳が途中で終わった可能性があるため、続きを取得（1回のみ）
-            if "<EOF>" not in result[-10:] and retry_count < 1:
-                retry_count += 1
-                print("\n---- 翻訳が途中で終わった可能性があります。続きを取得します。")
-                
-                # 続きを取得するためのプロンプト
-                continuation_prompt = prompts.get_continuation_prompt(result)
-                
-                # 続きを取得
-                continuation_result, continuation_usage = gemini.generate_content(model, max_rpm, continuation_prompt)
-                
-                # 統計情報をマージ
-                for k, v in gemini.iter_stats(continuation_usage):
-                    gemini.update_stats(total_usage, k, v)
-                
-                # 結果を連結
-                result += "\n" + continuation_result
-                
-                # 統計情報を表示
-                print("\n---- 続きの翻訳の統計情報:")
-                gemini.show_stats(continuation_usage)
-                
-                # 合計統計情報を作成
-                usage = total_usage
-            
-            # <EOF>タグを削除（もし存在すれば）
-            if "<EOF>" in result[-10:]:
-                result = result[:-5].rstrip()
+                result, usage = await translate_chunks_async(
+                    model, markdown, max_rpm, max_tpm, chunk_tokens, chunk_concurrency, prefix, cache_params, memory
+                )
             else:
-                print("\n---- 警告: 翻訳が<EOF>タグで終わっていません。翻訳が不完全な可能性があります。")
+                result, usage = await translate_whole_async(
+                    model_name, generation_config, system_instruction, max_rpm, max_tpm, file, cache, prompt, markdown
+                )
             
             # 統計情報を計算して表示
             for k, v in gemini.iter_stats(usage):
@@ -134,17 +132,162 @@ def summarize(
             text += f"> {prompt}\n\n" + result
             # 元のマークダウンと同じディレクトリにtranslation.mdとして保存
             os.makedirs(os.path.dirname(translation_output), exist_ok=True)
-            with open(translation_output, "w", encoding="utf-8") as f:
+            # 途中で中断しても不完全な翻訳が残らないよう、一時ファイルに書いてから置き換える
+            with open(f"{translation_output}.part", "w", encoding="utf-8") as f:
                 f.write(result)
+            os.replace(f"{translation_output}.part", translation_output)
             print(f"Translation saved to: {translation_output}")
             
     finally:
-        if cache:
+        if cache and owns_resources:
             cache.delete()
             print("Deleted cache")
-        if file:
+        if file and owns_resources:
             genai.delete_file(file.name)
             print(f"Deleted file '{file.display_name}' from: {file.uri}")
     
     gemini.set_stats(stats)
     return result, output, stats
+
+
+async def translate_whole_async(model_name, generation_config, system_instruction, max_rpm, max_tpm, file, cache, prompt, markdown):
+    """ファイル全体を1回のリクエストで翻訳する（途中で終わった場合は1回だけ続きを取得）"""
+    retry_count = 0  # 再試行回数を追跡
+    cache_params = (model_name, system_instruction, generation_config)
+    
+    # モデルの準備
+    if cache:
+        model = genai.GenerativeModel.from_cached_content(cache)
+        model.generation_config = generation_config
+    else:
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            system_instruction=system_instruction,
+        )
+    
+    # 初回の翻訳
+    if cache:
+        result, usage = await gemini.generate_content_async(
+            model, max_rpm, prompt, max_tpm=max_tpm,
+            cache_key=response_cache.make_key(markdown, prompt, *cache_params))
+    else:
+        # アップロードしていない場合（--batch）はマークダウンを直接渡す
+        result, usage = await gemini.generate_content_async(
+            model, max_rpm, file or markdown, prompt, max_tpm=max_tpm,
+            cache_key=response_cache.make_key(markdown, prompt, *cache_params))
+    
+    # 初回の統計情報を保存
+    total_usage = usage.copy() if usage else {}
+    
+    # <EOF>タグがない場合、翻訳が途中で終わった可能性があるため、続きを取得（1回のみ）
+    if "<EOF>" not in result[-10:] and retry_count < 1:
+        retry_count += 1
+        print("\n---- 翻訳が途中で終わった可能性があります。続きを取得します。")
+        
+        # 続きを取得するためのプロンプト
+        continuation_prompt = prompts.get_continuation_prompt(result)
+        
+        # 続きを取得
+        with metrics.span("continuation"):
+            continuation_result, continuation_usage = await gemini.generate_content_async(
+                model, max_rpm, continuation_prompt, max_tpm=max_tpm,
+                cache_key=response_cache.make_key(markdown, continuation_prompt, *cache_params))
+        
+        # 統計情報をマージ
+        for k, v in gemini.iter_stats(continuation_usage):
+            gemini.update_stats(total_usage, k, v)
+        
+        # 結果を連結
+        result += "\n" + continuation_result
+        
+        # 統計情報を表示
+        print("\n---- 続きの翻訳の統計情報:")
+        gemini.show_stats(continuation_usage)
+        
+        # 合計統計情報を作成
+        usage = total_usage
+    
+    # <EOF>タグを削除（もし存在すれば）
+    if "<EOF>" in result[-10:]:
+        result = result[:-5].rstrip()
+    else:
+        print("\n---- 警告: 翻訳が<EOF>タグで終わっていません。翻訳が不完全な可能性があります。")
+    
+    return result, usage
+
+async def translate_chunk_async(model, index, chunk, max_rpm, max_tpm, semaphore, prefix="", cache_params=None, memory=None, heading=None):
+    """1チャンクを翻訳する。画像の参照や表が失われた場合は1回だけ再試行する"""
+    usage = {}
+    for attempt in range(2):
+        # 翻訳メモリは初回のみ使う（再試行では元のチャンクをそのまま送信する）
+        text, prompt, fills = translation_memory.prepare_chunk(memory if attempt == 0 else None, chunk, heading)
+        if fills and not translation_memory.needs_request(text):
+            # 全てのセグメントが翻訳メモリにある場合は送信しない
+            memory.record(fills, local=True)
+            print(f"\n---- {prefix}チャンク{index + 1}を翻訳メモリから作成しました")
+            return translation_memory.unmask(text, fills)[0], usage
+        # 入力（プロンプト＋チャンク）と出力（ほぼ同量）の概算トークン数
+        estimated = chunking.estimate_tokens(prompt + text) + chunking.estimate_tokens(text)
+        cache_key = response_cache.make_key(text, prompt, *cache_params) if cache_params else None
+        async with semaphore:
+            with metrics.span("chunk", index=index, attempt=attempt):
+                result, chunk_usage = await gemini.generate_content_async(
+                    model, max_rpm, prompt, text, max_tpm=max_tpm, estimated_tokens=estimated,
+                    cache_key=cache_key,
+                )
+        for k, v in gemini.iter_stats(chunk_usage):
+            gemini.update_stats(usage, k, v)
+        
+        # <EOF>タグを削除
+        result = result.rstrip()
+        truncated = not result.endswith("<EOF>")
+        if not truncated:
+            result = result[:-5].rstrip()
+        
+        lost = []
+        if fills:
+            result, lost = translation_memory.unmask(result, fills)
+        problems = chunking.check_chunk(chunk, result)
+        if truncated:
+            problems.append("<EOF>タグで終わっていません")
+        if lost:
+            problems.append(f"翻訳メモリのプレースホルダーが失われています: {', '.join(lost)}")
+        if not problems:
+            if fills:
+                memory.record(fills)
+            break
+        # 問題のある応答は再利用しない
+        if cache_key and gemini.response_cache:
+            gemini.response_cache.delete(cache_key)
+        print(f"\n---- {prefix}チャンク{index + 1}の翻訳に問題があります: {'; '.join(problems)}")
+    else:
+        # 再試行しても失われた画像の参照は、チャンクの末尾に補う
+        translated_images = set(chunking.image_refs(result))
+        for m in chunking.IMAGE_PATTERN.finditer(chunk):
+            if m.group(2) not in translated_images:
+                result += "\n\n" + m.group(0)
+        print(f"\n---- 警告: {prefix}チャンク{index + 1}の翻訳が不完全な可能性があります。")
+    return result, usage
+
+async def translate_chunks_async(model, markdown, max_rpm, max_tpm, chunk_tokens, concurrency=4, prefix="", cache_params=None, memory=None):
+    """
+    マークダウンをトークン数の上限付きチャンクに分割して並行に翻訳し、元の順序で結合する
+    
+    Returns:
+        tuple[str, dict]: 翻訳結果と合計の統計情報
+    """
+    chunks = chunking.split_markdown(markdown, chunk_tokens)
+    print(f"---- {prefix}{len(chunks)}個のチャンクに分割して翻訳します")
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    headings = translation_memory.section_headings(chunks)
+    results = await asyncio.gather(*[
+        translate_chunk_async(model, i, chunk, max_rpm, max_tpm, semaphore, prefix, cache_params, memory, headings[i])
+        for i, chunk in enumerate(chunks)
+    ])
+    
+    usage = {}
+    for _, chunk_usage in results:
+        for k, v in gemini.iter_stats(chunk_usage):
+            gemini.update_stats(usage, k, v)
+    return "\n\n".join(result for result, _ in results), usage
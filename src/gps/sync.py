@@ -0,0 +1,223 @@
+"""
+PDFの内容のハッシュと更新日時に基づいてディレクトリを差分同期する
+
+マニフェストに (パス, サイズ, 更新日時, SHA-256) と出力先を記録し、
+新規または変更されたPDFのみを処理する。内容が同じPDFの移動・名前変更は
+ハッシュで検出して出力を移動し、再処理しない。
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from pathlib import Path
+
+from .jobstore import normalize_path, sha256_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "logs/sync_manifest.sqlite"
+
+
+class Manifest:
+    """同期済みのPDFと出力先の対応を記録するマニフェスト"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime REAL NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " output TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS manifest_sha256 ON manifest(sha256);"
+        )
+
+    def load(self):
+        """全エントリをパスをキーとした辞書で取得する"""
+        with self._lock:
+            rows = self._conn.execute("SELECT path, size, mtime, sha256, output FROM manifest").fetchall()
+        return {r[0]: {"path": r[0], "size": r[1], "mtime": r[2], "sha256": r[3], "output": r[4]} for r in rows}
+
+    def put(self, path, size, mtime, sha256, output):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO manifest (path, size, mtime, sha256, output) VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime, sha256, output),
+            )
+
+    def delete(self, path):
+        with self._lock:
+            self._conn.execute("DELETE FROM manifest WHERE path = ?", (path,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def output_root(pdf_file: Path, input_dir: Path, output_dir: Path) -> Path:
+    """PDFに対応する出力先ディレクトリ（process_directoryと同じ配置）を取得する"""
+    relative_path = pdf_file.relative_to(input_dir)
+    return output_dir / relative_path.parent / pdf_file.stem
+
+
+def derived_from(name, stem) -> bool:
+    """ファイル名がPDF名（stem）に由来するもの（<stem>、<stem>.<拡張子>、<stem>_meta.json）かどうか"""
+    return name == stem or name.startswith(stem + ".") or name.startswith(stem + "_meta.")
+
+
+def move_outputs(old_root: Path, new_root: Path, copy=False):
+    """
+    出力ディレクトリを移動（またはコピー）し、PDF名に由来するファイル名を新しい名前に変更する
+
+    出力ディレクトリの構成は <root>/<stem>/<stem>.md, <root>/<stem>.pdf など。
+    名前を変更するのは <stem>、<stem>.<拡張子>、<stem>_meta.json だけで、同じ文字列で始まる
+    他のファイル（combined.md や markerの画像 _page_N_Picture_M.jpeg など）は変更しない。
+    """
+    if not old_root.exists():
+        return False
+    new_root.parent.mkdir(parents=True, exist_ok=True)
+    if new_root.exists():
+        shutil.rmtree(new_root)
+    if copy:
+        shutil.copytree(old_root, new_root)
+    else:
+        shutil.move(str(old_root), str(new_root))
+
+    old_stem, new_stem = old_root.name, new_root.name
+    if old_stem != new_stem:
+        children = [p for p in new_root.rglob("*") if derived_from(p.name, old_stem)]
+        for child in sorted(children, key=lambda p: len(p.parts), reverse=True):
+            child.rename(child.with_name(new_stem + child.name[len(old_stem):]))
+    return True
+
+
+def scan(input_dir: Path, output_dir: Path, manifest: Manifest, prune=False, job_store=None):
+    """
+    入力ディレクトリとマニフェストを比較し、処理が必要なPDFを判定する
+
+    移動・名前変更されたPDFの出力はこの時点で移動する。
+
+    Returns:
+        tuple[list[dict], dict]: 処理が必要なジョブのリストと、件数の集計
+    """
+    entries = manifest.load()
+    by_hash = {}
+    for entry in entries.values():
+        by_hash.setdefault(entry["sha256"], []).append(entry)
+
+    seen = set()
+    changed = []
+    counts = {"unchanged": 0, "new": 0, "changed": 0, "moved": 0, "copied": 0, "deleted": 0}
+    for pdf_file in sorted(input_dir.rglob("*.pdf")):
+        path = normalize_path(pdf_file)
+        seen.add(path)
+        stat = pdf_file.stat()
+        entry = entries.get(path)
+        root = output_root(pdf_file, input_dir, output_dir)
+        # サイズと更新日時が同じであればハッシュを計算しない
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            counts["unchanged"] += 1
+            continue
+
+        digest = sha256_file(pdf_file)
+        if entry and entry["sha256"] == digest:
+            manifest.put(path, stat.st_size, stat.st_mtime, digest, entry["output"])
+            counts["unchanged"] += 1
+            continue
+
+        # 同じ内容のPDFが処理済みであれば、出力を移動またはコピーする
+        moved = False
+        for other in by_hash.get(digest, []):
+            if other["path"] == path:
+                continue
+            source_exists = os.path.exists(other["path"])
+            if move_outputs(Path(other["output"]), root, copy=source_exists):
+                manifest.put(path, stat.st_size, stat.st_mtime, digest, str(root))
+                if job_store:
+                    job_store.update(path, "success", content_hash=digest)
+                if not source_exists:
+                    manifest.delete(other["path"])
+                    entries.pop(other["path"], None)
+                    by_hash[digest].remove(other)
+                    counts["moved"] += 1
+                    logger.info(f"移動を検出しました: {other['path']} -> {path}")
+                else:
+                    counts["copied"] += 1
+                    logger.info(f"同じ内容のPDFの出力をコピーしました: {other['path']} -> {path}")
+                moved = True
+                break
+        if moved:
+            continue
+
+        counts["changed" if entry else "new"] += 1
+        root.parent.mkdir(parents=True, exist_ok=True)
+        changed.append({
+            "pdf_path": str(pdf_file),
+            "output_dir": str(root),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": digest,
+        })
+
+    # 入力から削除されたPDF（このディレクトリ配下のもののみ）
+    input_prefix = normalize_path(input_dir) + os.sep
+    for path, entry in entries.items():
+        if path in seen or not path.startswith(input_prefix) or os.path.exists(path):
+            continue
+        counts["deleted"] += 1
+        if prune:
+            if os.path.exists(entry["output"]):
+                shutil.rmtree(entry["output"])
+            manifest.delete(path)
+            logger.info(f"削除されたPDFの出力を削除しました: {entry['output']}")
+        else:
+            logger.info(f"削除されたPDF: {path}（出力を削除するには--pruneを指定してください）")
+    return changed, counts
+
+
+def sync_directory(input_dir, output_dir, process_jobs, job_store, manifest_path=DEFAULT_PATH, prune=False):
+    """
+    ディレクトリを差分同期する
+
+    Args:
+        input_dir (str): 入力ディレクトリ
+        output_dir (str): 出力ディレクトリ
+        process_jobs (callable): ジョブのリストを処理する関数（run_pipelineなど）
+        job_store (JobStore): 処理結果を確認するためのジョブストア
+        manifest_path (str): マニフェストのパス
+        prune (bool): 削除されたPDFの出力を削除するかどうか
+
+    Returns:
+        dict: 件数の集計
+    """
+    input_dir = Path(input_dir)
+    output_dir = Path(output_dir)
+    manifest = Manifest(manifest_path)
+    try:
+        logger.info(f"同期を開始します: {input_dir}")
+        jobs, counts = scan(input_dir, output_dir, manifest, prune, job_store)
+        logger.info(
+            "変更なし: {unchanged}, 新規: {new}, 変更: {changed}, 移動: {moved}, コピー: {copied}, 削除: {deleted}".format(**counts)
+        )
+        if jobs:
+            process_jobs(jobs)
+
+        # 処理に成功したPDFのみマニフェストに記録する
+        counts["failed"] = 0
+        for job in jobs:
+            entry = job_store.get(job["pdf_path"])
+            if entry and entry["status"] == "success":
+                manifest.put(normalize_path(job["pdf_path"]), job["size"], job["mtime"], job["sha256"], job["output_dir"])
+            else:
+                counts["failed"] += 1
+        logger.info(f"同期を完了しました: {len(jobs) - counts['failed']}/{len(jobs)}件を処理しました")
+        return counts
+    finally:
+        manifest.close()
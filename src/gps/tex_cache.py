@@ -0,0 +1,95 @@
+"""
+LuaLaTeXのフォント・フォーマットキャッシュをツールで管理する
+
+luaotfloadのフォントデータベースやluatexjaのキャッシュの作成は、1回のレンダリング時間の
+大半を占める。テンプレートごとに永続的なキャッシュディレクトリ（TEXMFVAR/TEXMFCACHE）を用意し、
+最初に一度だけ作成して全てのレンダリングで再利用する。テンプレートが変わると
+別のディレクトリになるため、自動的に作り直される。
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = "cache/texmf"
+# 作成済みのキャッシュディレクトリに置くファイル
+READY_FILE = ".ready"
+
+_lock = threading.Lock()
+
+
+def cache_dir_for(template, font, pdf_engine, base_dir=DEFAULT_DIR) -> str:
+    """テンプレート・フォント・エンジンに対応するキャッシュディレクトリのパスを取得する"""
+    h = hashlib.sha256(f"{font}\0{pdf_engine}\0".encode("utf-8"))
+    if template and os.path.isfile(template):
+        with open(template, "rb") as f:
+            h.update(f.read())
+    else:
+        h.update(str(template).encode("utf-8"))
+    return os.path.join(os.path.abspath(base_dir), f"{pdf_engine}-{h.hexdigest()[:16]}")
+
+
+def is_ready(cache_dir) -> bool:
+    return os.path.exists(os.path.join(cache_dir, READY_FILE))
+
+
+def activate(cache_dir):
+    """以降に起動するTeXプロセスがキャッシュディレクトリを使うよう環境変数を設定する"""
+    os.environ["TEXMFVAR"] = cache_dir
+    os.environ["TEXMFCACHE"] = cache_dir
+
+
+def prune(base_dir, keep):
+    """使われなくなった（テンプレートが変わる前の）キャッシュディレクトリを削除する"""
+    if not os.path.isdir(base_dir):
+        return
+    for name in os.listdir(base_dir):
+        path = os.path.join(base_dir, name)
+        if path != keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info(f"古いTeXキャッシュを削除しました: {path}")
+
+
+def prepare(template, font, pdf_engine, warm_up, base_dir=DEFAULT_DIR) -> str:
+    """
+    キャッシュディレクトリを用意して有効にする。未作成の場合はwarm_upを実行して作成する
+
+    複数のスレッド・プロセスから同時に呼ばれても、作成は一度だけ行われる。
+
+    Args:
+        template (str): テンプレートファイルのパス
+        font (str): フォント名
+        pdf_engine (str): PDFエンジン
+        warm_up (callable): キャッシュを作成するために1回レンダリングする関数
+        base_dir (str): キャッシュディレクトリの親ディレクトリ
+
+    Returns:
+        str: キャッシュディレクトリのパス
+    """
+    cache_dir = cache_dir_for(template, font, pdf_engine, base_dir)
+    with _lock:
+        activate(cache_dir)
+        if is_ready(cache_dir):
+            return cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(os.path.dirname(cache_dir), ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if not is_ready(cache_dir):
+                    logger.info(f"TeXのフォント・フォーマットキャッシュを作成しています: {cache_dir}")
+                    start = time.monotonic()
+                    warm_up()
+                    elapsed = time.monotonic() - start
+                    with open(os.path.join(cache_dir, READY_FILE), "w") as f:
+                        f.write(f"{elapsed:.3f}\n")
+                    logger.info(f"TeXキャッシュを作成しました（{elapsed:.1f}秒）")
+                    prune(os.path.dirname(cache_dir), cache_dir)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return cache_dir
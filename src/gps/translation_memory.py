@@ -0,0 +1,495 @@
+"""
+論文をまたいで翻訳を再利用する翻訳メモリ（セグメント単位）
+
+完了した翻訳（元のマークダウンとtranslation.md）を見出し・参考文献の項目・段落の
+セグメントに対応付けて、正規化した原文 -> 訳文をSQLiteに記録する。チャンク翻訳では
+翻訳メモリにあるセグメントをプレースホルダー（<!-- tm:N -->）に置き換えて送信し、
+応答のプレースホルダーを訳文に戻す。全てのセグメントが翻訳メモリにあるチャンクは送信しない。
+
+- 見出しと参考文献の項目は、最初に出現した論文の訳文を記録する。番号（"2."、"[12]"）や
+  アンカー（<span id=...></span>）は除いて照合し、埋めるときは元の番号を使う。
+- 段落は2つ以上の論文に出現したもの（謝辞や助成の記載などの定型文）だけを使う。
+  1つ目の論文ではハッシュのみを記録し、2つ目の論文の訳文を記録する。
+- fuzzyを指定した場合、参考文献の項目は表記の揺れ（句読点、大文字小文字など）を許して照合する。
+- 図表のキャプションは訳文で位置が移動するため、段落の対応付けから除く。対応付けた組は
+  数字（年、番号、引用）と長さの比で確かめ、一致しないものは記録しない。
+- 誤った訳文は learn(..., overwrite=True)（gps tm build --overwrite）で上書きするか、
+  forget（gps tm forget）で削除する。
+"""
+
+import difflib
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from . import chunking
+from . import prompts
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "cache/translation_memory.sqlite"
+
+HEADING = "heading"
+REFERENCE = "reference"
+TEXT = "text"
+
+# 見出しや参考文献の項目の先頭の記号・番号・アンカー（照合には使わず、埋めるときは原文のものを使う）
+PREFIX_PATTERN = re.compile(
+    r"^(?:#{1,6}\s+|[-*+]\s+)?(?:<span[^>]*>\s*</span>\s*)*(?:\[\d+\]|\d+(?:\.\d+)*\.?(?=\s))?\s*"
+)
+SPAN_PATTERN = re.compile(r"<span[^>]*>\s*</span>")
+# 参考文献の項目の先頭の行
+ENTRY_PATTERN = re.compile(r"^\s*(?:[-*+]\s+|\[\d+\]|\d+\.\s)")
+# 参考文献のセクションの見出し
+REFERENCES_PATTERN = re.compile(r"^(?:references|bibliography|参考文献|引用文献|文献)$", re.IGNORECASE)
+PLACEHOLDER = "<!-- tm:{} -->"
+PLACEHOLDER_PATTERN = re.compile(r"<!--\s*tm:(\d+)\s*-->")
+# fuzzyの候補を絞り込むための先頭の単語数と、1回の照合で比較する候補の最大数
+SKETCH_WORDS = 4
+MAX_CANDIDATES = 50
+# これより短いセグメントは記録しない
+MIN_CHARS = 3
+# 図表のキャプション（訳文では次の段落に移動するため、段落の対応付けに使わない）
+CAPTION_PATTERN = re.compile(r"^\s*[*_]*\s*(?:Figure|Fig\.|Table|図|表)\s*\d", re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r"\d+")
+# 段落の訳文の長さ / 原文の長さ の許容範囲（英語 -> 日本語）
+LENGTH_RATIO = (0.1, 2.0)
+
+
+def split_prefix(segment: str) -> tuple[str, str]:
+    """セグメントを先頭の記号・番号と本文に分ける"""
+    m = PREFIX_PATTERN.match(segment)
+    return segment[:m.end()], segment[m.end():]
+
+
+def normalize(text: str) -> str:
+    """照合用にアンカーを除き、空白をまとめる"""
+    return " ".join(SPAN_PATTERN.sub("", text).split())
+
+
+def fuzzy_form(text: str) -> str:
+    """表記の揺れを許して比較するための形（小文字の英数字の単語列）"""
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def is_heading(block: str) -> bool:
+    return block.startswith("#")
+
+
+def is_references(heading: str) -> bool:
+    """参考文献のセクションの見出しかどうか"""
+    return bool(REFERENCES_PATTERN.match(normalize(split_prefix(heading)[1]).strip("*: ")))
+
+
+def is_translatable(block: str) -> bool:
+    """翻訳の対象になるブロックかどうか（画像、表、コード、数式のブロックは除く）"""
+    stripped = block.strip()
+    if not stripped or PLACEHOLDER_PATTERN.fullmatch(stripped):
+        return False
+    if chunking.IMAGE_PATTERN.fullmatch(stripped) or chunking.table_rows(stripped):
+        return False
+    return not stripped.startswith(("```", "$$"))
+
+
+def split_entries(block: str) -> list[str]:
+    """参考文献のブロックを項目ごとの行に分ける（項目の先頭の行がない場合はブロック全体で1項目）"""
+    entries = []
+    for line in block.splitlines():
+        if ENTRY_PATTERN.match(line) or not entries:
+            entries.append(line)
+        else:
+            entries[-1] += "\n" + line
+    return entries
+
+
+def is_caption(block: str) -> bool:
+    """図表のキャプションかどうか"""
+    return bool(CAPTION_PATTERN.match(block))
+
+
+def plausible(kind, source, translation) -> bool:
+    """
+    対応付けた原文と訳文の組が妥当かどうか
+
+    数字（年、番号、引用）が同じであること、段落は長さの比が極端でないことを確かめる。
+    """
+    if sorted(NUMBER_PATTERN.findall(source)) != sorted(NUMBER_PATTERN.findall(translation)):
+        return False
+    if kind == TEXT:
+        low, high = LENGTH_RATIO
+        return low <= len(translation) / max(len(source), 1) <= high
+    return True
+
+
+def segment(kind, source, translation=None):
+    """(種類, 照合用の原文, 訳文の本文) を作成する"""
+    if kind == TEXT:
+        return kind, normalize(source), translation
+    return kind, normalize(split_prefix(source)[1]), translation and split_prefix(translation)[1].strip()
+
+
+def align_sections(source_sections, translated_sections):
+    """対応するセクションの組から、対応付けられたセグメントを取得する"""
+    segments = []
+    for source, translated in zip(source_sections, translated_sections):
+        if is_heading(source[0]) and is_heading(translated[0]):
+            segments.append(segment(HEADING, source[0], translated[0]))
+        if is_heading(source[0]) and is_references(source[0]):
+            source_entries = [e for b in source[1:] for e in split_entries(b)]
+            translated_entries = [e for b in translated[1:] for e in split_entries(b)]
+            if len(source_entries) == len(translated_entries):
+                segments += [segment(REFERENCE, s, t) for s, t in zip(source_entries, translated_entries)]
+            continue
+        # 段落は数が一致する場合のみ順に対応付ける（画像とキャプションは移動するため除く）
+        source_blocks = [b for b in source[1:] if is_translatable(b) and not is_caption(b)]
+        translated_blocks = [b for b in translated[1:] if is_translatable(b) and not is_caption(b)]
+        if len(source_blocks) == len(translated_blocks):
+            segments += [segment(TEXT, s, t) for s, t in zip(source_blocks, translated_blocks)]
+    return segments
+
+
+def align(source: str, translation: str) -> list[tuple[str, str, str]]:
+    """
+    原文と訳文のマークダウンをセグメント単位で対応付ける
+
+    見出しの数が一致する場合はセクションを順に対応付ける。一致しない場合は
+    参考文献のセクションだけを対応付ける。
+
+    Returns:
+        list[tuple[str, str, str]]: (種類, 照合用の原文, 訳文の本文) のリスト
+    """
+    source_sections = chunking.split_sections(chunking.split_blocks(source))
+    translated_sections = chunking.split_sections(chunking.split_blocks(translation))
+    if len(source_sections) != len(translated_sections):
+        source_sections = [s for s in source_sections if is_heading(s[0]) and is_references(s[0])][-1:]
+        translated_sections = [s for s in translated_sections if is_heading(s[0]) and is_references(s[0])][-1:]
+    return [
+        s for s in align_sections(source_sections, translated_sections)
+        if len(s[1]) >= MIN_CHARS and s[2] and s[1] != normalize(s[2]) and plausible(*s)
+    ]
+
+
+def section_headings(chunks: list[str]) -> list[str]:
+    """各チャンクの直前の見出しを取得する（チャンクがセクションの途中から始まる場合に使う）"""
+    headings = []
+    heading = None
+    for chunk in chunks:
+        headings.append(heading)
+        for block in chunking.split_blocks(chunk):
+            if is_heading(block):
+                heading = block
+    return headings
+
+
+class TranslationMemory:
+    """セグメントの原文 -> 訳文をSQLiteに記録する翻訳メモリ"""
+
+    def __init__(self, path=DEFAULT_PATH, fuzzy=0.0):
+        """
+        Args:
+            path (str): SQLiteファイルのパス
+            fuzzy (float): 参考文献の項目を表記の揺れを許して照合する場合の類似度の下限（0で完全一致のみ）
+        """
+        self.path = path
+        self.fuzzy = fuzzy
+        self.hits = 0
+        self.saved_chars = 0
+        self.local_chunks = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            " key TEXT PRIMARY KEY,"
+            " kind TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " translation TEXT,"
+            " sketch TEXT NOT NULL,"
+            " papers INTEGER NOT NULL,"
+            " last_paper TEXT,"
+            " updated REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS segments_sketch ON segments(kind, sketch)")
+
+    @staticmethod
+    def make_key(kind, source):
+        return hashlib.sha256(f"{kind}\0{source}".encode("utf-8")).hexdigest()
+
+    def learn(self, source: str, translation: str, overwrite=False) -> int:
+        """
+        論文の原文と訳文から翻訳メモリを更新する
+
+        記録済みのセグメントの訳文は変更しない。overwriteを指定した場合はこの論文の訳文で置き換える
+        （段落は2つ目の論文に出現するまで訳文を記録しない規則は変わらない）。
+
+        Returns:
+            int: 対応付けられたセグメント数
+        """
+        segments = align(source, translation)
+        paper = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for kind, text, translated in segments:
+                    key = self.make_key(kind, text)
+                    row = self._conn.execute(
+                        "SELECT last_paper, translation FROM segments WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is None:
+                        # 段落は2つ目の論文に出現するまで訳文を記録しない
+                        first = None if kind == TEXT else translated
+                        sketch = " ".join(fuzzy_form(text).split()[:SKETCH_WORDS]) if kind == REFERENCE else ""
+                        self._conn.execute(
+                            "INSERT INTO segments (key, kind, source, translation, sketch, papers, last_paper, updated)"
+                            " VALUES (?, ?, ?, ?, ?, 1, ?, ?)",
+                            (key, kind, text if kind == REFERENCE else "", first, sketch, paper, now),
+                        )
+                    elif row[0] != paper or overwrite:
+                        new_paper = row[0] != paper
+                        if overwrite and (kind != TEXT or new_paper or row[1] is not None):
+                            value = translated
+                        elif new_paper and row[1] is None:
+                            value = translated
+                        else:
+                            value = row[1]
+                        self._conn.execute(
+                            "UPDATE segments SET papers = papers + ?, last_paper = ?, updated = ?,"
+                            " translation = ? WHERE key = ?",
+                            (int(new_paper), paper, now, value, key),
+                        )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(segments)
+
+    def forget(self, sources) -> int:
+        """
+        セグメント（見出し、参考文献の項目、段落の原文）を翻訳メモリから削除する
+
+        Returns:
+            int: 削除したセグメント数
+        """
+        keys = [self.make_key(kind, segment(kind, source)[1]) for source in sources for kind in (HEADING, REFERENCE, TEXT)]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                deleted = sum(
+                    self._conn.execute("DELETE FROM segments WHERE key = ?", (key,)).rowcount for key in keys
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return deleted
+
+    def lookup(self, kind, source):
+        """セグメントの訳文の本文を取得する。ない場合はNoneを返す"""
+        text = segment(kind, source)[1]
+        if len(text) < MIN_CHARS:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT translation FROM segments WHERE key = ?", (self.make_key(kind, text),)
+            ).fetchone()
+            if row and row[0]:
+                return row[0]
+            if kind != REFERENCE or not self.fuzzy:
+                return None
+            form = fuzzy_form(text)
+            candidates = self._conn.execute(
+                "SELECT source, translation FROM segments WHERE kind = ? AND sketch = ? AND translation IS NOT NULL LIMIT ?",
+                (kind, " ".join(form.split()[:SKETCH_WORDS]), MAX_CANDIDATES),
+            ).fetchall()
+        best, best_ratio = None, self.fuzzy
+        for candidate, translated in candidates:
+            ratio = difflib.SequenceMatcher(None, form, fuzzy_form(candidate)).ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = translated, ratio
+        return best
+
+    def fill(self, kind, source):
+        """セグメントの訳文（原文の先頭の記号・番号付き）を取得する。ない場合はNoneを返す"""
+        translated = self.lookup(kind, source)
+        if translated is None:
+            return None
+        if kind == TEXT:
+            return translated
+        return split_prefix(source)[0] + translated
+
+    def mask(self, chunk: str, heading: str = None) -> tuple[str, dict[str, str]]:
+        """
+        チャンクの翻訳メモリにあるセグメントをプレースホルダーに置き換える
+
+        連続するセグメントは1つのプレースホルダーにまとめる。
+
+        Args:
+            chunk (str): チャンク
+            heading (str, optional): チャンクの直前の見出し（参考文献のセクションの途中から始まる場合の判定に使う）
+
+        Returns:
+            tuple[str, dict[str, str]]: 置き換えたチャンクと、プレースホルダー -> 訳文
+        """
+        fills = {}
+        blocks = []
+        pending = []
+
+        def flush(out, separator):
+            if pending:
+                placeholder = PLACEHOLDER.format(len(fills) + 1)
+                fills[placeholder] = separator.join(pending)
+                out.append(placeholder)
+                pending.clear()
+
+        in_references = bool(heading) and is_references(heading)
+        for block in chunking.split_blocks(chunk):
+            if is_heading(block):
+                in_references = is_references(block)
+                translated = self.fill(HEADING, block)
+            elif not is_translatable(block):
+                translated = None
+            elif in_references:
+                entries = split_entries(block)
+                translated_entries = [self.fill(REFERENCE, entry) for entry in entries]
+                if None not in translated_entries:
+                    translated = "\n".join(translated_entries)
+                elif any(t is not None for t in translated_entries):
+                    # 一部の項目だけが翻訳メモリにある場合は、ブロック内で行ごとに置き換える
+                    flush(blocks, "\n\n")
+                    lines = []
+                    for entry, translated_entry in zip(entries, translated_entries):
+                        if translated_entry is not None:
+                            pending.append(translated_entry)
+                            continue
+                        flush(lines, "\n")
+                        lines.append(entry)
+                    flush(lines, "\n")
+                    blocks.append("\n".join(lines))
+                    continue
+                else:
+                    translated = None
+            else:
+                translated = self.fill(TEXT, block)
+            if translated is not None:
+                pending.append(translated)
+                continue
+            flush(blocks, "\n\n")
+            blocks.append(block)
+        flush(blocks, "\n\n")
+        return "\n\n".join(blocks), fills
+
+    def record(self, fills, local=False):
+        """置き換えたセグメントの統計を記録する"""
+        with self._lock:
+            self.hits += len(fills)
+            self.saved_chars += sum(len(text) for text in fills.values())
+            self.local_chunks += bool(local)
+
+    def stats(self):
+        with self._lock:
+            rows, translated = self._conn.execute(
+                "SELECT COUNT(*), COUNT(translation) FROM segments"
+            ).fetchone()
+            return {
+                "segments": rows,
+                "translated_segments": translated,
+                "hits": self.hits,
+                "saved_chars": self.saved_chars,
+                "local_chunks": self.local_chunks,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def prepare_chunk(memory, chunk, heading=None):
+    """
+    翻訳メモリを適用したチャンクの翻訳のリクエストを作成する
+
+    Returns:
+        tuple[str, str, dict[str, str]]: (送信するチャンク, プロンプト, プレースホルダー -> 訳文)
+    """
+    if memory is None:
+        return chunk, prompts.chunk_prompt, {}
+    masked, fills = memory.mask(chunk, heading)
+    if not fills:
+        return chunk, prompts.chunk_prompt, {}
+    return masked, prompts.chunk_memory_prompt, fills
+
+
+def needs_request(masked: str) -> bool:
+    """プレースホルダーに置き換えた後のチャンクに翻訳する部分が残っているかどうか"""
+    return any(is_translatable(block) for block in chunking.split_blocks(masked))
+
+
+def unmask(text: str, fills: dict[str, str]) -> tuple[str, list[str]]:
+    """
+    プレースホルダーを訳文に戻す
+
+    Returns:
+        tuple[str, list[str]]: 訳文に戻したテキストと、応答から失われたプレースホルダーのリスト
+    """
+    found = set()
+
+    def replace(m):
+        placeholder = PLACEHOLDER.format(m.group(1))
+        if placeholder not in fills:
+            return m.group(0)
+        found.add(placeholder)
+        return fills[placeholder]
+
+    text = PLACEHOLDER_PATTERN.sub(replace, text)
+    return text, [p for p in fills if p not in found]
+
+
+def find_outputs(root):
+    """
+    出力ディレクトリから (元のマークダウン, 訳文) のパスの組を探す
+
+    訳文はtranslation.md、またはcombined.mdの「## 論文全文」以降を使う。
+    """
+    for dirpath, _, filenames in os.walk(root):
+        source = os.path.join(dirpath, os.path.basename(dirpath) + ".md")
+        if not os.path.exists(source):
+            continue
+        for name in ("translation.md", "combined.md"):
+            if name in filenames:
+                yield source, os.path.join(dirpath, name)
+                break
+
+
+def read_translation(path):
+    """translation.mdまたはcombined.mdから訳文を読み込む"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    marker = "\n\n---\n\n## 論文全文\n\n"
+    if os.path.basename(path) == "combined.md" and marker in text:
+        text = text.split(marker, 1)[1]
+    return text
+
+
+def build(memory, roots, overwrite=False):
+    """
+    完了した出力から翻訳メモリを作成する（overwriteを指定した場合は記録済みの訳文を置き換える）
+
+    Returns:
+        tuple[int, int]: (論文数, 対応付けられたセグメント数)
+    """
+    papers = 0
+    segments = 0
+    for root in roots:
+        for source_path, translation_path in find_outputs(root):
+            with open(source_path, "r", encoding="utf-8") as f:
+                source = f.read()
+            count = memory.learn(source, read_translation(translation_path), overwrite)
+            logger.info(f"翻訳メモリに追加: {translation_path}（{count}セグメント）")
+            papers += 1
+            segments += count
+    return papers, segments
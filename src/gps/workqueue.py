@@ -0,0 +1,430 @@
+"""
+複数のマシンで1つのアーカイブを処理するための共有ワークキュー
+
+コーディネータ（gps queue add）が論文をキューに登録し、各マシンのワーカー（gps worker）が
+期限付きのリースを取得して処理する。ワーカーは処理中のリースを定期的に延長し、完了または
+失敗を記録する。ワーカーがクラッシュしてリースが延長されなくなると、期限切れの論文は
+他のワーカーに再び割り当てられる（MAX_ATTEMPTS回まで）。
+
+キューは共有ファイルシステム上のSQLite（WorkQueue）か、それをHTTPで公開したサーバー
+（gps queue serve、RemoteQueue）で共有する。SQLiteのロックが信頼できないファイルシステム
+（NFSなど）ではサーバーを使う。
+
+リースには取得ごとに増える番号（attempts）を付け、期限切れの後に他のワーカーへ割り当てられた
+論文について、元のワーカーが延長や完了を記録しても無視されるようにする。
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "cache/work_queue.sqlite"
+DEFAULT_PORT = 8766
+# リースの期限（秒）。ワーカーは期限の1/3ごとに延長する
+DEFAULT_LEASE = 300
+# キューが空の場合に再確認する間隔（秒）
+DEFAULT_POLL_INTERVAL = 10
+# リースの期限切れ（ワーカーのクラッシュ）がこの回数に達した論文は失敗とする
+MAX_ATTEMPTS = 3
+# キューに接続できない場合のエラー（サーバーの停止、共有ファイルシステムのロックの失敗など）
+QUEUE_ERRORS = (OSError, sqlite3.Error)
+
+
+def worker_name() -> str:
+    """このプロセスを識別するワーカー名（ホスト名:PID）"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """SQLite（WALモード）に保存する共有ワークキュー"""
+
+    def __init__(self, path=DEFAULT_PATH, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS queue ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " path TEXT NOT NULL UNIQUE,"
+            " output_dir TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " worker TEXT,"
+            " lease_until REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " updated REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS queue_status ON queue(status, lease_until);"
+        )
+
+    def _transaction(self, func):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def enqueue(self, jobs, retry_failed=False):
+        """
+        論文をキューに登録する（登録済みの論文は状態を変えない）
+
+        Args:
+            jobs (list): {"pdf_path", "output_dir"} のリスト（他のマシンからも参照できるパス）
+            retry_failed (bool): 失敗した論文を再び処理待ちにする
+
+        Returns:
+            int: 処理待ちにした論文の数
+        """
+        now = time.time()
+
+        def run(conn):
+            added = 0
+            for job in jobs:
+                cursor = conn.execute(
+                    "INSERT INTO queue (path, output_dir, status, updated) VALUES (?, ?, 'queued', ?)"
+                    " ON CONFLICT(path) DO NOTHING",
+                    (job["pdf_path"], job["output_dir"], now),
+                )
+                if not cursor.rowcount and retry_failed:
+                    cursor = conn.execute(
+                        "UPDATE queue SET status = 'queued', worker = NULL, attempts = 0, error = NULL, updated = ?"
+                        " WHERE path = ? AND status = 'failed'",
+                        (now, job["pdf_path"]),
+                    )
+                added += cursor.rowcount
+            return added
+
+        return self._transaction(run)
+
+    def claim(self, worker, lease_seconds=DEFAULT_LEASE):
+        """
+        処理待ちまたはリースが期限切れの論文を1件取得する
+
+        Returns:
+            dict: {"id", "pdf_path", "output_dir", "lease"}。取得できる論文がない場合はNone
+        """
+        def run(conn):
+            now = time.time()
+            while True:
+                row = conn.execute(
+                    "SELECT id, path, output_dir, attempts, worker FROM queue"
+                    " WHERE status = 'queued' OR (status = 'leased' AND lease_until < ?)"
+                    " ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    return None
+                job_id, path, output_dir, attempts, previous = row
+                if attempts >= self.max_attempts:
+                    # 何度もワーカーが停止する論文は、他のワーカーを巻き込まないよう失敗とする
+                    conn.execute(
+                        "UPDATE queue SET status = 'failed', worker = NULL, lease_until = NULL, error = ?, updated = ?"
+                        " WHERE id = ?",
+                        (f"リースの期限切れが{attempts}回続きました（最後のワーカー: {previous}）", now, job_id),
+                    )
+                    continue
+                conn.execute(
+                    "UPDATE queue SET status = 'leased', worker = ?, lease_until = ?, attempts = ?, updated = ?"
+                    " WHERE id = ?",
+                    (worker, now + lease_seconds, attempts + 1, now, job_id),
+                )
+                if previous:
+                    logger.warning(f"リースが期限切れのため再び割り当てます（前のワーカー: {previous}）: {path}")
+                return {"id": job_id, "pdf_path": path, "output_dir": output_dir, "lease": attempts + 1}
+
+        return self._transaction(run)
+
+    def heartbeat(self, worker, leases, lease_seconds=DEFAULT_LEASE):
+        """
+        保持しているリースを延長する
+
+        Args:
+            leases (list): (id, lease) のリスト
+
+        Returns:
+            list: 延長できなかった（他のワーカーに割り当てられた）論文のid
+        """
+        def run(conn):
+            now = time.time()
+            lost = []
+            for job_id, lease in leases:
+                cursor = conn.execute(
+                    "UPDATE queue SET lease_until = ?, updated = ?"
+                    " WHERE id = ? AND attempts = ? AND worker = ? AND status = 'leased'",
+                    (now + lease_seconds, now, job_id, lease, worker),
+                )
+                if not cursor.rowcount:
+                    lost.append(job_id)
+            return lost
+
+        return self._transaction(run)
+
+    def complete(self, worker, job_id, lease, status, error=None):
+        """
+        処理の結果（"done" または "failed"）を記録する
+
+        Returns:
+            bool: 記録した場合はTrue。リースを失っていた場合はFalse
+        """
+        def run(conn):
+            cursor = conn.execute(
+                "UPDATE queue SET status = ?, error = ?, lease_until = NULL, updated = ?"
+                " WHERE id = ? AND attempts = ? AND worker = ? AND status = 'leased'",
+                (status, str(error) if error else None, time.time(), job_id, lease, worker),
+            )
+            return bool(cursor.rowcount)
+
+        return self._transaction(run)
+
+    def release(self, worker, job_id, lease):
+        """処理を始めていない（または中断した）論文を処理待ちに戻す（試行回数に数えない）"""
+        def run(conn):
+            cursor = conn.execute(
+                "UPDATE queue SET status = 'queued', worker = NULL, lease_until = NULL,"
+                " attempts = attempts - 1, updated = ?"
+                " WHERE id = ? AND attempts = ? AND worker = ? AND status = 'leased'",
+                (time.time(), job_id, lease, worker),
+            )
+            return bool(cursor.rowcount)
+
+        return self._transaction(run)
+
+    def pending(self):
+        """処理待ちと処理中（リース中）の論文の数"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM queue WHERE status IN ('queued', 'leased')"
+            ).fetchone()[0]
+
+    def counts(self):
+        """状態ごとの論文の数"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM queue GROUP BY status").fetchall()
+        return dict(rows)
+
+    def leases(self):
+        """リース中の論文（ワーカー、期限までの秒数、試行回数）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, worker, lease_until, attempts FROM queue WHERE status = 'leased' ORDER BY id"
+            ).fetchall()
+        now = time.time()
+        return [
+            {"path": path, "worker": worker, "expires_in": lease_until - now, "attempts": attempts}
+            for path, worker, lease_until, attempts in rows
+        ]
+
+    def failures(self, limit=100):
+        """失敗した論文とエラー"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, error FROM queue WHERE status = 'failed' ORDER BY updated DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [{"path": path, "error": error} for path, error in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# RemoteQueueから呼び出せるメソッド
+REMOTE_METHODS = ("enqueue", "claim", "heartbeat", "complete", "release", "pending", "counts", "leases", "failures")
+
+
+class RemoteQueue:
+    """gps queue serve で公開したワークキューのクライアント（WorkQueueと同じメソッドを持つ）"""
+
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _call(self, method, **kwargs):
+        from urllib.request import Request, urlopen
+        request = Request(
+            f"{self.url}/{method}",
+            data=json.dumps(kwargs).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())["result"]
+
+    def __getattr__(self, name):
+        if name not in REMOTE_METHODS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, **dict(zip(_parameters(name), args)), **kwargs)
+
+    def close(self):
+        pass
+
+
+def _parameters(method):
+    """WorkQueueのメソッドの引数名（位置引数をキーワード引数にして送るため）"""
+    code = getattr(WorkQueue, method).__code__
+    return code.co_varnames[1:code.co_argcount]
+
+
+def open_queue(spec):
+    """URL（http://host:port）の場合はRemoteQueue、それ以外はSQLiteのパスとしてWorkQueueを開く"""
+    if urlparse(spec).scheme in ("http", "https"):
+        return RemoteQueue(spec)
+    return WorkQueue(spec)
+
+
+def make_handler(work_queue):
+    """ワークキューのメソッドをPOST /<method>（JSONのキーワード引数）で呼び出すHTTPハンドラを作成する"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if urlparse(self.path).path == "/status":
+                self._send(200, {"counts": work_queue.counts(), "leases": work_queue.leases()})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            method = urlparse(self.path).path.strip("/")
+            if method not in REMOTE_METHODS:
+                self._send(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                kwargs = json.loads(self.rfile.read(length) or b"{}")
+                result = getattr(work_queue, method)(**kwargs)
+            except (ValueError, TypeError) as e:
+                self._send(400, {"error": str(e)})
+                return
+            self._send(200, {"result": result})
+
+        def log_message(self, format, *args):
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+    return Handler
+
+
+def serve_queue(work_queue, host="127.0.0.1", port=DEFAULT_PORT):
+    """ワークキューをHTTPで公開し、停止されるまで応答し続ける"""
+    httpd = ThreadingHTTPServer((host, port), make_handler(work_queue))
+    logger.info(f"ワークキューを公開しました: http://{host}:{httpd.server_address[1]}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("停止します")
+    finally:
+        httpd.server_close()
+
+
+class LeaseKeeper:
+    """ワーカーが取得したリースを保持し、処理が終わるまで定期的に延長する"""
+
+    def __init__(self, work_queue, lease_seconds=DEFAULT_LEASE, worker=None):
+        self.queue = work_queue
+        self.lease_seconds = lease_seconds
+        self.worker = worker or worker_name()
+        self.held = {}
+        # 延長できずにリースを失った（他のワーカーに割り当てられた可能性がある）論文のID
+        self.lost = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="gps-lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def jobs(self, wait=False, poll_interval=DEFAULT_POLL_INTERVAL):
+        """
+        リースを取得した論文のジョブを返し続ける
+
+        キューが空でも他のワーカーが処理中の論文があれば、期限切れになった場合に引き継げるよう待つ。
+        waitがTrueの場合は、全ての論文が終わった後も新しい論文の登録を待ち続ける。
+        """
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(self.worker, self.lease_seconds)
+                pending = job is not None or self.queue.pending()
+            except QUEUE_ERRORS as e:
+                logger.warning(f"ワークキューに接続できません（{poll_interval}秒後に再試行します）: {e}")
+                job, pending = None, True
+            if job:
+                with self._lock:
+                    self.held[job["id"]] = job["lease"]
+                logger.info(f"リースを取得しました（{job['lease']}回目）: {job['pdf_path']}")
+                Path(job["output_dir"]).parent.mkdir(parents=True, exist_ok=True)
+                yield {
+                    "pdf_path": job["pdf_path"],
+                    "output_dir": job["output_dir"],
+                    "queue_id": job["id"],
+                    "lease": job["lease"],
+                }
+                continue
+            if not pending and not wait:
+                return
+            self._stop.wait(poll_interval)
+
+    def is_lost(self, job) -> bool:
+        """ジョブのリースを失っているかどうか（Trueの場合は以降の処理を行わない）"""
+        with self._lock:
+            return job["queue_id"] in self.lost
+
+    def finish(self, job, status, error=None):
+        """ジョブの結果（"done" または "failed"）をキューに記録し、リースを手放す"""
+        with self._lock:
+            self.lost.discard(job["queue_id"])
+            lease = self.held.pop(job["queue_id"], None)
+        if lease is None:
+            return
+        try:
+            if not self.queue.complete(self.worker, job["queue_id"], lease, status, error):
+                logger.warning(f"リースを失っていたため、結果を記録しませんでした: {job['pdf_path']}")
+        except QUEUE_ERRORS as e:
+            # 記録できなかった論文はリースの期限切れ後に再び割り当てられる
+            logger.error(f"ワークキューに結果を記録できませんでした: {job['pdf_path']}: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                leases = list(self.held.items())
+            if not leases:
+                continue
+            try:
+                lost = self.queue.heartbeat(self.worker, leases, self.lease_seconds)
+            except QUEUE_ERRORS as e:
+                logger.warning(f"リースを延長できませんでした: {e}")
+                continue
+            for job_id in lost:
+                with self._lock:
+                    self.held.pop(job_id, None)
+                    self.lost.add(job_id)
+                logger.warning(f"リースを失いました（他のワーカーに割り当てられた可能性があります）: id={job_id}")
+
+    def close(self):
+        """延長を止め、終わっていない論文を処理待ちに戻す"""
+        self._stop.set()
+        self._thread.join(timeout=5)
+        with self._lock:
+            leases = list(self.held.items())
+            self.held.clear()
+        for job_id, lease in leases:
+            try:
+                self.queue.release(self.worker, job_id, lease)
+            except QUEUE_ERRORS as e:
+                logger.warning(f"リースを手放せませんでした（期限切れ後に再び割り当てられます）: id={job_id}: {e}")
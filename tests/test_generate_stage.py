@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+import pytest
+
+genai = pytest.importorskip("google.generativeai")
+grpc = pytest.importorskip("grpc")
+
+from google.ai import generativelanguage_v1beta as glm
+from google.ai.generativelanguage_v1beta.services.generative_service.transports.grpc_asyncio import (
+    GenerativeServiceGrpcAsyncIOTransport,
+)
+
+from gps import __main__ as gps_main
+
+SERVICE = "google.ai.generativelanguage.v1beta.GenerativeService"
+
+
+@pytest.fixture
+def grpc_server():
+    """Local StreamGenerateContent server that echoes the last text part followed by <EOF>"""
+    ready = threading.Event()
+    state = {}
+
+    async def stream(request, context):
+        text = request.contents[-1].parts[-1].text
+        yield glm.GenerateContentResponse(
+            candidates=[{"content": {"role": "model", "parts": [{"text": text + "\n<EOF>"}]}}],
+            usage_metadata={"prompt_token_count": 10, "candidates_token_count": 5, "total_token_count": 15},
+        )
+
+    async def serve():
+        server = grpc.aio.server()
+        server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(SERVICE, {
+            "StreamGenerateContent": grpc.unary_stream_rpc_method_handler(
+                stream,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+        }),))
+        state["port"] = server.add_insecure_port("127.0.0.1:0")
+        state["loop"], state["stop"] = asyncio.get_running_loop(), asyncio.Event()
+        await server.start()
+        ready.set()
+        await state["stop"].wait()
+        await server.stop(None)
+
+    thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+    thread.start()
+    ready.wait(10)
+    yield state["port"]
+    state["loop"].call_soon_threadsafe(state["stop"].set)
+    thread.join(10)
+
+
+def test_generate_stage_runs_several_papers_on_the_cached_async_client(grpc_server, tmp_path, monkeypatch):
+    # The real async client, connected without TLS to the local server
+    def transport(**kwargs):
+        kwargs["channel"] = lambda *args, **options: grpc.aio.insecure_channel(f"127.0.0.1:{grpc_server}")
+        return GenerativeServiceGrpcAsyncIOTransport(**kwargs)
+
+    genai.configure(api_key="test", transport=transport)
+    monkeypatch.setattr(gps_main, "gemini_configured", True)
+    monkeypatch.chdir(tmp_path)
+    args = gps_main.parse_args(["input", "--nosummary", "--no-translation-memory", "--rpm", "0"])
+
+    for name in ("first", "second", "third"):
+        paper_dir = tmp_path / "output" / name
+        paper_dir.mkdir(parents=True)
+        md_path = paper_dir / f"{name}.md"
+        md_path.write_text(f"# {name}\n\nBody of the {name} paper.\n", encoding="utf-8")
+        job = {"pdf_path": str(tmp_path / f"{name}.pdf"), "output_dir": str(paper_dir), "md_path": str(md_path)}
+
+        assert gps_main.generate_stage(job, args) is job
+        assert f"Body of the {name} paper." in (paper_dir / "translation.md").read_text(encoding="utf-8")
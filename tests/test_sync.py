@@ -0,0 +1,34 @@
+from gps.sync import move_outputs
+
+
+def test_move_outputs_renames_only_stem_files(tmp_path):
+    old_root = tmp_path / "c"
+    paper_dir = old_root / "c"
+    paper_dir.mkdir(parents=True)
+    for name in ("c.md", "c_meta.json", "combined.md", "_page_0_Picture_1.jpeg"):
+        (paper_dir / name).write_text(name)
+    (old_root / "c.pdf").write_text("pdf")
+
+    new_root = tmp_path / "paper"
+    assert move_outputs(old_root, new_root)
+
+    assert not old_root.exists()
+    assert sorted(p.name for p in (new_root / "paper").iterdir()) == [
+        "_page_0_Picture_1.jpeg", "combined.md", "paper.md", "paper_meta.json",
+    ]
+    assert (new_root / "paper" / "combined.md").read_text() == "combined.md"
+    assert (new_root / "paper.pdf").exists()
+
+
+def test_move_outputs_keeps_marker_images_with_stem_prefix(tmp_path):
+    old_root = tmp_path / "_page"
+    paper_dir = old_root / "_page"
+    paper_dir.mkdir(parents=True)
+    (paper_dir / "_page.md").write_text("![](_page_1_Picture_2.jpeg)")
+    (paper_dir / "_page_1_Picture_2.jpeg").write_bytes(b"jpeg")
+
+    new_root = tmp_path / "renamed"
+    assert move_outputs(old_root, new_root, copy=True)
+
+    assert old_root.exists()
+    assert sorted(p.name for p in (new_root / "renamed").iterdir()) == ["_page_1_Picture_2.jpeg", "renamed.md"]